@@ -0,0 +1,44 @@
+import logging
+
+from dl_portfolio.cache import invalidate_cache, list_cache
+from dl_portfolio.logger import LOGGER
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache_dir",
+                        type=str,
+                        help="Cache directory of performance.py")
+    parser.add_argument("--base_dir",
+                        default=None,
+                        type=str,
+                        help="Only invalidate the results of this run directory")
+    parser.add_argument("--test_set",
+                        default=None,
+                        type=str,
+                        help="Only invalidate the results of this test set: val or test")
+    parser.add_argument("--older_than",
+                        default=None,
+                        type=float,
+                        help="Only invalidate the results created more than older_than days ago")
+    parser.add_argument("--list",
+                        action='store_true',
+                        help="List the cached results instead of removing them")
+    parser.add_argument("-v",
+                        "--verbose",
+                        help="Be verbose",
+                        action="store_const",
+                        dest="loglevel",
+                        const=logging.INFO,
+                        default=logging.WARNING)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+    LOGGER.setLevel(args.loglevel)
+
+    if args.list:
+        print(list_cache(args.cache_dir).to_string())
+    else:
+        removed = invalidate_cache(args.cache_dir, base_dir=args.base_dir, test_set=args.test_set,
+                                   older_than=args.older_than)
+        print(f"Removed {len(removed)} cached results")
@@ -2,6 +2,9 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache, partial
 from scipy import stats as scipy_stats
 from typing import Union, Dict, Optional, List
 from joblib import Parallel, delayed
@@ -12,10 +15,108 @@ from dl_portfolio.data import load_data
 from dl_portfolio.utils import load_result
 from dl_portfolio.constant import DATA_SPECS_BOND, DATA_SPECS_MULTIASSET_TRADITIONAL
 from dl_portfolio.probabilistic_sr import probabilistic_sharpe_ratio, min_track_record_length
-from dl_portfolio.weights import portfolio_weights, equal_class_weights
+from dl_portfolio.weights import BATCH_PORTFOLIOS, fold_batch_weights, portfolio_weights, equal_class_weights
+from dl_portfolio.context import PortfolioContext, get_context, get_contexts
+from dl_portfolio.cluster import ensemble_embedding
+from dl_portfolio.covariance import factor_covariance
+from dl_portfolio.cache import artifact_hash, hash_frame, load_cached, one_cv_key, save_cached
+from dl_portfolio.shared import SharedFrame, as_frame
+from dl_portfolio.volatility_target import multi_horizon_volatility, target_leverage
 from dl_portfolio.constant import PORTFOLIOS
 
 
+BENCHMARKS = ['SP500', 'Russel2000', 'EuroStoxx50']
+STATS_COLUMNS = ['Return', 'Volatility', 'Skewness', 'Excess kurtosis', 'VaR-5%', 'ES-5%', 'SR', 'PSR', 'minTRL', 'MDD',
+                 'CR', 'CEQ']
+
+
+@lru_cache(maxsize=None)
+def _load_benchmark_returns(dataset: str = 'dataset2') -> pd.DataFrame:
+    benchmark, _ = load_data(dataset=dataset)
+    return benchmark.pct_change().dropna()[BENCHMARKS]
+
+
+def get_benchmark_returns(index: pd.Index, volatility_target: float = 0.05) -> pd.DataFrame:
+    """
+    Returns of the benchmarks on index with volatility_target annualized volatility, the data is only loaded once
+
+    :param index: dates
+    :param volatility_target:
+    :return:
+    """
+    benchmark = _load_benchmark_returns().loc[index]
+    return benchmark * volatility_target / (benchmark.std() * np.sqrt(252))
+
+
+def _perf_stats_column(perf: pd.Series, period: int = 250) -> List:
+    cum_perf = np.cumprod(perf + 1)
+    return [perf.mean() * period,
+            annualized_volatility(perf, period=period),
+            scipy_stats.skew(perf, axis=0),
+            scipy_stats.kurtosis(perf, axis=0) - 3,
+            hist_VaR(perf, level=0.05),
+            hist_ES(perf, level=0.05),
+            sharpe_ratio(perf, period=period),
+            probabilistic_sharpe_ratio(perf, sr_benchmark=0),
+            min_track_record_length(perf, sr_benchmark=0),
+            get_mdd(cum_perf),
+            calmar_ratio(cum_perf),
+            ceq(perf, period=period)]
+
+
+def perf_stats(perf: pd.DataFrame, period: int = 250) -> pd.DataFrame:
+    """
+    STATS_COLUMNS of each strategy computed on the full (T, n_strategies) matrix in one pass, with the same
+    definitions as the functions used by _perf_stats_column. Strategies with NaN returns are computed column by column
+    to keep the NaN handling of these functions.
+
+    :param perf: returns of the strategies
+    :param period:
+    :return: pd.DataFrame with strategies as index and STATS_COLUMNS as columns
+    """
+    x = perf.values.astype(np.float64)
+    n = len(x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.mean(x, axis=0)
+        centered = x - mean
+        m2 = np.mean(centered ** 2, axis=0)
+        skew = np.mean(centered ** 3, axis=0) / m2 ** 1.5
+        kurtosis = np.mean(centered ** 4, axis=0) / m2 ** 2
+        var = m2 * n / (n - 1)
+        sr = mean / np.sqrt(var)
+
+        quantile = np.quantile(x, 0.05, axis=0)
+        below = x <= quantile
+        es = - np.sum(np.where(below, x, 0.), axis=0) / np.sum(below, axis=0)
+
+        sr_std = np.sqrt((1 + 0.5 * sr ** 2 - skew * sr + (kurtosis - 3) / 4 * sr ** 2) / (n - 1))
+        psr = scipy_stats.norm.cdf(sr / sr_std)
+        min_trl = 1 + sr_std ** 2 * (n - 1) * (scipy_stats.norm.ppf(0.95) / sr) ** 2
+
+        cum_perf = np.cumprod(x + 1, axis=0)
+        mdd = np.abs(np.min(cum_perf / np.maximum.accumulate(cum_perf, axis=0) - 1., axis=0))
+        calmar = (cum_perf[-1] / cum_perf[0] - 1) / mdd
+
+    stats = pd.DataFrame(np.stack([mean * period,
+                                   np.sqrt(var * period),
+                                   skew,
+                                   kurtosis - 3 - 3,
+                                   - quantile,
+                                   es,
+                                   sr * np.sqrt(period),
+                                   psr,
+                                   min_trl,
+                                   mdd,
+                                   calmar,
+                                   mean * period - var / 2 * period], axis=1),
+                         index=perf.columns,
+                         columns=STATS_COLUMNS)
+    for strat in perf.columns[np.any(np.isnan(x), axis=0)]:
+        stats.loc[strat] = _perf_stats_column(perf[strat], period=period)
+
+    return stats
+
+
 def backtest_stats(perf: pd.DataFrame, weights: Dict, period: int = 250, format: bool = True, sspw_tto=True,
                    **kwargs):
     """
@@ -26,25 +127,20 @@ def backtest_stats(perf: pd.DataFrame, weights: Dict, period: int = 250, format:
     :param format:
     :return:
     """
-    bench_names = ['SP500', 'Russel2000', 'EuroStoxx50']
-    benchmark, _ = load_data(dataset='dataset2')
-    benchmark = benchmark.pct_change().dropna()
-    benchmark = benchmark.loc[perf.index, bench_names]
-    benchmark = benchmark * 0.05 / (benchmark.std() * np.sqrt(252))
+    benchmark = get_benchmark_returns(perf.index)
 
     perf = pd.concat([perf, benchmark], 1)
 
     strats = list(perf.keys())
     if sspw_tto:
-        cols = ['Return', 'Volatility', 'Skewness', 'Excess kurtosis', 'VaR-5%', 'ES-5%', 'SR', 'PSR', 'minTRL', 'MDD',
-                'CR', 'CEQ', 'SSPW', 'TTO']
+        cols = STATS_COLUMNS + ['SSPW', 'TTO']
     else:
-        cols = ['Return', 'Volatility', 'Skewness', 'Excess kurtosis', 'VaR-5%', 'ES-5%', 'SR', 'PSR', 'minTRL', 'MDD',
-                'CR', 'CEQ']
+        cols = STATS_COLUMNS
 
     stats = pd.DataFrame(index=strats,
                          columns=cols,
                          dtype=np.float32)
+    stats.loc[:, STATS_COLUMNS] = perf_stats(perf, period=period).values.astype(np.float32)
     ports = list(weights.keys())
     assets = weights[ports[0]].columns
     n_assets = weights[ports[0]].shape[-1]
@@ -60,35 +156,10 @@ def backtest_stats(perf: pd.DataFrame, weights: Dict, period: int = 250, format:
             weights['equal_class'] = pd.DataFrame(equal_class_weights(market_budget)).T
 
         if sspw_tto:
-            stats.loc[strat] = [perf[strat].mean() * period,
-                                annualized_volatility(perf[strat], period=period),
-                                scipy_stats.skew(perf[strat], axis=0),
-                                scipy_stats.kurtosis(perf[strat], axis=0) - 3,
-                                hist_VaR(perf[strat], level=0.05),
-                                hist_ES(perf[strat], level=0.05),
-                                sharpe_ratio(perf[strat], period=period),
-                                probabilistic_sharpe_ratio(perf[strat], sr_benchmark=0),
-                                min_track_record_length(perf[strat], sr_benchmark=0),
-                                get_mdd(np.cumprod(perf[strat] + 1)),
-                                calmar_ratio(np.cumprod(perf[strat] + 1)),
-                                ceq(perf[strat], period=period),
-                                sspw(weights[strat]) if strat not in bench_names else np.nan,
-                                total_average_turnover(weights[strat]) if strat not in bench_names + ['equal'] else 0.
-                                ]
-        else:
-            stats.loc[strat] = [perf[strat].mean() * period,
-                                annualized_volatility(perf[strat], period=period),
-                                scipy_stats.skew(perf[strat], axis=0),
-                                scipy_stats.kurtosis(perf[strat], axis=0) - 3,
-                                hist_VaR(perf[strat], level=0.05),
-                                hist_ES(perf[strat], level=0.05),
-                                sharpe_ratio(perf[strat], period=period),
-                                probabilistic_sharpe_ratio(perf[strat], sr_benchmark=0),
-                                min_track_record_length(perf[strat], sr_benchmark=0),
-                                get_mdd(np.cumprod(perf[strat] + 1)),
-                                calmar_ratio(np.cumprod(perf[strat] + 1)),
-                                ceq(perf[strat], period=period)
-                                ]
+            stats.loc[strat, ['SSPW', 'TTO']] = [
+                sspw(weights[strat]) if strat not in BENCHMARKS else np.nan,
+                total_average_turnover(weights[strat]) if strat not in BENCHMARKS + ['equal'] else 0.
+            ]
 
     if format:
         print("Formatting table")
@@ -205,18 +276,60 @@ def get_dl_average_weights(cv_results):
         date = cv_results[0][cv]['returns'].index[0]
         for port in portfolios:
             if 'ae' in port:
-                weights = pd.DataFrame()
-                for i in cv_results:
-                    w = pd.DataFrame(cv_results[i][cv]['port'][port]).T
-                    weights = pd.concat([weights, w])
-                weights = weights.mean()
-                weights = pd.DataFrame(weights).T
+                # Average over the runs for which the weights could be computed
+                weights = [cv_results[i][cv]['port'][port] for i in cv_results if
+                           cv_results[i][cv]['port'][port] is not None]
+                if weights:
+                    weights = pd.DataFrame(weights).mean()
+                    weights = pd.DataFrame(weights).T
+                else:
+                    weights = pd.DataFrame(np.nan, columns=cv_results[0][cv]['returns'].columns, index=[0])
                 weights.index = [date]
                 port_weights[cv][port] = weights
 
     return port_weights
 
 
+def get_dl_ensemble_weights(cv_results, portfolios: List[str], market_budget: pd.DataFrame, method: str = 'mean',
+                            **kwargs):
+    """
+    Alternative to get_dl_average_weights: the embeddings and loadings of all runs are first combined in a single
+    embedding per fold with dl_portfolio.cluster.ensemble_embedding, then the AE portfolios are computed once per fold,
+    whatever the number of runs.
+
+    :param cv_results: {run_i: {cv: res}}, the AE weights of the runs are not needed (compute_weights=False)
+    :param portfolios: AE portfolios
+    :param market_budget:
+    :param method: 'mean' or 'consensus', see ensemble_embedding
+    :param kwargs: passed to portfolio_weights
+    :return: same structure as get_dl_average_weights
+    """
+    port_weights = {cv: {} for cv in cv_results[0]}
+    for cv in cv_results[0]:
+        date = cv_results[0][cv]['returns'].index[0]
+        train_returns = cv_results[0][cv]['train_returns']
+        assets = train_returns.columns
+        embedding, loading = ensemble_embedding({i: cv_results[i][cv]['embedding'] for i in cv_results},
+                                                {i: cv_results[i][cv]['loading'] for i in cv_results},
+                                                method=method)
+        weights = portfolio_weights(train_returns,
+                                    budget=market_budget.loc[assets],
+                                    embedding=embedding,
+                                    loading=loading,
+                                    portfolio=portfolios,
+                                    context=cv_results[0][cv].get('context'),
+                                    **kwargs)
+        for port in portfolios:
+            if weights[port] is not None:
+                w = pd.DataFrame(weights[port]).T
+            else:
+                w = pd.DataFrame(np.nan, columns=assets, index=[0])
+            w.index = [date]
+            port_weights[cv][port] = w
+
+    return port_weights
+
+
 def plot_perf(perf, strategies=['aerp'], save_path=None, show=False, legend=True, figsize=(20, 10)):
     plt.figure(figsize=figsize)
     for s in strategies:
@@ -374,9 +487,17 @@ def compute_balance(price, weights, prev_weights, prev_K, fee=2e-4, leverage=1):
     return K, N, cost
 
 
+def is_missing_weights(weights) -> bool:
+    """
+    True if the weights of a portfolio could not be computed: None or only NaN
+    """
+    return weights is None or bool(np.all(np.isnan(np.asarray(weights, dtype=np.float64))))
+
+
 def get_portfolio_perf_wrapper(train_returns: pd.DataFrame, returns: pd.DataFrame, weights: Dict, portfolios: List,
                                train_weights: Optional[Dict] = None, prev_weights: Optional[Dict] = None,
-                               fee: float = 2e-4, volatility_target: Optional[float] = 0.05, **kwargs):
+                               fee: float = 2e-4, volatility_target: Optional[float] = 0.05,
+                               max_leverage: Optional[float] = None, **kwargs):
     """
 
     Logic:
@@ -385,17 +506,24 @@ def get_portfolio_perf_wrapper(train_returns: pd.DataFrame, returns: pd.DataFram
     then use same weights as on test set
     - prev weights is previous cv weights or vector of 1s for the first cv
     - weights is current weights for the test period
+    - If the weights of a portfolio are missing (see is_missing_weights), its performance and leverage are NaN
+    - The leverages of all portfolios are computed at once from the matrix of their train returns, see
+    dl_portfolio.volatility_target
 
     :param portfolio: one of  ['equal', 'markowitz', 'shrink_markowitz', 'ivp', 'aerp', 'hrp', 'rp', 'aeerc']
     :param train_returns:
     :param returns:
     :param weights: Dict with portfolio keys and corresponding weight
     :param prev_weights: Dict with portfolio keys and corresponding weight for the previous period (to compute fees)
+    :param max_leverage: if given, maximum leverage
     :return:
     """
     N = returns.shape[-1]
     port_perfs = {}
     leverages = {}
+    if volatility_target:
+        fold_leverages = _fold_leverages(train_returns, weights, portfolios, train_weights=train_weights,
+                                         volatility_target=volatility_target, max_leverage=max_leverage, **kwargs)
     for portfolio in portfolios:
         if portfolio == 'equal':
             port_perf = portfolio_return(returns, weights=1 / N)
@@ -406,45 +534,38 @@ def get_portfolio_perf_wrapper(train_returns: pd.DataFrame, returns: pd.DataFram
             w = equal_class_weights(market_budget)
             port_perf = portfolio_return(returns, weights=w)
         else:
-            if weights[portfolio] is not None:
+            if not is_missing_weights(weights[portfolio]):
                 port_perf = portfolio_return(returns, weights=weights[portfolio])
             else:
                 LOGGER.info(f'Warning: No weight for {portfolio} portfolio... Setting to NaN')
-                port_perf = returns * np.nan
+                port_perf = portfolio_return(returns, weights=None)
+                port_perfs[portfolio] = port_perf
+                leverages[portfolio] = np.nan
+                continue
         # Volatility target weights
+        leverage = 1
         if volatility_target:
-            if portfolio == 'equal':
-                train_port_perf = portfolio_return(train_returns, weights=1 / N)
-                cost = 0
-            elif portfolio == 'equal_class':
-                market_budget = kwargs.get('market_budget')
-                assert market_budget is not None
-                market_budget = market_budget.loc[returns.columns, :]
-                w = equal_class_weights(market_budget)
-                train_port_perf = portfolio_return(train_returns, weights=w)
+            if portfolio in ['equal', 'equal_class']:
                 cost = 0
             else:
-                assert train_weights is not None
-                train_port_perf = portfolio_return(train_returns, weights=train_weights[portfolio])
+                prev_w = prev_weights[portfolio]
+                if is_missing_weights(prev_w):
+                    # Previous weights could not be computed, same as the first cv
+                    prev_w = weights[portfolio] * 0 + 1
 
                 if weights[portfolio].shape[0] > 1:
                     assert isinstance(weights[portfolio], pd.DataFrame)
-                    assert isinstance(prev_weights[portfolio], pd.DataFrame)
-                    cost = pd.concat([prev_weights[portfolio].iloc[-1:, :], weights[portfolio]])
+                    assert isinstance(prev_w, pd.DataFrame)
+                    cost = pd.concat([prev_w.iloc[-1:, :], weights[portfolio]])
                     cost = fee * np.abs(cost.diff().dropna()).sum(1)
                     cost = pd.Series(cost, index=returns.index)
                     assert cost.isna().sum() == 0
                 else:
-                    mu = np.abs(prev_weights[portfolio] - weights[portfolio])
+                    mu = np.abs(prev_w - weights[portfolio])
                     cost = fee * np.sum(mu)
                     assert not np.isnan(cost)
 
-            # Check Jaeger et al 2021
-            base_vol = np.max((np.std(train_port_perf[-20:]), np.std(train_port_perf[-60:]))) * np.sqrt(252)
-            assert not np.isinf(base_vol)
-            assert not np.isnan(base_vol)
-
-            leverage = 0.05 / base_vol
+            leverage = fold_leverages[portfolio]
             cost = cost * leverage
             port_perf = leverage * port_perf
             if portfolio not in ["equal", "equal_class"]:
@@ -461,6 +582,42 @@ def get_portfolio_perf_wrapper(train_returns: pd.DataFrame, returns: pd.DataFram
     return port_perfs, leverages
 
 
+def _fold_leverages(train_returns: pd.DataFrame, weights: Dict, portfolios: List, train_weights: Optional[Dict] = None,
+                    volatility_target: float = 0.05, max_leverage: Optional[float] = None, **kwargs) -> Dict:
+    """
+    Leverage of the portfolios of get_portfolio_perf_wrapper whose weights are not missing: the train returns of all
+    portfolios are computed with one matrix product and their leverage by
+    dl_portfolio.volatility_target.multi_horizon_volatility (Jaeger et al 2021)
+
+    :return: Dictionary with portfolio keys and leverage
+    """
+    N = train_returns.shape[-1]
+    train_w = {}
+    for portfolio in portfolios:
+        if portfolio == 'equal':
+            train_w[portfolio] = np.full(N, 1 / N)
+        elif portfolio == 'equal_class':
+            market_budget = kwargs.get('market_budget')
+            assert market_budget is not None
+            train_w[portfolio] = equal_class_weights(market_budget.loc[train_returns.columns, :]).values
+        elif not is_missing_weights(weights[portfolio]):
+            assert train_weights is not None
+            w = train_weights[portfolio]
+            if isinstance(w, pd.Series):
+                w = w.loc[train_returns.columns]
+            train_w[portfolio] = np.asarray(w, dtype=np.float64)
+    if not train_w:
+        return {}
+
+    train_port_perf = np.stack(list(train_w.values())) @ train_returns.values.T
+    base_vol = multi_horizon_volatility(train_port_perf)
+    assert not np.any(np.isinf(base_vol))
+    assert not np.any(np.isnan(base_vol))
+    leverage = target_leverage(base_vol, volatility_target, max_leverage=max_leverage)
+
+    return dict(zip(train_w.keys(), leverage))
+
+
 def cv_portfolio_perf(cv_results: Dict,
                       portfolios: List = ['equal', 'markowitz', 'shrink_markowitz', 'ivp', 'aerp', 'hrp', 'rp',
                                           'aeerc'],
@@ -545,7 +702,7 @@ def cv_portfolio_perf_df(cv_portfolio: Dict, portfolios: List[str] = ['ae_rp_c',
         if train_weights is not None:
             train_w = train_weights[cv]
         else:
-            train_w = {p: weights[p].iloc[0, :] for p in weights}
+            train_w = {p: weights[p].iloc[0, :] if weights[p] is not None else None for p in weights}
 
         one_cv_perf, one_cv_leverage = get_portfolio_perf_wrapper(cv_portfolio[cv]['train_returns'],
                                                                   cv_portfolio[cv]['returns'],
@@ -572,9 +729,20 @@ def portfolio_return(returns, weights: Optional[Union[float, np.ndarray]] = None
 
 
 def one_cv(data, assets, base_dir, cv, test_set, portfolios, market_budget=None, compute_weights=True,
-           window: Optional[int] = 250, **kwargs):
+           window: Optional[int] = 250, context: Optional[PortfolioContext] = None,
+           data_returns: Optional[Union[pd.DataFrame, SharedFrame]] = None, cov_method: str = 'sample',
+           n_threads: Optional[int] = None, **kwargs):
+    """
+
+    :param data: prices, pd.DataFrame or SharedFrame
+    :param data_returns: data.pct_change(1).dropna() precomputed once for all folds, pd.DataFrame or SharedFrame
+    :param cov_method: covariance estimator of the portfolios, see dl_portfolio.covariance.get_covariance
+    :param n_threads: if given, the portfolios of the fold are computed concurrently by a ThreadPoolExecutor with
+    n_threads threads, see portfolio_weights
+    """
     ae_config = kwargs.get('ae_config')
     res = {}
+    data = as_frame(data)
 
     model, scaler, dates, test_data, test_features, pred, embedding, decoding, _ = load_result(ae_config, test_set,
                                                                                                data,
@@ -582,8 +750,10 @@ def one_cv(data, assets, base_dir, cv, test_set, portfolios, market_budget=None,
                                                                                                base_dir, cv)
 
     std = np.sqrt(scaler['attributes']['var_'])
-    data = data.pct_change(1).dropna()
-    data = data[assets]
+    timings = {}
+    if data_returns is None:
+        data_returns = data.pct_change(1).dropna()
+    data = as_frame(data_returns)[assets]
     assert np.sum(data.isna().sum()) == 0
     train_returns = data.loc[dates['train']]
     returns = data.loc[dates[test_set]]
@@ -604,18 +774,34 @@ def one_cv(data, assets, base_dir, cv, test_set, portfolios, market_budget=None,
     res['w'] = decoding
     res['train_returns'] = train_returns
     res['returns'] = returns
+    res['context'] = get_context(train_returns, context, cov_method=cov_method)
+    res['factor_cov'] = None
+    if compute_weights and 'shrink_markowitz' in portfolios:
+        # Factor model covariance estimated on the train window only: Su is computed on the test returns
+        res['factor_cov'] = factor_covariance(train_returns, decoding.multiply(std, axis=0))
+    markowitz_info = {}
     if compute_weights:
         assert market_budget is not None
-        res['port'] = portfolio_weights(train_returns,
-                                        # shrink_cov=res['H'],
-                                        budget=market_budget.loc[assets],
-                                        embedding=embedding,
-                                        loading=decoding,
-                                        portfolio=portfolios,
-                                        **kwargs
-                                        )
+        with ThreadPoolExecutor(n_threads) if n_threads else nullcontext() as executor:
+            res['port'] = portfolio_weights(train_returns,
+                                            shrink_cov=res['factor_cov'],
+                                            budget=market_budget.loc[assets],
+                                            embedding=embedding,
+                                            loading=decoding,
+                                            portfolio=portfolios,
+                                            context=res['context'],
+                                            executor=executor,
+                                            timings=timings,
+                                            fold=cv,
+                                            solver_info=markowitz_info,
+                                            cov_method=cov_method,
+                                            **kwargs
+                                            )
     else:
         res['port'] = None
+    res['timing'] = timings
+    # Solve time, status and solver of the Markowitz portfolios, see dl_portfolio.markowitz.get_markowitz_history
+    res['markowitz'] = markowitz_info
 
     # clusters, _ = get_cluster_labels(embedding)
     res['mean_mse'] = np.mean((residuals ** 2).mean(1))
@@ -624,21 +810,122 @@ def one_cv(data, assets, base_dir, cv, test_set, portfolios, market_budget=None,
     return cv, res
 
 
+def cached_one_cv(cache_dir: str, data, assets, base_dir, cv, test_set, portfolios, market_budget=None,
+                  compute_weights=True, window: Optional[int] = 250, context: Optional[PortfolioContext] = None,
+                  data_hash: Optional[str] = None, data_returns: Optional[Union[pd.DataFrame, SharedFrame]] = None,
+                  n_threads: Optional[int] = None, **kwargs):
+    """
+    one_cv with an on-disk cache: the result is stored in cache_dir under a content address built from the artifacts
+    of the fold, the data and the parameters (see dl_portfolio.cache), it is only computed if it is not already there.
+
+    :param cache_dir:
+    :param data_hash: hash of data, computed if None
+    :param data_returns: see one_cv, it is computed from data and is not part of the key
+    :param n_threads: see one_cv, it does not change the result and is not part of the key
+    :param kwargs: other parameters of one_cv, they must be accepted by dl_portfolio.cache.key_value
+    :return: cv, res
+    """
+    if data_hash is None:
+        data_hash = hash_frame(as_frame(data))
+    key = one_cv_key(artifact_hash(base_dir, cv), cv, test_set, window, portfolios if compute_weights else None,
+                     market_budget if compute_weights else None, data_hash=data_hash,
+                     compute_weights=compute_weights, **kwargs)
+    res = load_cached(cache_dir, key)
+    if res is not None:
+        LOGGER.debug(f"Loaded fold {cv} of {base_dir} from cache {key}")
+        return cv, res
+
+    _, res = one_cv(data, assets, base_dir, cv, test_set, portfolios, market_budget=market_budget,
+                    compute_weights=compute_weights, window=window, context=context, data_returns=data_returns,
+                    n_threads=n_threads, **kwargs)
+    save_cached(cache_dir, key, res, base_dir=base_dir, cv=cv, test_set=test_set, window=window,
+                portfolios=portfolios)
+    return cv, res
+
+
+def _split_batch_portfolios(portfolios: Optional[List[str]], compute_weights: bool):
+    """
+    Portfolios computed by one_cv and portfolios solved for all folds at once by add_fold_batch_weights
+    """
+    if not compute_weights or portfolios is None:
+        return portfolios, []
+    return [p for p in portfolios if p not in BATCH_PORTFOLIOS], [p for p in portfolios if p in BATCH_PORTFOLIOS]
+
+
+def add_fold_batch_weights(cv_results: Dict, portfolios: List[str], batch_portfolios: List[str],
+                           market_budget: pd.DataFrame):
+    """
+    Solve batch_portfolios for all the folds of cv_results in one batched call (see
+    dl_portfolio.weights.fold_batch_weights) and add their weights to res['port'] in the order of portfolios
+
+    :param cv_results: {cv: res} of one run
+    :param portfolios: all the portfolios of the run
+    :param batch_portfolios: portfolios of BATCH_PORTFOLIOS which were not computed by one_cv
+    :param market_budget:
+    :return:
+    """
+    if not batch_portfolios:
+        return
+    assets = cv_results[0]['train_returns'].columns
+    timings = {}
+    batch_weights = fold_batch_weights([cv_results[cv]['context'] for cv in cv_results], batch_portfolios,
+                                       budget=market_budget.loc[assets], timings=timings)
+    for cv, port_w in zip(cv_results, batch_weights):
+        port_w.update(cv_results[cv]['port'])
+        cv_results[cv]['port'] = {p: port_w[p] for p in portfolios if p in port_w}
+        # Time of the batched solve shared by all folds
+        cv_results[cv]['timing'].update({p: timings[p] / len(cv_results) for p in batch_portfolios})
+
+
 def get_cv_results(base_dir, test_set, n_folds, portfolios=None, market_budget=None, compute_weights=True,
-                   window: Optional[int] = None, n_jobs: int = None, dataset='global', **kwargs):
+                   window: Optional[int] = None, n_jobs: int = None, dataset='global',
+                   contexts: Optional[Dict] = None, cache_dir: Optional[str] = None, **kwargs):
+    """
+
+    :param base_dir:
+    :param test_set:
+    :param n_folds:
+    :param portfolios:
+    :param market_budget:
+    :param compute_weights:
+    :param window:
+    :param n_jobs:
+    :param dataset:
+    :param contexts: {cv: PortfolioContext} from a previous call on the same folds (another seed), the train returns
+    statistics and the weights of the non-AE portfolios are then reused. Use dl_portfolio.context.get_contexts to
+    extract them from the results.
+    :param cache_dir: if given, the results of one_cv are cached on disk in this directory, see cached_one_cv
+    :param kwargs:
+    :return:
+    """
     assert test_set in ['val', 'test']
+    if contexts is None:
+        contexts = {}
+    # The BATCH_PORTFOLIOS of all folds are solved at once after one_cv
+    all_portfolios = portfolios
+    portfolios, batch_portfolios = _split_batch_portfolios(portfolios, compute_weights)
 
     ae_config = kwargs.get('ae_config')
 
     data, assets = load_data(dataset=dataset)
+    if cache_dir is not None:
+        _one_cv = partial(cached_one_cv, cache_dir, data_hash=hash_frame(data))
+    else:
+        _one_cv = one_cv
+
+    # Returns are computed once for all folds
+    data_returns = data.pct_change(1).dropna()
 
     if n_jobs:
-        with Parallel(n_jobs=n_jobs) as _parallel_pool:
-            cv_results = _parallel_pool(
-                delayed(one_cv)(data, assets, base_dir, cv, test_set, portfolios, market_budget=market_budget,
-                                compute_weights=compute_weights, window=window, **kwargs)
-                for cv in range(n_folds)
-            )
+        # Workers attach to the prices and returns in shared memory instead of receiving a copy with each task
+        with SharedFrame(data) as shared_data, SharedFrame(data_returns) as shared_returns:
+            with Parallel(n_jobs=n_jobs) as _parallel_pool:
+                cv_results = _parallel_pool(
+                    delayed(_one_cv)(shared_data, assets, base_dir, cv, test_set, portfolios,
+                                     market_budget=market_budget, compute_weights=compute_weights, window=window,
+                                     context=contexts.get(cv), data_returns=shared_returns, **kwargs)
+                    for cv in range(n_folds)
+                )
         # Build dictionary
         cv_results = {cv_results[i][0]: cv_results[i][1] for i in range(len(cv_results))}
         # Reorder dictionary
@@ -646,12 +933,104 @@ def get_cv_results(base_dir, test_set, n_folds, portfolios=None, market_budget=N
     else:
         cv_results = {}
         for cv in range(n_folds):
-            _, cv_results[cv] = one_cv(data, assets, base_dir, cv, test_set, portfolios, market_budget=market_budget,
-                                       compute_weights=compute_weights, window=window, **kwargs)
+            _, cv_results[cv] = _one_cv(data, assets, base_dir, cv, test_set, portfolios, market_budget=market_budget,
+                                        compute_weights=compute_weights, window=window, context=contexts.get(cv),
+                                        data_returns=data_returns, **kwargs)
+    add_fold_batch_weights(cv_results, all_portfolios, batch_portfolios, market_budget)
 
     return cv_results
 
 
+# PortfolioContext of the folds computed by the current process, by (returns block, fold, window), so that a worker
+# reuses the train returns statistics of a fold for all the runs it processes
+_FOLD_CONTEXTS: Dict = {}
+
+
+def _one_cv_task(one_cv_func, run, data, assets, base_dir, cv, test_set, portfolios, window: Optional[int] = None,
+                 data_returns: Optional[SharedFrame] = None, **kwargs):
+    """
+    Task of get_runs_cv_results executed in a worker
+
+    :param one_cv_func: one_cv or cached_one_cv
+    :param run: index of the run, returned with the result
+    :return: run, cv, res
+    """
+    name = getattr(data_returns, 'name', None)
+    for key in [key for key in _FOLD_CONTEXTS if key[0] != name]:
+        # Contexts of a previous analysis
+        del _FOLD_CONTEXTS[key]
+    key = (name, cv, window, kwargs.get('cov_method', 'sample'))
+    _, res = one_cv_func(data, assets, base_dir, cv, test_set, portfolios, window=window,
+                         context=_FOLD_CONTEXTS.get(key), data_returns=data_returns, **kwargs)
+    if res.get('context') is not None:
+        _FOLD_CONTEXTS[key] = res['context']
+    return run, cv, res
+
+
+def get_runs_cv_results(base_dirs: List[str], test_set, n_folds, portfolios: List[List[str]], market_budget=None,
+                        window: Optional[int] = None, n_jobs: int = None, dataset='global',
+                        cache_dir: Optional[str] = None, **kwargs) -> Dict:
+    """
+    get_cv_results of several runs (seeds) on the same folds. With n_jobs, the (run, fold) tasks of all the runs are
+    dispatched at once to a single pool of workers, one task at a time: the workers are started, import the
+    libraries and attach to the data once for the whole analysis, and a free worker takes the next task whatever its
+    run. A worker reuses the train returns statistics of a fold across runs, see _FOLD_CONTEXTS.
+
+    :param base_dirs: run directories
+    :param test_set:
+    :param n_folds:
+    :param portfolios: portfolios of each run, the weights of a run are not computed if its list is empty
+    :param market_budget:
+    :param window:
+    :param n_jobs:
+    :param dataset:
+    :param cache_dir: see get_cv_results
+    :param kwargs: passed to one_cv
+    :return: {run: {cv: res}}
+    """
+    assert test_set in ['val', 'test']
+    assert len(portfolios) == len(base_dirs)
+
+    if not n_jobs:
+        runs_cv_results = {}
+        contexts = None
+        for run, base_dir in enumerate(base_dirs):
+            runs_cv_results[run] = get_cv_results(base_dir, test_set, n_folds, portfolios=portfolios[run],
+                                                  market_budget=market_budget,
+                                                  compute_weights=len(portfolios[run]) > 0, window=window,
+                                                  dataset=dataset, contexts=contexts, cache_dir=cache_dir, **kwargs)
+            # Train returns statistics are the same for all runs
+            contexts = get_contexts(runs_cv_results[run])
+        return runs_cv_results
+
+    data, assets = load_data(dataset=dataset)
+    if cache_dir is not None:
+        _one_cv = partial(cached_one_cv, cache_dir, data_hash=hash_frame(data))
+    else:
+        _one_cv = one_cv
+    data_returns = data.pct_change(1).dropna()
+
+    # The BATCH_PORTFOLIOS of all folds of a run are solved at once after one_cv
+    split = [_split_batch_portfolios(p, len(p) > 0) for p in portfolios]
+
+    runs_cv_results = {run: {} for run in range(len(base_dirs))}
+    with SharedFrame(data) as shared_data, SharedFrame(data_returns) as shared_returns:
+        results = Parallel(n_jobs=n_jobs, batch_size=1)(
+            delayed(_one_cv_task)(_one_cv, run, shared_data, assets, base_dir, cv, test_set, split[run][0],
+                                  market_budget=market_budget, compute_weights=len(portfolios[run]) > 0,
+                                  window=window, data_returns=shared_returns, **kwargs)
+            for run, base_dir in enumerate(base_dirs) for cv in range(n_folds)
+        )
+    for run, cv, res in results:
+        runs_cv_results[run][cv] = res
+    # Reorder dictionary
+    runs_cv_results = {run: {cv: runs_cv_results[run][cv] for cv in range(n_folds)} for run in runs_cv_results}
+    for run in runs_cv_results:
+        add_fold_batch_weights(runs_cv_results[run], portfolios[run], split[run][1], market_budget)
+
+    return runs_cv_results
+
+
 def get_mdd(performance: [pd.Series, np.ndarray]):
     assert len(performance.shape) == 1
     dd = performance / performance.cummax() - 1.0
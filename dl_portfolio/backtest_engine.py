@@ -0,0 +1,413 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, Optional, Union
+
+from dl_portfolio.weights import equal_class_weights
+from dl_portfolio.constant import PORTFOLIOS
+from dl_portfolio.volatility_target import VOL_LOOKBACKS, daily_fold_leverage, multi_horizon_volatility, \
+    target_leverage
+
+
+def _stack_train_returns(train_returns: List[np.ndarray], lookback: int) -> np.ndarray:
+    """
+    Last lookback train returns of each fold, padded with NaN if the train window is shorter
+
+    :param train_returns: list of (n_obs, n_assets) arrays
+    :param lookback:
+    :return: (n_folds, lookback, n_assets)
+    """
+    n_assets = np.shape(train_returns[0])[-1]
+    stacked = np.full((len(train_returns), lookback, n_assets), np.nan)
+    for f, r in enumerate(train_returns):
+        r = np.asarray(r, dtype=np.float64)[-lookback:]
+        stacked[f, lookback - len(r):] = r
+    return stacked
+
+
+def fold_leverage(weights: np.ndarray, folds: np.ndarray, train_returns: List[np.ndarray],
+                  volatility_target: float = 0.05, max_leverage: Optional[float] = None) -> np.ndarray:
+    """
+    Leverage of each portfolio and fold: volatility_target / max(vol 20 days, vol 60 days), the volatility is computed
+    on the train returns of the fold with the weights of the first test date of the fold
+
+    :param weights: (P, T, N) without NaN
+    :param folds: position of the first date of each fold, (F)
+    :param train_returns: train returns of each fold, list of F (n_obs, N) arrays
+    :param volatility_target:
+    :param max_leverage: if given, maximum leverage
+    :return: (P, F), inf for null weights without max_leverage
+    """
+    train = _stack_train_returns(train_returns, max(VOL_LOOKBACKS))
+    train_port_returns = np.einsum('pfn,fln->pfl', weights[:, folds, :], train)
+    return target_leverage(multi_horizon_volatility(train_port_returns), volatility_target, max_leverage=max_leverage)
+
+
+def backtest_arrays(returns: np.ndarray, weights: np.ndarray, folds: np.ndarray, train_returns: List[np.ndarray],
+                    fee: Union[float, np.ndarray] = 2e-4, volatility_target: Optional[float] = 0.05,
+                    leverage_method: str = 'fold', max_leverage: Optional[float] = None):
+    """
+    Volatility targeted and cost adjusted returns of P portfolios on all folds in one vectorized pass, same logic as
+    get_portfolio_perf_wrapper:
+    - the leverage of a fold is volatility_target / max(vol 20 days, vol 60 days), the volatility is computed on the
+    train returns of the fold with the weights of the first test date. With the daily leverage methods of
+    dl_portfolio.volatility_target ('ewma', 'multi_horizon'), the leverage of each date is computed with the volatility
+    of the train returns followed by the unlevered test returns of the fold up to the previous date
+    - the cost of a date is fee * sum(|w_t - w_t-1|) * leverage, at the start of a fold w_t-1 is the last weights of
+    the previous fold, or 1 for the first fold and after a fold whose weights are missing
+    - if the weights of a portfolio are missing (NaN) on a whole fold, its returns and leverage are NaN on this fold
+
+    :param returns: test returns of all folds, (T, N)
+    :param weights: weights of each portfolio on every test date, (P, T, N)
+    :param folds: position of the first date of each fold in returns, (F)
+    :param train_returns: train returns of each fold, list of F (n_obs, N) arrays, only the last 60 are used
+    :param fee: transaction fee, scalar or (P), use 0 for portfolios without costs such as equal weights
+    :param volatility_target: if None, there is no leverage and no cost
+    :param leverage_method: one of dl_portfolio.volatility_target.LEVERAGE_METHODS
+    :param max_leverage: if given, maximum leverage
+    :return: portfolio returns (P, T), leverage (P, F) or (P, T) with a daily leverage method
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    folds = np.asarray(folds)
+    n_ports, n_dates, n_assets = weights.shape
+    n_folds = len(folds)
+    assert returns.shape == (n_dates, n_assets)
+    assert folds[0] == 0 and np.all(np.diff(folds) > 0)
+    assert len(train_returns) == n_folds
+    fold_id = np.repeat(np.arange(n_folds), np.diff(np.append(folds, n_dates)))
+    fee = np.broadcast_to(np.asarray(fee, dtype=np.float64), (n_ports,))
+
+    missing = np.logical_and.reduceat(np.all(np.isnan(weights), axis=-1), folds, axis=1)
+    weights = np.nan_to_num(weights)
+    port_returns = np.einsum('ptn,tn->pt', weights, returns)
+
+    if volatility_target:
+        if leverage_method == 'fold':
+            leverage = fold_leverage(weights, folds, train_returns, volatility_target, max_leverage=max_leverage)
+            date_leverage = leverage[:, fold_id]
+        else:
+            train_port_returns = [weights[:, start] @ np.asarray(r, dtype=np.float64).T
+                                  for start, r in zip(folds, train_returns)]
+            leverage = date_leverage = daily_fold_leverage(port_returns, folds, train_port_returns, volatility_target,
+                                                           method=leverage_method, max_leverage=max_leverage)
+        prev_weights = np.empty_like(weights)
+        prev_weights[:, 0] = 1.
+        prev_weights[:, 1:] = weights[:, :-1]
+        prev_weights[:, folds[1:]] = np.where(missing[:, :-1, None], 1., prev_weights[:, folds[1:]])
+        cost = fee[:, None] * np.sum(np.abs(weights - prev_weights), axis=-1)
+        with np.errstate(invalid='ignore'):
+            port_returns = date_leverage * (port_returns - cost)
+    else:
+        leverage = np.ones((n_ports, n_folds))
+
+    port_returns[missing[:, fold_id]] = np.nan
+    leverage[missing if leverage.shape[1] == n_folds else missing[:, fold_id]] = np.nan
+
+    return port_returns, leverage
+
+
+def cv_portfolio_perf_array(cv_portfolio: Dict, portfolios: List[str] = ['ae_rp_c', 'aeaa', 'aeerc'],
+                            fee: float = 2e-4, volatility_target: Optional[float] = 0.05,
+                            market_budget: Optional[pd.DataFrame] = None, leverage_method: str = 'fold',
+                            max_leverage: Optional[float] = None):
+    """
+    Same inputs and outputs as cv_portfolio_perf_df, computed with backtest_arrays
+
+    :param cv_portfolio: {cv: {'returns', 'train_returns', 'port': {portfolio: weights}}}, the weights are a
+    pd.DataFrame with one row per test date or a single row, or a pd.Series, None if missing
+    :param portfolios:
+    :param fee:
+    :param volatility_target:
+    :param market_budget: required for 'equal_class'
+    :param leverage_method: see backtest_arrays
+    :param max_leverage: see backtest_arrays
+    :return: port_perf {portfolio: {'total': pd.DataFrame}}, leverage pd.DataFrame with one row per fold, or per test
+    date with a daily leverage method
+    """
+    returns, weights, folds, train_returns, fees = cv_portfolio_arrays(cv_portfolio, portfolios, fee=fee,
+                                                                      market_budget=market_budget)
+    port_returns, leverage = backtest_arrays(returns.values, weights, folds, train_returns, fee=fees,
+                                             volatility_target=volatility_target, leverage_method=leverage_method,
+                                             max_leverage=max_leverage)
+    port_perf = {p: {'total': pd.DataFrame(port_returns[i], index=returns.index)} for i, p in enumerate(portfolios)}
+    if leverage_method == 'fold':
+        leverage = pd.DataFrame(leverage.T, columns=portfolios)
+    else:
+        leverage = pd.DataFrame(leverage.T, index=returns.index, columns=portfolios)
+
+    return port_perf, leverage
+
+
+def cv_portfolio_arrays(cv_portfolio: Dict, portfolios: List[str], fee: Union[float, np.ndarray] = 2e-4,
+                        market_budget: Optional[pd.DataFrame] = None):
+    """
+    Convert the cv_portfolio dictionary of cv_portfolio_perf_df to the arrays of backtest_arrays
+
+    :param cv_portfolio:
+    :param portfolios:
+    :param fee: fee of the portfolios with costs, scalar or array
+    :param market_budget: required for 'equal_class'
+    :return: returns pd.DataFrame (T, N), weights (P, T, N), folds (F), train_returns list of F arrays, fees (P, ...)
+    where the fees of the equal weights portfolios are 0
+    """
+    assert all([p in PORTFOLIOS for p in portfolios])
+    assets = cv_portfolio[0]['returns'].columns
+    n_assets = len(assets)
+    cv_returns = [cv_portfolio[cv]['returns'][assets] for cv in cv_portfolio]
+    returns = pd.concat(cv_returns)
+    folds = np.cumsum([0] + [len(r) for r in cv_returns[:-1]])
+
+    weights = np.full((len(portfolios), len(returns), n_assets), np.nan)
+    fee = np.asarray(fee, dtype=np.float64)
+    fees = np.repeat(fee[None], len(portfolios), axis=0)
+    for i, p in enumerate(portfolios):
+        if p == 'equal':
+            weights[i] = 1 / n_assets
+            fees[i] = 0.
+        elif p == 'equal_class':
+            assert market_budget is not None
+            weights[i] = equal_class_weights(market_budget.loc[assets, :]).values
+            fees[i] = 0.
+        else:
+            for cv, start, r in zip(cv_portfolio, folds, cv_returns):
+                w = cv_portfolio[cv]['port'][p]
+                if w is not None:
+                    w = w.loc[assets] if isinstance(w, pd.Series) else w[assets]
+                    weights[i, start:start + len(r)] = np.asarray(w, dtype=np.float64)
+    train_returns = [cv_portfolio[cv]['train_returns'][assets].values for cv in cv_portfolio]
+
+    return returns, weights, folds, train_returns, fees
+
+
+def simulate_drift(returns: np.ndarray, weights: np.ndarray, folds: np.ndarray, train_returns: List[np.ndarray],
+                   fee: Union[float, np.ndarray] = 2e-4, volatility_target: Optional[float] = 0.05,
+                   return_weights: bool = False, max_leverage: Optional[float] = None):
+    """
+    Share level simulation of P portfolios on all folds in one array computation, generalizing compute_balance.
+    The portfolios are rebalanced to their target exposure leverage * weights at the start of each fold and when
+    their target weights change. Between two rebalancing dates the number of shares is constant, the weights drift with
+    the prices and the rest of the capital is held in cash (negative for leverage above 1) with null return. At each
+    rebalancing, the cost is sum_i fee_i * |target exposure_i - drifted exposure_i| of the capital. The portfolios start
+    from cash and go back to cash when their weights are missing (NaN on a whole fold), with NaN returns.
+
+    :param returns: test returns of all folds, (T, N), price.pct_change(1)
+    :param weights: target weights of each portfolio on every test date, (P, T, N)
+    :param folds: position of the first date of each fold in returns, (F)
+    :param train_returns: train returns of each fold, list of F (n_obs, N) arrays, for the volatility target
+    :param fee: transaction fee, scalar, per asset (N), per portfolio (P, 1) or (P, N)
+    :param volatility_target: if None, the leverage is 1
+    :param return_weights: also return the drifted weights (exposure as a fraction of the capital) at the close of
+    each date, the number of shares is exposure * capital / price
+    :param max_leverage: if given, maximum leverage
+    :return: portfolio returns (P, T), leverage (P, F), turnover (P, T) and the drifted weights (P, T, N) if
+    return_weights
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    folds = np.asarray(folds)
+    n_ports, n_dates, n_assets = weights.shape
+    n_folds = len(folds)
+    assert returns.shape == (n_dates, n_assets)
+    assert folds[0] == 0 and np.all(np.diff(folds) > 0)
+    assert len(train_returns) == n_folds
+    fold_id = np.repeat(np.arange(n_folds), np.diff(np.append(folds, n_dates)))
+    fee = np.broadcast_to(np.asarray(fee, dtype=np.float64), (n_ports, n_assets))
+
+    missing = np.logical_and.reduceat(np.all(np.isnan(weights), axis=-1), folds, axis=1)
+    weights = np.nan_to_num(weights)
+    if volatility_target:
+        leverage = fold_leverage(weights, folds, train_returns, volatility_target, max_leverage=max_leverage)
+    else:
+        leverage = np.ones((n_ports, n_folds))
+    leverage[missing] = np.nan
+    exposure = np.nan_to_num(leverage)[:, fold_id, None] * weights
+
+    rebalance = np.zeros((n_ports, n_dates), dtype=bool)
+    rebalance[:, folds] = True
+    rebalance[:, 1:] |= np.any(exposure[:, 1:] != exposure[:, :-1], axis=-1)
+    # Growth of each asset since the last rebalancing date, included
+    segment_start = np.maximum.accumulate(np.where(rebalance, np.arange(n_dates), 0), axis=1)
+    log_prices = np.concatenate([np.zeros((1, n_assets)), np.cumsum(np.log1p(returns), axis=0)])
+    growth = np.exp(log_prices[1:][None, :, :] - log_prices[segment_start])
+
+    holdings = exposure * growth
+    value = 1 - np.sum(exposure, axis=-1) + np.sum(holdings, axis=-1)
+    drifted_weights = holdings / value[:, :, None]
+
+    prev_weights = np.zeros_like(drifted_weights)
+    prev_weights[:, 1:] = drifted_weights[:, :-1]
+    turnover = np.where(rebalance, np.sum(np.abs(exposure - prev_weights), axis=-1), 0.)
+    cost = np.where(rebalance, np.sum(fee[:, None, :] * np.abs(exposure - prev_weights), axis=-1), 0.)
+    prev_value = np.ones_like(value)
+    prev_value[:, 1:] = value[:, :-1]
+    prev_value[rebalance] = 1.
+    port_returns = (1 - cost) * value / prev_value - 1
+    port_returns[missing[:, fold_id]] = np.nan
+
+    if return_weights:
+        return port_returns, leverage, turnover, drifted_weights
+    return port_returns, leverage, turnover
+
+
+def cv_portfolio_perf_drift(cv_portfolio: Dict, portfolios: List[str] = ['ae_rp_c', 'aeaa', 'aeerc'],
+                            fee: Union[float, np.ndarray] = 2e-4, volatility_target: Optional[float] = 0.05,
+                            market_budget: Optional[pd.DataFrame] = None, max_leverage: Optional[float] = None):
+    """
+    Same inputs and outputs as cv_portfolio_perf_array, computed with simulate_drift. The leverage is computed per fold
+
+    :param cv_portfolio:
+    :param portfolios:
+    :param fee: scalar or per asset fee schedule (N) in the order of the returns columns, not applied to equal weights
+    portfolios
+    :param volatility_target:
+    :param market_budget: required for 'equal_class'
+    :param max_leverage: if given, maximum leverage
+    :return: port_perf {portfolio: {'total': pd.DataFrame, 'turnover': pd.Series}}, leverage pd.DataFrame
+    """
+    returns, weights, folds, train_returns, fees = cv_portfolio_arrays(cv_portfolio, portfolios, fee=fee,
+                                                                      market_budget=market_budget)
+    if fees.ndim == 1:
+        fees = fees[:, None]
+    port_returns, leverage, turnover = simulate_drift(returns.values, weights, folds, train_returns, fee=fees,
+                                                      volatility_target=volatility_target, max_leverage=max_leverage)
+    port_perf = {p: {'total': pd.DataFrame(port_returns[i], index=returns.index),
+                     'turnover': pd.Series(turnover[i], index=returns.index)} for i, p in enumerate(portfolios)}
+    leverage = pd.DataFrame(leverage.T, columns=portfolios)
+
+    return port_perf, leverage
+
+
+class BacktestState:
+    """
+    Incremental version of backtest_arrays for daily production updates: the state of the backtest (previous weights
+    for the turnover cost, leverage of the current fold, capital, running maximum for the drawdown and online central
+    moments) is updated with one day of returns and weights in O(NP) for N assets and P portfolios. The state can be
+    checkpointed to disk with save and restored with load.
+    """
+
+    def __init__(self, portfolios: List[str], assets: List[str], fee: Union[float, np.ndarray] = 2e-4,
+                 volatility_target: Optional[float] = 0.05, period: int = 250):
+        """
+
+        :param portfolios:
+        :param assets:
+        :param fee: transaction fee, scalar or (P), use 0 for portfolios without costs such as equal weights
+        :param volatility_target: if None, there is no leverage and no cost
+        :param period: annualization period of the statistics
+        """
+        self.portfolios = list(portfolios)
+        self.assets = list(assets)
+        n_ports = len(self.portfolios)
+        self.fee = np.broadcast_to(np.asarray(fee, dtype=np.float64), (n_ports,)).copy()
+        self.volatility_target = volatility_target
+        self.period = period
+
+        self.dates = []
+        self.prev_weights = np.ones((n_ports, len(self.assets)))
+        self.leverage = np.ones(n_ports)
+        # Online moments of the returns (Terriberry), the count ignores the NaN returns of missing weights
+        self.n = np.zeros(n_ports)
+        self.mean = np.zeros(n_ports)
+        self._m2 = np.zeros(n_ports)
+        self._m3 = np.zeros(n_ports)
+        self._m4 = np.zeros(n_ports)
+        # Cumulative performance: np.cumprod(perf + 1)
+        self.capital = np.ones(n_ports)
+        self.first_capital = np.full(n_ports, np.nan)
+        self.running_max = np.full(n_ports, -np.inf)
+        self.mdd = np.zeros(n_ports)
+
+    def new_fold(self, train_returns: np.ndarray, weights: np.ndarray):
+        """
+        Compute the leverage of a new fold with the weights of its first date, see backtest_arrays
+
+        :param train_returns: train returns of the fold, (n_obs, N), only the last 60 are used
+        :param weights: weights of the first test date of the fold, (P, N)
+        :return:
+        """
+        if not self.volatility_target:
+            return
+        weights = np.nan_to_num(np.asarray(weights, dtype=np.float64))
+        self.leverage = fold_leverage(weights[:, None, :], np.array([0]), [train_returns], self.volatility_target)[:, 0]
+
+    def update(self, date, returns: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        Add one day to the backtest
+
+        :param date:
+        :param returns: returns of the assets, (N)
+        :param weights: weights of the portfolios, (P, N), NaN if missing
+        :return: volatility targeted and cost adjusted returns of the portfolios, (P)
+        """
+        returns = np.asarray(returns, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        missing = np.all(np.isnan(weights), axis=-1)
+        weights = np.nan_to_num(weights)
+
+        port_returns = weights @ returns
+        if self.volatility_target:
+            cost = self.fee * np.sum(np.abs(weights - self.prev_weights), axis=-1)
+            with np.errstate(invalid='ignore'):
+                port_returns = self.leverage * (port_returns - cost)
+        port_returns[missing] = np.nan
+        # Same as the first fold after missing weights
+        self.prev_weights = np.where(missing[:, None], 1., weights)
+        self.dates.append(date)
+
+        valid = ~missing
+        x = port_returns[valid]
+        n1 = self.n[valid]
+        n = n1 + 1
+        delta = x - self.mean[valid]
+        delta_n = delta / n
+        term = delta * delta_n * n1
+        m2, m3 = self._m2[valid], self._m3[valid]
+        self._m4[valid] += term * delta_n ** 2 * (n * n - 3 * n + 3) + 6 * delta_n ** 2 * m2 - 4 * delta_n * m3
+        self._m3[valid] += term * delta_n * (n - 2) - 3 * delta_n * m2
+        self._m2[valid] += term
+        self.mean[valid] += delta_n
+        self.n[valid] = n
+
+        self.capital[valid] *= 1 + x
+        self.first_capital = np.where(np.isnan(self.first_capital) & valid, self.capital, self.first_capital)
+        self.running_max[valid] = np.maximum(self.running_max[valid], self.capital[valid])
+        self.mdd[valid] = np.maximum(self.mdd[valid], 1 - self.capital[valid] / self.running_max[valid])
+
+        return port_returns
+
+    def stats(self) -> pd.DataFrame:
+        """
+        Current statistics of the portfolios with the definitions of backtest_stats, the quantile based statistics
+        (VaR, ES) are not available online
+
+        :return: pd.DataFrame with portfolios as index
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = self._m2 / (self.n - 1)
+            skew = np.sqrt(self.n) * self._m3 / self._m2 ** 1.5
+            kurtosis = self.n * self._m4 / self._m2 ** 2
+            stats = pd.DataFrame({
+                'Return': self.mean * self.period,
+                'Volatility': np.sqrt(var * self.period),
+                'Skewness': skew,
+                'Excess kurtosis': kurtosis - 3 - 3,
+                'SR': self.mean / np.sqrt(var) * np.sqrt(self.period),
+                'MDD': self.mdd,
+                'CR': (self.capital / self.first_capital - 1) / self.mdd,
+                'CEQ': self.mean * self.period - var / 2 * self.period
+            }, index=self.portfolios)
+        return stats
+
+    def save(self, path: str):
+        with open(path, 'wb') as _file:
+            pickle.dump(self, _file)
+
+    @classmethod
+    def load(cls, path: str) -> 'BacktestState':
+        with open(path, 'rb') as _file:
+            state = pickle.load(_file)
+        assert isinstance(state, cls)
+        return state
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+from typing import Dict, Optional
+from joblib import Parallel, delayed
+
+from dl_portfolio.sample import id_nb_bootstrap_batch
+
+BOOTSTRAP_STATS = ['SR', 'CEQ', 'MDD', 'VaR-5%', 'ES-5%', 'CR']
+
+
+def _replica_stats(x: np.ndarray, period: int = 250) -> np.ndarray:
+    """
+    BOOTSTRAP_STATS of the strategies of each replica, same definitions as backtest_stats
+
+    :param x: returns, (n_replicas, n_obs, n_strategies)
+    :param period:
+    :return: (n_stats, n_replicas, n_strategies)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.mean(x, axis=1)
+        var = np.var(x, axis=1, ddof=1)
+
+        quantile = np.quantile(x, 0.05, axis=1)
+        below = x <= quantile[:, None, :]
+        es = - np.sum(np.where(below, x, 0.), axis=1) / np.sum(below, axis=1)
+
+        cum_perf = np.cumprod(x + 1, axis=1)
+        mdd = np.abs(np.min(cum_perf / np.maximum.accumulate(cum_perf, axis=1) - 1., axis=1))
+        calmar = (cum_perf[:, -1] / cum_perf[:, 0] - 1) / mdd
+
+        return np.stack([mean / np.sqrt(var) * np.sqrt(period),
+                         mean * period - var / 2 * period,
+                         mdd,
+                         - quantile,
+                         es,
+                         calmar])
+
+
+def _bootstrap_chunk(values: np.ndarray, n_replicas: int, block_length: int, period: int,
+                     seed: np.random.SeedSequence) -> np.ndarray:
+    _id = id_nb_bootstrap_batch(len(values), block_length, n_replicas, random_state=seed)
+    return _replica_stats(values[_id], period=period)
+
+
+def bootstrap_stats(perf: pd.DataFrame, n_replicas: int = 1000, block_length: int = 44, period: int = 250,
+                    max_memory: int = 2 ** 28, n_jobs: Optional[int] = None,
+                    random_state: Optional[int] = 0) -> Dict[str, pd.DataFrame]:
+    """
+    Distribution of BOOTSTRAP_STATS of all strategies on block bootstrap replicas of the returns matrix. All strategies
+    are resampled with the same indexes to keep their dependence. The replicas are processed by chunks to bound the
+    memory and the chunks are distributed over n_jobs workers. Each chunk has its own seed spawned from random_state,
+    so the result does not depend on n_jobs.
+
+    :param perf: returns of the strategies, (n_obs, n_strategies)
+    :param n_replicas:
+    :param block_length:
+    :param period: annualization period
+    :param max_memory: maximum size in bytes of the resampled returns of a chunk
+    :param n_jobs: number of parallel jobs, sequential if None
+    :param random_state:
+    :return: {stat: pd.DataFrame (n_replicas, n_strategies)}
+    """
+    values = perf.values.astype(np.float64)
+    chunk_size = int(max(1, min(n_replicas, max_memory // (8 * values.size))))
+    chunks = [min(chunk_size, n_replicas - start) for start in range(0, n_replicas, chunk_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(chunks))
+
+    if n_jobs:
+        with Parallel(n_jobs=n_jobs) as _parallel_pool:
+            stats = _parallel_pool(
+                delayed(_bootstrap_chunk)(values, size, block_length, period, seed) for size, seed in zip(chunks, seeds)
+            )
+    else:
+        stats = [_bootstrap_chunk(values, size, block_length, period, seed) for size, seed in zip(chunks, seeds)]
+    stats = np.concatenate(stats, axis=1)
+
+    return {s: pd.DataFrame(stats[i], columns=perf.columns) for i, s in enumerate(BOOTSTRAP_STATS)}
+
+
+def bootstrap_ci(perf: pd.DataFrame, alpha: float = 0.05, period: int = 250, **kwargs) -> pd.DataFrame:
+    """
+    Percentile confidence intervals of BOOTSTRAP_STATS
+
+    :param perf: returns of the strategies, (n_obs, n_strategies)
+    :param alpha: the intervals have 1 - alpha coverage
+    :param period:
+    :param kwargs: passed to bootstrap_stats
+    :return: pd.DataFrame with strategies as index and for each stat the sample estimate, the lower and upper bounds
+    """
+    distribution = bootstrap_stats(perf, period=period, **kwargs)
+    estimate = _replica_stats(perf.values.astype(np.float64)[None, :, :], period=period)[:, 0]
+
+    ci = pd.DataFrame(index=perf.columns)
+    for i, s in enumerate(BOOTSTRAP_STATS):
+        ci[s] = estimate[i]
+        ci[f'{s}-lower'] = np.nanquantile(distribution[s].values, alpha / 2, axis=0)
+        ci[f'{s}-upper'] = np.nanquantile(distribution[s].values, 1 - alpha / 2, axis=0)
+
+    return ci
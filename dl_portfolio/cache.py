@@ -0,0 +1,222 @@
+import datetime as dt
+import hashlib
+import json
+import os
+import threading
+import types
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+from dl_portfolio.logger import LOGGER
+
+# Version of the cached results, increase it when the content of one_cv results or the format of the key changes
+CACHE_VERSION = 1
+
+
+def hash_files(paths: List[str]) -> str:
+    """
+    Hash of the content of files
+
+    :param paths:
+    :return:
+    """
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        h.update(os.path.basename(path).encode())
+        with open(path, 'rb') as _file:
+            for chunk in iter(lambda: _file.read(2 ** 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def artifact_hash(base_dir: str, cv: int) -> str:
+    """
+    Hash of the artifacts of a fold: the files of the fold directory and the files at the root of the run directory
+    (configuration)
+
+    :param base_dir: run directory
+    :param cv: fold
+    :return:
+    """
+    paths = [os.path.join(base_dir, f) for f in os.listdir(base_dir) if os.path.isfile(os.path.join(base_dir, f))]
+    fold_dir = os.path.join(base_dir, str(cv))
+    for root, _, files in os.walk(fold_dir):
+        paths.extend(os.path.join(root, f) for f in files)
+    return hash_files(paths)
+
+
+def hash_frame(frame: Optional[pd.DataFrame]) -> Optional[str]:
+    if frame is None:
+        return None
+    h = hashlib.sha1(pd.util.hash_pandas_object(frame, index=True).values.tobytes())
+    h.update(str(list(frame.columns)).encode())
+    return h.hexdigest()
+
+
+def key_value(value: Any, name: str = 'value'):
+    """
+    JSON value of a parameter of one_cv in its cache key: numbers, strings, booleans and None as is, lists, tuples and
+    dictionaries recursively, pd.DataFrame, pd.Series and np.ndarray by the hash of their content and modules (the
+    configuration) by the hash of their source file. Any other type is rejected, its content could change without
+    changing the key.
+
+    :param value:
+    :param name: name of the parameter for the error message
+    :return:
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (int, float, str, bool, type(None))):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [key_value(v, f"{name}[{i}]") for i, v in enumerate(value)]
+    if isinstance(value, dict):
+        return {str(k): key_value(v, f"{name}[{k}]") for k, v in value.items()}
+    if isinstance(value, pd.Series):
+        value = value.to_frame()
+    if isinstance(value, pd.DataFrame):
+        return {'frame': hash_frame(value)}
+    if isinstance(value, np.ndarray):
+        h = hashlib.sha1(np.ascontiguousarray(value).tobytes())
+        h.update(f"{value.dtype}{value.shape}".encode())
+        return {'array': h.hexdigest()}
+    if isinstance(value, types.ModuleType) and getattr(value, '__file__', None):
+        return {'module': value.__name__, 'source': hash_files([value.__file__])}
+    raise ValueError(f"Parameter '{name}' of type {type(value).__name__} cannot be part of the cache key")
+
+
+def one_cv_key(artifact: str, cv: int, test_set: str, window: Optional[int], portfolios: Optional[List[str]],
+               market_budget: Optional[pd.DataFrame], data_hash: Optional[str] = None, **kwargs) -> str:
+    """
+    Content address of the result of one_cv
+
+    :param artifact: artifact_hash of the fold
+    :param cv:
+    :param test_set:
+    :param window:
+    :param portfolios:
+    :param market_budget:
+    :param data_hash: hash_frame of the prices
+    :param kwargs: other parameters of one_cv, see key_value
+    :return:
+    """
+    params = {
+        'version': CACHE_VERSION,
+        'artifact': artifact,
+        'cv': cv,
+        'test_set': test_set,
+        'window': window,
+        'portfolios': None if portfolios is None else list(portfolios),
+        'market_budget': hash_frame(market_budget),
+        'data': data_hash,
+        'kwargs': {k: key_value(v, k) for k, v in kwargs.items()}
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def load_cached(cache_dir: str, key: str) -> Optional[Dict]:
+    path = os.path.join(cache_dir, f"{key}.joblib")
+    if not os.path.isfile(path):
+        return None
+    try:
+        return joblib.load(path)
+    except Exception as _exc:
+        LOGGER.warning(f"Could not load cached result {path}: {_exc}")
+        return None
+
+
+def _atomic_write(path: str, write):
+    """
+    Write path with write(tmp_path) in a temporary file of the same directory renamed to path, the temporary file of a
+    failed write is removed
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def _dump_json(obj, path: str):
+    with open(path, 'w') as _file:
+        json.dump(obj, _file, default=str)
+
+
+def save_cached(cache_dir: str, key: str, res: Dict, **meta):
+    """
+    Store a result and its metadata, the files are written atomically so that concurrent jobs (processes or threads)
+    never read a partial result
+
+    :param cache_dir:
+    :param key:
+    :param res:
+    :param meta: stored in {key}.json for the invalidation CLI
+    :return:
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    _atomic_write(os.path.join(cache_dir, f"{key}.joblib"), partial(joblib.dump, res))
+    meta['created'] = dt.datetime.now().isoformat()
+    _atomic_write(os.path.join(cache_dir, f"{key}.json"), partial(_dump_json, meta))
+
+
+def list_cache(cache_dir: str) -> pd.DataFrame:
+    """
+    Metadata of the cached results
+
+    :param cache_dir:
+    :return: pd.DataFrame with key as index
+    """
+    entries = {}
+    if os.path.isdir(cache_dir):
+        for f in os.listdir(cache_dir):
+            if f.endswith('.json'):
+                with open(os.path.join(cache_dir, f)) as _file:
+                    entries[f[:-len('.json')]] = json.load(_file)
+    entries = pd.DataFrame.from_dict(entries, orient='index')
+    if len(entries):
+        entries['size'] = [os.path.getsize(os.path.join(cache_dir, f"{key}.joblib"))
+                           if os.path.isfile(os.path.join(cache_dir, f"{key}.joblib")) else np.nan
+                           for key in entries.index]
+    return entries
+
+
+def invalidate_cache(cache_dir: str, base_dir: Optional[str] = None, test_set: Optional[str] = None,
+                     older_than: Optional[float] = None) -> List[str]:
+    """
+    Remove cached results, all of them if no filter is given
+
+    :param cache_dir:
+    :param base_dir: only the results of this run directory
+    :param test_set: only the results of this test set
+    :param older_than: only the results created more than older_than days ago
+    :return: removed keys
+    """
+    entries = list_cache(cache_dir)
+    if not len(entries):
+        return []
+    mask = np.ones(len(entries), dtype=bool)
+    if base_dir is not None:
+        mask &= (entries['base_dir'].apply(os.path.normpath) == os.path.normpath(base_dir)).values
+    if test_set is not None:
+        mask &= (entries['test_set'] == test_set).values
+    if older_than is not None:
+        # isoformat omits the microseconds when they are 0, each date is parsed on its own
+        created = entries['created'].apply(pd.Timestamp)
+        mask &= (created < dt.datetime.now() - dt.timedelta(days=older_than)).values
+
+    removed = list(entries.index[mask])
+    for key in removed:
+        for ext in ['joblib', 'json']:
+            path = os.path.join(cache_dir, f"{key}.{ext}")
+            if os.path.isfile(path):
+                os.remove(path)
+    LOGGER.info(f"Removed {len(removed)} cached results from {cache_dir}")
+    return removed
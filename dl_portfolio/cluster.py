@@ -3,7 +3,9 @@ import pandas as pd
 import numpy as np
 from sklearn import metrics
 from sklearn.cluster import KMeans
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from scipy.optimize import linear_sum_assignment
 from scipy.spatial.distance import squareform
 from fastcluster import linkage
 
@@ -44,36 +46,110 @@ def assign_cluster_from_consmat(cons_mat: pd.DataFrame, cluster_names: List[str]
     return cluster_assignment
 
 
-def get_cluster_labels(embedding: pd.DataFrame, threshold: float = 0.1):
-    encoding_dim = embedding.shape[-1]
+@lru_cache(maxsize=4096)
+def _cluster_labels(data: bytes, shape: Tuple, dtype: str, threshold: Optional[float]) -> np.ndarray:
+    embedding = np.frombuffer(data, dtype=dtype).reshape(shape)
+    encoding_dim = shape[-1]
     if threshold is None:
-        kmeans = KMeans(n_clusters=encoding_dim, random_state=0).fit(embedding.values)
-        labels = pd.DataFrame(kmeans.labels_, index=embedding.index, columns=['label'])
+        labels = KMeans(n_clusters=encoding_dim, random_state=0).fit(embedding).labels_
     else:
-        mask = embedding >= threshold
-        labels = pd.DataFrame(columns=['label'], index=mask.index)
-        for c in range(encoding_dim):
-            labels.loc[mask.index[mask[c]], 'label'] = c
+        # Assets are assigned to the factor with the largest loading, if it is above threshold. Other assets are put in
+        # another cluster: encoding_dim
+        labels = np.where(np.max(embedding, axis=1) >= threshold, np.argmax(embedding, axis=1), encoding_dim)
+    labels = labels.astype(int)
+    labels.setflags(write=False)
+    return labels
+
+
+def cluster_labels(embedding: np.ndarray, threshold: Optional[float] = 0.1) -> np.ndarray:
+    """
+    Integer cluster label of each asset, memoized on the content of the embedding
 
-        # When orthogonality constraint is not met, take max
-        multi_c = (labels['label'] != embedding.idxmax(1)) & (~labels['label'].isna())
-        labels.loc[multi_c, 'label'] = embedding.idxmax(1).loc[multi_c]
-        labels = labels.fillna(
-            encoding_dim)  # Some assets might not be assigned to any cluster, put them in another cluster
+    :param embedding: (n_assets, encoding_dim)
+    :param threshold: if None, use KMeans with encoding_dim clusters
+    :return: read-only array of labels in [0, encoding_dim]
+    """
+    embedding = np.ascontiguousarray(embedding, dtype=np.float64)
+    return _cluster_labels(embedding.tobytes(), embedding.shape, embedding.dtype.str, threshold)
 
-    cluster_labels = np.unique(labels['label'].values).tolist()
-    cluster_labels.sort()
 
-    clusters = {}
-    for c in cluster_labels:
-        assets = list(labels.loc[labels['label'] == c].index)
-        clusters[c] = assets
+def get_cluster_labels(embedding: pd.DataFrame, threshold: float = 0.1):
+    """
+    Clusters are numbered by factor position, whatever the names of the embedding columns: assets whose largest
+    loading is below threshold are in cluster embedding.shape[-1]. The embedding is not modified.
 
-    clusters = {i: clusters.get(i) for i in range(len(cluster_labels)) if clusters.get(i) is not None}  # reorder dict
+    :param embedding:
+    :param threshold:
+    :return: clusters {label: list of assets}, labels pd.DataFrame with 'label' column
+    """
+    labels = cluster_labels(embedding.values, threshold=threshold)
+    clusters = {int(c): list(embedding.index[labels == c]) for c in np.unique(labels)}
+    labels = pd.DataFrame(labels, index=embedding.index, columns=['label'])
 
     return clusters, labels
 
 
+def align_factors(reference: pd.DataFrame, embedding: pd.DataFrame) -> np.ndarray:
+    """
+    The factors of different runs are only identified up to a permutation. Find the permutation of the factors of
+    embedding maximizing the total cosine similarity with the factors of reference.
+
+    :param reference: (n_assets, encoding_dim)
+    :param embedding: (n_assets, encoding_dim)
+    :return: order such that embedding.iloc[:, order] is aligned with reference
+    """
+    assert reference.shape == embedding.shape
+    ref = reference.values
+    emb = embedding.loc[reference.index].values
+    ref_norm = np.linalg.norm(ref, axis=0)
+    emb_norm = np.linalg.norm(emb, axis=0)
+    similarity = (ref / np.where(ref_norm > 0, ref_norm, 1)).T @ (emb / np.where(emb_norm > 0, emb_norm, 1))
+    _, order = linear_sum_assignment(-similarity)
+    return order
+
+
+def ensemble_embedding(embeddings: Dict, loadings: Dict, method: str = 'mean', threshold: float = 0.1):
+    """
+    Single embedding and loading for several runs (seeds) of the same fold, the factors of each run are first aligned
+    with the factors of the first run.
+    - 'mean': average of the aligned embeddings
+    - 'consensus': frequency at which each asset is assigned to each aligned factor by get_cluster_labels, so that the
+    cluster of an asset is the one it is assigned to in most runs. Assets which are mostly in no cluster get a null row.
+    The loading is the average of the aligned loadings in both cases.
+
+    :param embeddings: {run_i: pd.DataFrame}
+    :param loadings: {run_i: pd.DataFrame}
+    :param method: 'mean' or 'consensus'
+    :param threshold: threshold of get_cluster_labels for 'consensus'
+    :return: embedding, loading
+    """
+    runs = list(embeddings.keys())
+    reference = embeddings[runs[0]]
+    assets, columns = reference.index, reference.columns
+    encoding_dim = reference.shape[-1]
+
+    aligned_embedding = np.zeros((len(runs), len(assets), encoding_dim))
+    aligned_loading = np.zeros((len(runs), len(assets), encoding_dim))
+    for i, run in enumerate(runs):
+        order = align_factors(reference, embeddings[run])
+        aligned_embedding[i] = embeddings[run].loc[assets].values[:, order]
+        aligned_loading[i] = loadings[run].loc[assets].values[:, order]
+    loading = pd.DataFrame(aligned_loading.mean(0), index=assets, columns=columns)
+
+    if method == 'mean':
+        embedding = aligned_embedding.mean(0)
+    elif method == 'consensus':
+        labels = np.stack([cluster_labels(e, threshold=threshold) for e in aligned_embedding])
+        frequency = (labels[:, :, None] == np.arange(encoding_dim + 1)).mean(0)
+        embedding = frequency[:, :encoding_dim]
+        embedding[np.argmax(frequency, axis=1) == encoding_dim] = 0.
+    else:
+        raise NotImplementedError(method)
+    embedding = pd.DataFrame(embedding, index=assets, columns=columns)
+
+    return embedding, loading
+
+
 def consensus_matrix(labels: Dict, reorder=False, method='single'):
     """
 
@@ -82,25 +158,12 @@ def consensus_matrix(labels: Dict, reorder=False, method='single'):
     """
     n_runs = len(labels)
     assets = labels[0]['label'].index
-    n_assets = len(assets)
-
-    connect_mat = []
-    for i in range(n_runs):
-        cm = pd.DataFrame(np.eye(n_assets), columns=assets, index=assets, dtype=np.uint8)
-        classes = labels[i]['label'].unique().tolist()
-
-        for label in classes:
-            cluster = list(assets[labels[i]['label'] == label])
-            cluster = {a: [x for j, x in enumerate(cluster) if i != j] for i, a in enumerate(cluster)}
-            for c in cluster:
-                cm.loc[c, cluster[c]] = 1
-
-        connect_mat.append(cm)
 
-    cons_mat = pd.DataFrame(0, columns=assets, index=assets, dtype=np.uint8)
+    cons_mat = np.zeros((len(assets), len(assets)))
     for i in range(n_runs):
-        cons_mat += connect_mat[i]
-    cons_mat = cons_mat / n_runs
+        run_labels = labels[i]['label'].loc[assets].values
+        cons_mat += run_labels[:, None] == run_labels[None, :]
+    cons_mat = pd.DataFrame(cons_mat / n_runs, columns=assets, index=assets)
 
     if reorder:
         cons_mat, res_order, res_linkage = compute_serial_matrix((1 - cons_mat).values, method)
@@ -117,10 +180,11 @@ def rand_score_permutation(labels):
     :return:
     """
     n_runs = len(labels)
-    rand = np.zeros((n_runs, n_runs))
+    rand = np.eye(n_runs)
+    # The adjusted rand score is symmetric
     for i in range(n_runs):
-        for j in range(n_runs):
-            rand[i, j] = metrics.adjusted_rand_score(labels[i]['label'], labels[j]['label'])
+        for j in range(i + 1, n_runs):
+            rand[i, j] = rand[j, i] = metrics.adjusted_rand_score(labels[i]['label'], labels[j]['label'])
     return rand
 
 
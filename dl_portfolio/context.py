@@ -0,0 +1,147 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from functools import cached_property
+from sklearn.cluster import KMeans
+from typing import Dict, Optional
+
+from dl_portfolio.cluster import get_cluster_labels
+from dl_portfolio.covariance import get_covariance
+from dl_portfolio.hierarchical import correlation_distance, get_linkage
+
+
+class PortfolioContext:
+    """
+    Statistics of the returns used to compute the portfolio weights on one (fold, window). Every statistic is computed
+    lazily the first time it is needed and cached, the context can then be shared by all the weight functions of a
+    portfolio_weights call and by all the seeds of the same fold. The linkage and KMeans caches are guarded by a lock
+    so that the weight functions can run in the threads of portfolio_weights, the statistics are idempotent.
+    """
+
+    def __init__(self, returns: pd.DataFrame, cov_method: str = 'sample'):
+        """
+
+        :param returns: train returns used for the portfolio optimisation
+        :param cov_method: estimator of the covariance matrix, see dl_portfolio.covariance.get_covariance
+        """
+        self.returns = returns
+        self.cov_method = cov_method
+        self._linkage = {}
+        self._kmeans_labels = {}
+        # Weights of the portfolios which do not depend on the model, filled by portfolio_weights and
+        # fold_batch_weights, the keys contain the portfolio and the other inputs of its weights
+        self.weights_cache = {}
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # The context is returned by the joblib workers and cached on disk, the lock cannot be pickled
+        state = self.__dict__.copy()
+        state.pop('_lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_moments(cls, returns: pd.DataFrame, mean: pd.Series, cov: pd.DataFrame):
+        """
+        Build a context whose mean and covariance were computed elsewhere, for example by rolling updates
+
+        :param returns:
+        :param mean:
+        :param cov:
+        :return:
+        """
+        context = cls(returns)
+        context.__dict__['mean'] = mean
+        context.__dict__['cov'] = cov
+        return context
+
+    @cached_property
+    def mean(self) -> pd.Series:
+        return self.returns.mean()
+
+    @cached_property
+    def cov(self) -> pd.DataFrame:
+        return get_covariance(self.returns, method=self.cov_method)
+
+    @cached_property
+    def corr(self) -> pd.DataFrame:
+        std = np.sqrt(np.diag(self.cov.values))
+        corr = self.cov.values / np.outer(std, std)
+        return pd.DataFrame(np.clip(corr, -1, 1), index=self.cov.index, columns=self.cov.columns)
+
+    @cached_property
+    def distance(self) -> pd.DataFrame:
+        """
+        Correlation distance: sqrt((1 - corr) / 2)
+        """
+        return pd.DataFrame(correlation_distance(self.corr.values), index=self.corr.index, columns=self.corr.columns)
+
+    def linkage(self, method: str = 'single') -> np.ndarray:
+        """
+        Hierarchical clustering of the assets based on the correlation distance
+
+        :param method: linkage method
+        :return:
+        """
+        # corr is read outside of the lock: it is a cached_property with its own lock on python < 3.12
+        corr = self.corr.values
+        with self._lock:
+            if method not in self._linkage:
+                self._linkage[method] = get_linkage(corr, method=method)
+            return self._linkage[method]
+
+    def kmeans_labels(self, n_clusters: int) -> np.ndarray:
+        """
+        KMeans clustering of the assets on their returns, fitted once per number of clusters
+
+        :param n_clusters:
+        :return: labels in the order of the returns columns
+        """
+        with self._lock:
+            if n_clusters not in self._kmeans_labels:
+                self._kmeans_labels[n_clusters] = KMeans(n_clusters=n_clusters, random_state=0).fit(
+                    self.returns.T).labels_
+            return self._kmeans_labels[n_clusters]
+
+    def cluster_labels(self, embedding: pd.DataFrame, threshold: float = 0.1):
+        """
+        get_cluster_labels of embedding, it is memoized on the content of the embedding
+
+        :param embedding:
+        :param threshold:
+        :return: clusters, labels
+        """
+        return get_cluster_labels(embedding, threshold=threshold)
+
+
+def get_context(returns: pd.DataFrame, context: Optional[PortfolioContext] = None,
+                cov_method: Optional[str] = None) -> PortfolioContext:
+    """
+    Return context if given, after checking that it is the context of returns, otherwise a new context of returns
+
+    :param returns:
+    :param context:
+    :param cov_method: if given, covariance estimator of the context, default to 'sample' for a new context
+    :return:
+    """
+    if context is None:
+        context = PortfolioContext(returns, cov_method=cov_method or 'sample')
+    else:
+        assert context.returns.index.equals(returns.index) and context.returns.columns.equals(returns.columns)
+        assert cov_method is None or context.cov_method == cov_method, (context.cov_method, cov_method)
+    return context
+
+
+def get_contexts(cv_results: Dict) -> Dict:
+    """
+    Extract the contexts of the results of get_cv_results to share them with the next seeds
+
+    :param cv_results: {cv: res}
+    :return:
+    """
+    return {cv: cv_results[cv]['context'] for cv in cv_results if cv_results[cv].get('context') is not None}
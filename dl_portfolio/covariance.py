@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+from typing import Optional
+from sklearn.covariance import LedoitWolf, OAS
+
+# Estimators of get_covariance
+COV_METHODS = ['sample', 'ledoit_wolf', 'oas', 'ewma']
+
+
+def ledoit_wolf_cov(returns: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ledoit-Wolf shrinkage towards a scaled identity
+
+    :param returns:
+    :return:
+    """
+    cov = LedoitWolf().fit(returns.values).covariance_
+    return pd.DataFrame(cov, index=returns.columns, columns=returns.columns)
+
+
+def oas_cov(returns: pd.DataFrame) -> pd.DataFrame:
+    """
+    Oracle Approximating Shrinkage towards a scaled identity
+
+    :param returns:
+    :return:
+    """
+    cov = OAS().fit(returns.values).covariance_
+    return pd.DataFrame(cov, index=returns.columns, columns=returns.columns)
+
+
+def ewma_cov(returns: pd.DataFrame, halflife: float = 60) -> pd.DataFrame:
+    """
+    Exponentially weighted covariance at the last date of returns
+
+    :param returns:
+    :param halflife: in number of observations
+    :return:
+    """
+    x = returns.values
+    weights = 0.5 ** (np.arange(len(x))[::-1] / halflife)
+    weights = weights / np.sum(weights)
+    x = x - np.dot(weights, x)
+    cov = np.dot(x.T * weights, x) / (1 - np.sum(weights ** 2))
+    return pd.DataFrame(cov, index=returns.columns, columns=returns.columns)
+
+
+class FactorCovariance:
+    """
+    Factor model covariance S = B S_f B^T + diag(d), stored in low-rank plus diagonal form: products, quadratic forms
+    and the diagonal cost O(NK) for N assets and K factors, the dense matrix is only built on demand.
+    """
+
+    def __init__(self, loadings: pd.DataFrame, factor_cov: np.ndarray, specific_var: np.ndarray):
+        """
+
+        :param loadings: B, (N, K) with assets as index
+        :param factor_cov: S_f, (K, K)
+        :param specific_var: d, (N)
+        """
+        self.loadings = loadings
+        self.factor_cov = np.asarray(factor_cov, dtype=np.float64)
+        self.specific_var = np.asarray(specific_var, dtype=np.float64)
+        assert self.factor_cov.shape == (loadings.shape[1], loadings.shape[1])
+        assert self.specific_var.shape == (loadings.shape[0],)
+
+    @property
+    def index(self) -> pd.Index:
+        return self.loadings.index
+
+    @property
+    def columns(self) -> pd.Index:
+        return self.loadings.index
+
+    @property
+    def shape(self):
+        return len(self.index), len(self.index)
+
+    def diag(self) -> np.ndarray:
+        B = self.loadings.values
+        return np.einsum('ik,kl,il->i', B, self.factor_cov, B) + self.specific_var
+
+    def dot(self, x: np.ndarray) -> np.ndarray:
+        B = self.loadings.values
+        return B @ (self.factor_cov @ (B.T @ x)) + self.specific_var * x
+
+    def quad(self, x: np.ndarray) -> float:
+        """
+        x^T S x
+        """
+        y = self.loadings.values.T @ x
+        return float(y @ self.factor_cov @ y + np.sum(self.specific_var * x ** 2))
+
+    def factor(self) -> np.ndarray:
+        """
+        F, (N, K) such that S = F F^T + diag(d)
+        """
+        eigval, eigvec = np.linalg.eigh(self.factor_cov)
+        return self.loadings.values @ (eigvec * np.sqrt(np.clip(eigval, 0, None)))
+
+    @property
+    def values(self) -> np.ndarray:
+        B = self.loadings.values
+        return B @ self.factor_cov @ B.T + np.diag(self.specific_var)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.values, index=self.index, columns=self.index)
+
+
+def factor_covariance(returns: pd.DataFrame, loadings: pd.DataFrame,
+                      specific_var: Optional[np.ndarray] = None) -> FactorCovariance:
+    """
+    Factor model covariance from the loadings of the AE/NMF: the factor returns are estimated by cross-sectional least
+    squares of the returns on the loadings at each date, S_f is their covariance and d the variance of the residuals.
+
+    :param returns: returns, (T, N), for example the train window of the fold
+    :param loadings: (N, K) loadings in the space of returns
+    :param specific_var: d, for example the diagonal of the residual covariance of the model. By default, the variance
+    of the residuals of the cross-sectional regression on returns.
+    :return:
+    """
+    loadings = loadings.loc[returns.columns]
+    x = returns.values - returns.values.mean(0)
+    B = loadings.values
+    factors = np.linalg.lstsq(B, x.T, rcond=None)[0].T
+    residuals = x - factors @ B.T
+    factor_cov = np.cov(factors, rowvar=False, ddof=1).reshape(B.shape[1], B.shape[1])
+    if specific_var is None:
+        specific_var = np.var(residuals, axis=0, ddof=1)
+    elif isinstance(specific_var, pd.Series):
+        specific_var = specific_var.loc[returns.columns].values
+
+    return FactorCovariance(loadings, factor_cov, specific_var)
+
+
+def get_covariance(returns: pd.DataFrame, method: str = 'sample', **kwargs) -> pd.DataFrame:
+    """
+
+    Covariance matrix of returns
+
+    :param returns:
+    :param method: one of COV_METHODS
+    :param kwargs: passed to the estimator
+    :return:
+    """
+    if method == 'sample':
+        return returns.cov()
+    elif method == 'ledoit_wolf':
+        return ledoit_wolf_cov(returns)
+    elif method == 'oas':
+        return oas_cov(returns)
+    elif method == 'ewma':
+        return ewma_cov(returns, **kwargs)
+    else:
+        raise NotImplementedError(method)
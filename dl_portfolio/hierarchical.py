@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+
+from typing import Optional
+from scipy.cluster.hierarchy import fcluster, leaves_list, to_tree
+from scipy.spatial.distance import squareform
+from fastcluster import linkage as fastcluster_linkage
+
+
+def correlation_distance(corr: np.ndarray) -> np.ndarray:
+    return np.sqrt(np.clip((1 - corr) / 2, 0., None))
+
+
+def get_linkage(corr: np.ndarray, method: str = 'single') -> np.ndarray:
+    """
+    Linkage of the assets on the correlation distance sqrt((1 - corr) / 2)
+
+    :param corr: correlation matrix
+    :param method: linkage method
+    :return:
+    """
+    return fastcluster_linkage(squareform(correlation_distance(corr), checks=False), method=method)
+
+
+def _ivp_cluster_var(cov: np.ndarray) -> np.ndarray:
+    """
+    Variance of the inverse variance portfolio of each cluster
+
+    :param cov: covariance of the assets of the cluster, (..., n, n)
+    :return: (...)
+    """
+    w = 1. / np.diagonal(cov, axis1=-2, axis2=-1)
+    w = w / np.sum(w, axis=-1, keepdims=True)
+    return np.einsum('...i,...ij,...j->...', w, cov, w)
+
+
+def hrp_batch(covs: np.ndarray, orders: np.ndarray) -> np.ndarray:
+    """
+    Hierarchical Risk Parity (Lopez de Prado, 2016) recursive bisection for a batch of problems with the same number
+    of assets, for example all the folds of a run. The bisection splits the quasi-diagonalized assets in halves, so the
+    segments only depend on the number of assets and each split is computed for all problems at once.
+
+    :param covs: covariance matrices, (n_problems, n_assets, n_assets)
+    :param orders: quasi-diagonal order of the assets of each problem (leaves of the linkage), (n_problems, n_assets)
+    :return: weights in the original order of the assets, (n_problems, n_assets)
+    """
+    covs = np.asarray(covs, dtype=np.float64)
+    orders = np.asarray(orders)
+    n_problems, n_assets = orders.shape
+    rows = np.arange(n_problems)[:, None]
+    # Sort the covariance matrices in the quasi-diagonal order
+    sorted_covs = covs[rows[:, :, None], orders[:, :, None], orders[:, None, :]]
+
+    sorted_weights = np.ones((n_problems, n_assets))
+    segments = [(0, n_assets)]
+    while segments:
+        next_segments = []
+        for start, end in segments:
+            if end - start < 2:
+                continue
+            middle = start + (end - start) // 2
+            var_left = _ivp_cluster_var(sorted_covs[:, start:middle, start:middle])
+            var_right = _ivp_cluster_var(sorted_covs[:, middle:end, middle:end])
+            alpha = 1 - var_left / (var_left + var_right)
+            sorted_weights[:, start:middle] *= alpha[:, None]
+            sorted_weights[:, middle:end] *= (1 - alpha)[:, None]
+            next_segments.extend([(start, middle), (middle, end)])
+        segments = next_segments
+
+    weights = np.empty_like(sorted_weights)
+    weights[rows, orders] = sorted_weights
+    return weights
+
+
+def hrp(cov: np.ndarray, link: np.ndarray) -> np.ndarray:
+    """
+    Hierarchical Risk Parity weights of one problem
+
+    :param cov: covariance matrix
+    :param link: linkage matrix
+    :return:
+    """
+    return hrp_batch(cov[None, :, :], leaves_list(link)[None, :])[0]
+
+
+def _within_cluster_dispersion(distance: np.ndarray, labels: np.ndarray) -> float:
+    w = 0.
+    for c in np.unique(labels):
+        idx = np.where(labels == c)[0]
+        w += np.sum(distance[np.ix_(idx, idx)]) / (2 * len(idx))
+    return w
+
+
+def get_optimal_number_of_clusters(returns: np.ndarray, link: np.ndarray, method: str = 'single',
+                                   n_reference: int = 5, max_clusters: Optional[int] = None,
+                                   random_state: Optional[int] = 0) -> int:
+    """
+    Number of clusters maximizing the gap statistic (Tibshirani et al., 2001): the log within cluster dispersion of
+    the tree is compared to the one of reference trees built on uniform returns.
+
+    :param returns: (n_obs, n_assets)
+    :param link: linkage of returns
+    :param method: linkage method used for the reference trees
+    :param n_reference: number of reference datasets
+    :param max_clusters: default to min(n_assets // 2, 10)
+    :param random_state:
+    :return:
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    n_assets = returns.shape[1]
+    if max_clusters is None:
+        max_clusters = min(n_assets // 2, 10)
+    if max_clusters < 2:
+        return 1
+    rng = np.random.default_rng(random_state)
+    distance = correlation_distance(np.corrcoef(returns, rowvar=False))
+    n_clusters = np.arange(1, max_clusters + 1)
+
+    log_w = np.log([_within_cluster_dispersion(distance, fcluster(link, k, criterion='maxclust'))
+                    for k in n_clusters])
+    ref_log_w = np.zeros((n_reference, len(n_clusters)))
+    for i in range(n_reference):
+        ref_distance = correlation_distance(np.corrcoef(rng.uniform(size=returns.shape), rowvar=False))
+        ref_link = fastcluster_linkage(squareform(ref_distance, checks=False), method=method)
+        ref_log_w[i] = np.log([_within_cluster_dispersion(ref_distance, fcluster(ref_link, k, criterion='maxclust'))
+                               for k in n_clusters])
+    gap = np.mean(ref_log_w, axis=0) - log_w
+
+    return int(n_clusters[np.argmax(gap)])
+
+
+def herc(cov: np.ndarray, link: np.ndarray, n_clusters: int, risk_measure: str = 'variance') -> np.ndarray:
+    """
+    Hierarchical Equal Risk Contribution (Raffinot, 2018). The tree is cut in n_clusters clusters, the weights are
+    split top-down between the two children of each node until reaching the clusters, then allocated inside each
+    cluster. As in Raffinot, the risk of a child is the sum of the risk contributions of the clusters it contains, the
+    risk contribution of a cluster being the variance of its inverse variance portfolio.
+
+    :param cov: covariance matrix
+    :param link: linkage matrix
+    :param n_clusters: number of clusters
+    :param risk_measure: 'variance' (HERC): split proportionally to the inverse risk of the children and inverse
+    variance weights inside clusters. 'equal_weighting' (HCAA): equal split and equal weights inside clusters.
+    :return:
+    """
+    assert risk_measure in ['variance', 'equal_weighting']
+    cov = np.asarray(cov, dtype=np.float64)
+    labels = fcluster(link, n_clusters, criterion='maxclust')
+    weights = np.zeros(len(cov))
+    if risk_measure == 'variance':
+        cluster_risk = {c: _ivp_cluster_var(cov[np.ix_(labels == c, labels == c)]) for c in np.unique(labels)}
+
+    nodes = [(to_tree(link), 1.)]
+    while nodes:
+        node, node_weight = nodes.pop()
+        items = node.pre_order()
+        if node.is_leaf() or len(np.unique(labels[items])) == 1:
+            # Allocation inside the cluster
+            if risk_measure == 'variance':
+                w = 1. / np.diag(cov)[items]
+            else:
+                w = np.ones(len(items))
+            weights[items] = node_weight * w / np.sum(w)
+            continue
+        left, right = node.get_left(), node.get_right()
+        if risk_measure == 'variance':
+            risk_left = sum(cluster_risk[c] for c in np.unique(labels[left.pre_order()]))
+            risk_right = sum(cluster_risk[c] for c in np.unique(labels[right.pre_order()]))
+            alpha = 1 - risk_left / (risk_left + risk_right)
+        else:
+            alpha = 0.5
+        nodes.extend([(left, node_weight * alpha), (right, node_weight * (1 - alpha))])
+
+    return weights
@@ -0,0 +1,190 @@
+import threading
+import time
+
+import cvxpy as cp
+import numpy as np
+import pandas as pd
+
+from typing import Callable, Dict, List, Optional, Union
+from pypfopt import risk_models
+
+from dl_portfolio.logger import LOGGER
+from dl_portfolio.covariance import FactorCovariance
+
+DEFAULT_SOLVERS = ['ECOS', 'SCS', 'OSQP']
+
+
+class MarkowitzEngine:
+    """
+    Long only max Sharpe portfolio compiled once for a given asset universe. Following pypfopt, the problem is solved
+    with the change of variable y = w / k:
+
+        min_y ||L^T y||^2 s.t. (mu - rf)^T y = 1, y >= 0
+
+    where S = L L^T, and w = y / sum(y). mu - rf and L are cvxpy Parameters, so that the problem is compiled once and
+    each new fold only updates the parameters and warm-starts the solver from the previous solution. For a
+    FactorCovariance S = F F^T + diag(d), the objective ||F^T y||^2 + ||sqrt(d) * y||^2 is used instead, its size is
+    O(NK).
+
+    Each compiled problem has its own variable, parameters and constraints, and max_sharpe holds a lock of the engine
+    from the update of the parameters to the read of the solution, so that an engine can be shared by threads.
+    """
+
+    def __init__(self, assets: List[str], solvers: Optional[List[str]] = None):
+        """
+
+        :param assets: asset universe
+        :param solvers: solvers to try in this order, the first one that succeeds is used
+        """
+        self.assets = list(assets)
+        if solvers is None:
+            solvers = DEFAULT_SOLVERS
+        self.solvers = [s for s in solvers if s in cp.installed_solvers()]
+        if not self.solvers:
+            # Let cvxpy choose
+            self.solvers = [None]
+        self._lock = threading.Lock()
+        L = cp.Parameter((len(self.assets), len(self.assets)), name='L')
+        self._dense_problem = self._compile(lambda y: cp.sum_squares(L.T @ y), {'L': L})
+        self.problem = self._dense_problem['problem']
+        # Factor model problems, compiled at the first use for each number of factors
+        self._factor_problems = {}
+
+    def _compile(self, risk: Callable, parameters: Dict) -> Dict:
+        """
+        Compile the problem min risk(y) s.t. (mu - rf)^T y = 1, y >= 0 with its own variable, expected returns
+        parameter and constraints
+
+        :param risk: function of the variable y
+        :param parameters: cvxpy Parameters of risk, by name
+        :return: {'problem', 'y', 'excess_mu'} and parameters
+        """
+        excess_mu = cp.Parameter(len(self.assets), name='excess_mu')
+        y = cp.Variable(len(self.assets), name='y')
+        problem = cp.Problem(cp.Minimize(risk(y)), [excess_mu @ y == 1, y >= 0])
+        assert problem.is_dcp(dpp=True)
+        return dict(problem=problem, y=y, excess_mu=excess_mu, **parameters)
+
+    def _factor_problem(self, n_factors: int) -> Dict:
+        if n_factors not in self._factor_problems:
+            F = cp.Parameter((len(self.assets), n_factors), name='F')
+            sqrt_d = cp.Parameter(len(self.assets), nonneg=True, name='sqrt_d')
+            self._factor_problems[n_factors] = self._compile(
+                lambda y: cp.sum_squares(F.T @ y) + cp.sum_squares(cp.multiply(sqrt_d, y)), {'F': F, 'sqrt_d': sqrt_d})
+        return self._factor_problems[n_factors]
+
+    @staticmethod
+    def cov_factor(S: np.ndarray, fix_cov: bool = False) -> np.ndarray:
+        """
+        Return L such that S = L L^T. The spectral fix of pypfopt is only applied if S is not positive definite.
+
+        :param S: covariance matrix
+        :param fix_cov: always apply the spectral fix
+        :return:
+        """
+        if not fix_cov:
+            try:
+                return np.linalg.cholesky(S)
+            except np.linalg.LinAlgError:
+                LOGGER.debug("Covariance matrix is not positive definite, applying spectral fix")
+        S = risk_models.fix_nonpositive_semidefinite(pd.DataFrame(S), fix_method='spectral').values
+        eigval, eigvec = np.linalg.eigh(S)
+        return eigvec * np.sqrt(np.clip(eigval, 0, None))
+
+    def max_sharpe(self, mu: Union[pd.Series, np.ndarray], S: Union[pd.DataFrame, np.ndarray, FactorCovariance],
+                   fix_cov: bool = False, risk_free_rate: float = 0., fold=None,
+                   info: Optional[Dict] = None) -> pd.Series:
+        """
+
+        :param mu: expected returns
+        :param S: covariance matrix
+        :param fix_cov: always apply the spectral fix to S, not used for FactorCovariance which is PSD by construction
+        :param risk_free_rate:
+        :param fold: only used to label the solve information
+        :param info: if given, filled with the fold, solve time, status and solver, also when the solve fails
+        :return: weights
+        """
+        if isinstance(mu, pd.Series):
+            mu = mu.loc[self.assets]
+        if isinstance(S, pd.DataFrame):
+            S = S.loc[self.assets, self.assets]
+        excess_mu = np.asarray(mu, dtype=np.float64) - risk_free_rate
+        if not np.any(excess_mu > 0):
+            raise ValueError("at least one of the assets must have an expected return exceeding the risk-free rate")
+
+        start_time = time.time()
+        if isinstance(S, FactorCovariance):
+            S = FactorCovariance(S.loadings.loc[self.assets], S.factor_cov,
+                                 pd.Series(S.specific_var, index=S.index).loc[self.assets].values)
+            values = {'F': S.factor(), 'sqrt_d': np.sqrt(np.clip(S.specific_var, 0, None))}
+            with self._lock:
+                compiled = self._factor_problem(S.factor_cov.shape[0])
+        else:
+            values = {'L': self.cov_factor(np.asarray(S, dtype=np.float64), fix_cov=fix_cov)}
+            compiled = self._dense_problem
+        problem = compiled['problem']
+
+        weights = None
+        with self._lock:
+            compiled['excess_mu'].value = excess_mu
+            for name, value in values.items():
+                compiled[name].value = value
+            for solver in self.solvers:
+                try:
+                    problem.solve(solver=solver, warm_start=True)
+                except (cp.error.SolverError, ValueError) as _exc:
+                    LOGGER.debug(f"Markowitz with solver {solver} failed: {_exc}")
+                    continue
+                if problem.status in [cp.OPTIMAL, cp.OPTIMAL_INACCURATE] and compiled['y'].value is not None:
+                    y = np.clip(compiled['y'].value, 0, None)
+                    weights = pd.Series(y / np.sum(y), index=self.assets)
+                    break
+                LOGGER.debug(f"Markowitz with solver {solver} returned status {problem.status}")
+            status = problem.status
+
+        solve_info = {
+            'fold': fold,
+            'time': time.time() - start_time,
+            'status': status,
+            'solver': solver
+        }
+        if info is not None:
+            info.update(solve_info)
+        LOGGER.debug(f"Markowitz fold {fold}: {solve_info}")
+        if weights is None:
+            raise cp.error.SolverError(f"Markowitz failed with solvers {self.solvers}: {status}")
+
+        return weights
+
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_markowitz_engine(assets: List[str], solvers: Optional[List[str]] = None) -> MarkowitzEngine:
+    """
+    Return the engine of the asset universe, it is compiled at the first call and then reused by all folds, seeds and
+    threads running in the same process
+
+    :param assets:
+    :param solvers:
+    :return:
+    """
+    key = (tuple(assets), None if solvers is None else tuple(solvers))
+    with _ENGINES_LOCK:
+        if key not in _ENGINES:
+            LOGGER.debug(f"Compiling Markowitz engine for {len(assets)} assets")
+            _ENGINES[key] = MarkowitzEngine(assets, solvers=solvers)
+        return _ENGINES[key]
+
+
+def get_markowitz_history(cv_results: Dict) -> pd.DataFrame:
+    """
+    Solve time, status and solver of the Markowitz portfolios of every fold, collected by one_cv in res['markowitz']
+
+    :param cv_results: {cv: res}, result of get_cv_results
+    :return: pd.DataFrame with one row per fold and portfolio
+    """
+    history = [dict(portfolio=p, **cv_results[cv]['markowitz'][p]) for cv in cv_results
+               for p in cv_results[cv].get('markowitz', {})]
+    return pd.DataFrame(history, columns=['fold', 'portfolio', 'time', 'status', 'solver'])
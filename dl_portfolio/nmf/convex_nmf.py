@@ -5,7 +5,7 @@ from typing import Optional
 
 from dl_portfolio.logger import LOGGER
 from dl_portfolio.nmf.semi_nmf import SemiNMF
-from dl_portfolio.nmf.utils import negative_matrix, positive_matrix, reconstruction_error
+from dl_portfolio.nmf.utils import negative_matrix, positive_matrix, gram_reconstruction_error
 
 
 class ConvexNMF(SemiNMF):
@@ -16,7 +16,14 @@ class ConvexNMF(SemiNMF):
         self.G = G
         self.encoding = None
 
-    def fit(self, X, verbose: Optional[int] = None):
+    def fit(self, X, verbose: Optional[int] = None, gram: Optional[np.ndarray] = None):
+        """
+
+        :param X: data
+        :param verbose:
+        :param gram: X^T X, see SemiNMF.fit
+        :return:
+        """
         X = X.astype(np.float32)
 
         if verbose is not None:
@@ -24,28 +31,28 @@ class ConvexNMF(SemiNMF):
 
         start_time = time.time()
         self._check_params(X)
-        # Initialize G and F
+        n_samples = X.shape[0]
+        if gram is None:
+            gram = self.gram(X)
+        # Initialize G and W with F = X.dot(W)
         G, W = self._initilize_g_w(X, self.G)
-        F = X.dot(W)
 
         # used for the convergence criterion
-        error_at_init = reconstruction_error(X, F, G, loss=self.loss)
+        error_at_init = gram_reconstruction_error(gram, W, G, n_samples, loss=self.loss)
         previous_error = error_at_init
 
         for n_iter in range(self.max_iter):
             # Update G
-            G = self._update_g(X, G, F)
+            G = self._update_g(gram, G, W)
             # Update W
-            W = self._update_w(X, W, G)
-            # Update F
-            F = X.dot(W)
+            W = self._update_w(gram, W, G)
 
             if n_iter == self.max_iter - 1:
                 if self.verbose:
                     LOGGER.info('Reached max iteration number, stopping')
 
             if self.tol > 0 and n_iter % 10 == 0:
-                error = reconstruction_error(X, F, G, loss=self.loss)
+                error = gram_reconstruction_error(gram, W, G, n_samples, loss=self.loss)
 
                 if self.verbose:
                     iter_time = time.time()
@@ -84,9 +91,9 @@ class ConvexNMF(SemiNMF):
         return G, W
 
     @staticmethod
-    def _update_w(X, W, G):
-        X_TX_plus = positive_matrix(X.T.dot(X))
-        X_TX_minus = negative_matrix(X.T.dot(X))
+    def _update_w(gram, W, G):
+        X_TX_plus = positive_matrix(gram)
+        X_TX_minus = negative_matrix(gram)
 
         numerator = X_TX_plus.dot(G) + X_TX_minus.dot(W.dot(G.T.dot(G)))
         denominator = X_TX_minus.dot(G) + X_TX_plus.dot(W.dot(G.T.dot(G)))
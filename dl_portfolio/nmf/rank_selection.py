@@ -0,0 +1,123 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, Optional
+from joblib import Parallel, delayed
+
+from dl_portfolio.logger import LOGGER
+from dl_portfolio.data import get_features
+from dl_portfolio.cluster import get_cluster_labels, consensus_matrix, rand_score_permutation
+from dl_portfolio.nmf.convex_nmf import ConvexNMF
+from dl_portfolio.nmf.semi_nmf import SemiNMF
+
+
+def fit_rank(train_data: np.ndarray, test_data: np.ndarray, gram: np.ndarray, n_components: int, assets: List[str],
+             model_type: str = "convex_nmf", seeds: List[int] = [0, 1, 2], **kwargs) -> Dict:
+    """
+    Fit one NMF model per seed with n_components on a single fold, reusing the precomputed Gram matrix of the train
+    data.
+
+    :param train_data:
+    :param test_data:
+    :param gram: train_data^T train_data
+    :param n_components:
+    :param assets:
+    :param model_type: 'convex_nmf' or 'semi_nmf'
+    :param seeds: one model is fitted per seed, stability is measured across seeds
+    :param kwargs: passed to the model
+    :return:
+    """
+    start_time = time.time()
+    train_mse = []
+    test_mse = []
+    labels = {}
+    for i, seed in enumerate(seeds):
+        if model_type == "convex_nmf":
+            nmf = ConvexNMF(n_components=n_components, random_state=seed, **kwargs)
+        elif model_type == "semi_nmf":
+            nmf = SemiNMF(n_components=n_components, random_state=seed, **kwargs)
+        else:
+            raise NotImplementedError(model_type)
+        nmf.fit(train_data, gram=gram)
+        train_mse.append(nmf.evaluate(train_data))
+        test_mse.append(nmf.evaluate(test_data))
+        _, labels[i] = get_cluster_labels(pd.DataFrame(nmf.components, index=assets))
+
+    if len(seeds) > 1:
+        rand = rand_score_permutation(labels)
+        rand = np.mean(rand[np.triu_indices(len(seeds), k=1)])
+        cons_mat = consensus_matrix(labels).values
+        # Dispersion coefficient of the consensus matrix (Kim and Park, 2007): 1 for a perfectly stable clustering
+        dispersion = np.mean(4 * (cons_mat - 0.5) ** 2)
+    else:
+        rand = np.nan
+        dispersion = np.nan
+
+    return {
+        'train_mse': np.mean(train_mse),
+        'test_mse': np.mean(test_mse),
+        'rand_index': rand,
+        'dispersion': dispersion,
+        'time': time.time() - start_time
+    }
+
+
+def rank_selection(config, data: pd.DataFrame, assets: List[str], ranks: List[int], seeds: List[int] = [0, 1, 2],
+                   test_set: str = 'val', n_jobs: Optional[int] = None, **kwargs):
+    """
+    Fit ConvexNMF or SemiNMF (config.model_type) for every rank in ranks on every fold of config.data_specs. The
+    Gram matrix of the train data is computed once per fold and shared by all ranks and seeds, the (fold, rank) fits
+    run in parallel.
+
+    :param config: nmf config
+    :param data: prices
+    :param assets:
+    :param ranks: list of encoding_dim to evaluate
+    :param seeds: seeds used to measure the stability of the clusters for each rank
+    :param test_set: 'val' or 'test', data used to compute the out-of-sample reconstruction error
+    :param n_jobs: number of parallel jobs
+    :param kwargs: passed to the model
+    :return: tuple (summary, cv_results), summary is a pd.DataFrame with average metrics per rank and cv_results a
+    pd.DataFrame with metrics per (cv, rank)
+    """
+    assert test_set in ['val', 'test']
+
+    folds = {}
+    for cv in config.data_specs:
+        data_spec = config.data_specs[cv]
+        train_data, val_data, test_data, _, _, _ = get_features(data,
+                                                                data_spec['start'],
+                                                                data_spec['end'],
+                                                                assets,
+                                                                val_start=data_spec['val_start'],
+                                                                test_start=data_spec.get('test_start'),
+                                                                scaler='StandardScaler')
+        # The resampling used during training only shuffles blocks of rows, it does not change the Gram matrix
+        train_data = train_data.astype(np.float32)
+        folds[cv] = {
+            'train': train_data,
+            'test': val_data if test_set == 'val' else test_data,
+            'gram': SemiNMF.gram(train_data)
+        }
+
+    LOGGER.info(f"Fitting {config.model_type} for ranks {ranks} on {len(folds)} folds...")
+    tasks = [(cv, k) for cv in folds for k in ranks]
+    if n_jobs:
+        with Parallel(n_jobs=n_jobs) as _parallel_pool:
+            results = _parallel_pool(
+                delayed(fit_rank)(folds[cv]['train'], folds[cv]['test'], folds[cv]['gram'], k, assets,
+                                  model_type=config.model_type, seeds=seeds, **kwargs)
+                for cv, k in tasks
+            )
+    else:
+        results = [fit_rank(folds[cv]['train'], folds[cv]['test'], folds[cv]['gram'], k, assets,
+                            model_type=config.model_type, seeds=seeds, **kwargs) for cv, k in tasks]
+    LOGGER.info("Done.")
+
+    cv_results = pd.DataFrame(results, index=pd.MultiIndex.from_tuples(tasks, names=['cv', 'encoding_dim']))
+    summary = cv_results.groupby(level='encoding_dim').mean()
+    summary['total_time'] = cv_results['time'].groupby(level='encoding_dim').sum()
+
+    return summary, cv_results
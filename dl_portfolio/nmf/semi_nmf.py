@@ -8,7 +8,7 @@ from sklearn.base import BaseEstimator
 from sklearn.cluster import KMeans
 
 from dl_portfolio.logger import LOGGER
-from dl_portfolio.nmf.utils import negative_matrix, positive_matrix, reconstruction_error
+from dl_portfolio.nmf.utils import negative_matrix, positive_matrix, reconstruction_error, gram_reconstruction_error
 
 EPSILON = 1e-12
 
@@ -55,7 +55,15 @@ class SemiNMF(BaseEstimator):
 
         return self
 
-    def fit(self, X, verbose: Optional[int] = None):
+    def fit(self, X, verbose: Optional[int] = None, gram: Optional[np.ndarray] = None):
+        """
+
+        :param X: data
+        :param verbose:
+        :param gram: X^T X. The updates only depend on X through its Gram matrix, so it can be computed once and
+        shared between several fits on the same data (different ranks or seeds)
+        :return:
+        """
         X = X.astype(np.float32)
 
         if verbose is not None:
@@ -63,26 +71,29 @@ class SemiNMF(BaseEstimator):
 
         start_time = time.time()
         self._check_params(X)
-        # Initialize G and F
+        n_samples = X.shape[0]
+        if gram is None:
+            gram = self.gram(X)
+        # Initialize G and W with F = X.dot(W)
         G = self._initilize_g(X)
-        F = self._update_f(X, G)
+        W = self._least_square_w(G)
 
         # used for the convergence criterion
-        error_at_init = reconstruction_error(X, F, G, loss=self.loss)
+        error_at_init = gram_reconstruction_error(gram, W, G, n_samples, loss=self.loss)
         previous_error = error_at_init
 
         for n_iter in range(self.max_iter):
             # Update G
-            G = self._update_g(X, G, F)
-            # Update F
-            F = self._update_f(X, G)
+            G = self._update_g(gram, G, W)
+            # Update W
+            W = self._least_square_w(G)
 
             if n_iter == self.max_iter - 1:
                 if self.verbose:
                     LOGGER.info('Reached max iteration number, stopping')
 
             if self.tol > 0 and n_iter % 10 == 0:
-                error = reconstruction_error(X, F, G, loss=self.loss)
+                error = gram_reconstruction_error(gram, W, G, n_samples, loss=self.loss)
 
                 if self.verbose:
                     iter_time = time.time()
@@ -130,16 +141,24 @@ class SemiNMF(BaseEstimator):
         pickle.dump(self, open(path, "wb"))
 
     @staticmethod
-    def _update_f(X, G):
-        return X.dot(G.dot(np.linalg.inv(G.T.dot(G))))
+    def gram(X):
+        return np.dot(X.T.astype(np.float64), X.astype(np.float64))
+
+    @staticmethod
+    def _least_square_w(G):
+        # F = X.dot(W) is the least square solution given G
+        return G.dot(np.linalg.inv(G.T.dot(G)))
 
     @staticmethod
-    def _update_g(X, G, F):
-        F_TF_minus = negative_matrix(F.T.dot(F))
-        F_TF_plus = positive_matrix(F.T.dot(F))
+    def _update_g(gram, G, W):
+        X_TF = gram.dot(W)
+        F_TF = W.T.dot(X_TF)
+
+        F_TF_minus = negative_matrix(F_TF)
+        F_TF_plus = positive_matrix(F_TF)
 
-        X_TF_minus = negative_matrix(X.T.dot(F))
-        X_TF_plus = positive_matrix(X.T.dot(F))
+        X_TF_minus = negative_matrix(X_TF)
+        X_TF_plus = positive_matrix(X_TF)
 
         numerator = X_TF_plus + G.dot(F_TF_minus)
         denominator = X_TF_minus + G.dot(F_TF_plus)
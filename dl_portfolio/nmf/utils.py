@@ -21,3 +21,24 @@ def reconstruction_error(X, F, G, loss='mse'):
 def mean_squarred_error(y_true, y_pred):
     errors = np.average((y_true - y_pred) ** 2, axis=0)
     return np.average(errors)
+
+
+def gram_reconstruction_error(gram, W, G, n_samples, loss='mse'):
+    """
+    Reconstruction error of X ~ X.dot(W).dot(G.T) computed from the Gram matrix X^T X only, so that the cost does
+    not depend on the number of samples.
+
+    :param gram: X^T X
+    :param W: encoding matrix such that F = X.dot(W)
+    :param G: components
+    :param n_samples: number of rows of X
+    :param loss: only 'mse'
+    :return:
+    """
+    if loss == 'mse':
+        gram_w = gram.dot(W)
+        sse = np.trace(gram) - 2 * np.sum(gram_w * G) + np.sum(W.T.dot(gram_w) * G.T.dot(G))
+        loss = max(sse, 0.) / (n_samples * gram.shape[0])
+    else:
+        raise NotImplementedError(loss)
+    return loss
@@ -26,9 +26,11 @@ from .base import nonnegative_regression
 
 from .ridge import NonnegativeRidge
 from .ridge import nonnegative_ridge_regression
+from .ridge import nonnegative_ridge_path
 
 
 __all__ = ['NonnegativeLinear',
            'NonnegativeRidge',
            'nonnegative_regression',
-           'nonnegative_ridge_regression']
+           'nonnegative_ridge_regression',
+           'nonnegative_ridge_path']
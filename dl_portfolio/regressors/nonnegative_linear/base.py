@@ -4,6 +4,8 @@ Nonnegative Linear Regression.
 # Authors: Joseph Knox <josephk@alleninstitute.org>
 # License: Allen Institute Software License
 
+import numbers
+
 import numpy as np
 import scipy.optimize as sopt
 
@@ -15,19 +17,166 @@ from sklearn.utils import check_X_y
 from sklearn.utils import check_consistent_length
 
 
-def _solve_nnls(X, y):
+def _passive_solve(XtX, Xty, passive):
+    """Unconstrained least squares of each target on its passive set.
+
+    The targets are grouped by passive set, each group is solved with one
+    factorization of its Gram submatrix for all its targets (Van Benthem and
+    Keenan, 2004).
+
+    Parameters
+    ----------
+    XtX : array, shape = (n_features, n_features)
+
+    Xty : array, shape = (n_features, n_targets)
+
+    passive : boolean array, shape = (n_features, n_targets)
+
+    Returns
+    -------
+    s : array, shape = (n_features, n_targets)
+        Zero outside of the passive sets.
+    """
+    s = np.zeros_like(Xty)
+    patterns, group = np.unique(passive.T, axis=0, return_inverse=True)
+    group = group.ravel()
+    for g, pattern in enumerate(patterns):
+        if not pattern.any():
+            continue
+        cols = np.flatnonzero(group == g)
+        idx = np.ix_(pattern, cols)
+        try:
+            s[idx] = np.linalg.solve(XtX[np.ix_(pattern, pattern)], Xty[idx])
+        except np.linalg.LinAlgError:
+            s[idx] = np.linalg.lstsq(XtX[np.ix_(pattern, pattern)], Xty[idx], rcond=None)[0]
+    return s
+
+
+def _solve_nnls_gram(XtX, Xty, coef_init=None, max_iter=None, tol=1e-10):
+    """Solves the nonnegative least squares problem for all targets from the
+    normal equations.
+
+    Lawson-Hanson active set method on the normal equations (Bro and De Jong,
+    1997) run on the whole (n_features, n_targets) matrix: each iteration adds
+    one feature to the passive set of every target which is not optimal yet
+    and solves all the targets at once with _passive_solve. The cost only
+    depends on n_features and on the number of distinct passive sets.
+
+    Parameters
+    ----------
+    XtX : array, shape = (n_features, n_features)
+        Gram matrix, possibly regularized.
+
+    Xty : array, shape = (n_features, n_targets)
+
+    coef_init : array, shape = (n_targets, n_features), optional
+        Warm start: the active set method starts from its support.
+
+    max_iter : int, optional (default = 3 * n_features)
+        Maximum number of outer iterations of each target.
+
+    tol : float, optional (default = 1e-10)
+        Tolerance on the gradient, relative to the largest absolute value of
+        the column of Xty of the target.
+
+    Returns
+    -------
+    coef : array, shape = (n_targets, n_features)
+
+    n_iter : array, shape = (n_targets,)
+        Number of outer iterations of the active set method.
+    """
+    n_features, n_targets = Xty.shape
+    if max_iter is None:
+        max_iter = 3 * n_features
+    tol = tol * np.maximum(np.max(np.abs(Xty), axis=0), np.finfo(np.float64).tiny)
+
+    x = np.zeros((n_features, n_targets))
+    if coef_init is None:
+        passive = np.zeros((n_features, n_targets), dtype=bool)
+    else:
+        # warm start: drop the features with a non positive solution until the
+        # solution on the passive sets is feasible
+        passive = np.asarray(coef_init).reshape(n_targets, n_features).T > 0
+        while passive.any():
+            s = _passive_solve(XtX, Xty, passive)
+            if (s[passive] > 0).all():
+                x = s
+                break
+            passive &= s > 0
+
+    w = Xty - XtX.dot(x)
+    n_iter = np.zeros(n_targets, dtype=int)
+    todo = np.flatnonzero((~passive & (w > tol)).any(axis=0))
+    while todo.size:
+        n_iter[todo] += 1
+        # add the feature with the largest gradient to each passive set
+        best = np.argmax(np.where(passive[:, todo], -np.inf, w[:, todo]), axis=0)
+        passive[best, todo] = True
+        s = _passive_solve(XtX, Xty[:, todo], passive[:, todo])
+        # targets with an infeasible solution step back to the boundary of
+        # the feasible set and drop the features which reach zero
+        infeasible = (passive[:, todo] & (s <= 0)).any(axis=0)
+        while infeasible.any():
+            cols = todo[infeasible]
+            x_cols, s_cols = x[:, cols], s[:, infeasible]
+            neg = passive[:, cols] & (s_cols <= 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                alpha = np.min(np.where(neg, x_cols / (x_cols - s_cols), np.inf), axis=0)
+            x_cols = x_cols + alpha * (s_cols - x_cols)
+            passive[:, cols] &= x_cols > 0
+            x[:, cols] = np.where(passive[:, cols], x_cols, 0.)
+            s[:, infeasible] = _passive_solve(XtX, Xty[:, cols], passive[:, cols])
+            infeasible = (passive[:, todo] & (s <= 0)).any(axis=0)
+        x[:, todo] = s
+        w[:, todo] = Xty[:, todo] - XtX.dot(s)
+        todo = todo[(~passive[:, todo] & (w[:, todo] > tol[todo])).any(axis=0) & (n_iter[todo] < max_iter)]
+
+    return x.T, n_iter
+
+
+def _check_solver_params(max_iter, tol):
+    """Validates the max_iter and tol parameters of an estimator and returns
+    the ones which are set as solver keyword arguments."""
+    solver_kwargs = {}
+    if max_iter is not None:
+        if (isinstance(max_iter, bool) or not isinstance(max_iter, numbers.Integral)
+                or max_iter < 1):
+            raise ValueError('max_iter must be a positive integer, not %r'
+                             % (max_iter,))
+        solver_kwargs['max_iter'] = int(max_iter)
+    if tol is not None:
+        if isinstance(tol, bool) or not isinstance(tol, numbers.Real) or tol < 0:
+            raise ValueError('tol must be a nonnegative float, not %r' % (tol,))
+        solver_kwargs['tol'] = float(tol)
+    return solver_kwargs
+
+
+def _solve_nnls(X, y, solver='gram', coef_init=None, **solver_kwargs):
     if X.ndim != 2 or y.ndim != 2:
         raise ValueError("X and y must be 2d arrays! May have to reshape "
                          "X.reshape(-1, 1) or y.reshape(-1, 1).")
 
     n_features = X.shape[1]
     n_targets = y.shape[1]
+
+    if solver == 'gram':
+        # form X^T X and X^T y once for all targets
+        XtX = X.T.dot(X).astype(np.float64)
+        Xty = X.T.dot(y).astype(np.float64)
+        coef, _ = _solve_nnls_gram(XtX, Xty, coef_init=coef_init, **solver_kwargs)
+        # ||Xc - y||^2 = y^T y - 2 c^T X^T y + c^T X^T X c
+        sse = (np.sum(y.astype(np.float64) ** 2, axis=0) - 2 * np.sum(coef.T * Xty, axis=0)
+               + np.sum(coef.T * XtX.dot(coef.T), axis=0))
+        res = np.sqrt(np.maximum(sse, 0.))
+        return coef.astype(X.dtype), res
+
     coef = np.empty((n_targets, n_features), dtype=X.dtype)
     res = np.empty(n_targets, dtype=np.float64)
 
     for i in range(n_targets):
         y_column = y[:, i]
-        info = sopt.nnls(X, y_column)
+        info = sopt.nnls(X, y_column, maxiter=solver_kwargs.get('max_iter'))
 
         coef[i] = info[0]
         res[i] = info[1]
@@ -35,12 +184,14 @@ def _solve_nnls(X, y):
     return coef, res
 
 
-def nonnegative_regression(X, y, sample_weight=None):
+def nonnegative_regression(X, y, sample_weight=None, solver='gram',
+                           coef_init=None, **solver_kwargs):
     r"""Solve the nonnegative least squares estimate regression problem.
 
     Solves :math:`\underset{x}{\text{argmin}} \| Ax - b \|_2^2` subject to :math:`x \geq 0`
-    using `scipy.optimize.nnls <https://docs.scipy.org/doc/scipy/reference/
-    generated/scipy.optimize.nnls.html>`_
+    either on the normal equations for all targets at once (``solver='gram'``)
+    or target by target with `scipy.optimize.nnls <https://docs.scipy.org/doc/scipy/reference/
+    generated/scipy.optimize.nnls.html>`_ (``solver='scipy'``)
 
     Parameters
     ----------
@@ -53,6 +204,19 @@ def nonnegative_regression(X, y, sample_weight=None):
     sample_weight : float or array-like, shape (n_samples,), optional (default = None)
         Individual weights for each sample.
 
+    solver : string, optional (default = 'gram')
+        'gram' forms :math:`X^TX` and :math:`X^Ty` once and solves every
+        target with an active set method on the normal equations, the cost of
+        the solves scales with n_features instead of n_samples. 'scipy' calls
+        scipy.optimize.nnls for each target.
+
+    coef_init : array, shape = (n_features,) or (n_targets, n_features), optional
+        Warm start of the 'gram' solver, for example the coefficients of the
+        previous fold.
+
+    **solver_kwargs
+        max_iter and tol of the 'gram' solver, max_iter only for 'scipy'.
+
     Returns
     -------
     coef : array, shape = (n_features,) or (n_samples, n_features)
@@ -88,7 +252,11 @@ def nonnegative_regression(X, y, sample_weight=None):
 
         X, y = _rescale_data(X, y, sample_weight)
 
-    coef, res = _solve_nnls(X, y)
+    if solver not in ('gram', 'scipy'):
+        raise ValueError('solver must be one of gram, scipy, not %s' % solver)
+
+    coef, res = _solve_nnls(X, y, solver=solver, coef_init=coef_init,
+                            **solver_kwargs)
 
     if ravel:
         # When y was passed as 1d-array, we flatten the coefficients
@@ -104,6 +272,20 @@ class NonnegativeLinear(LinearModel, RegressorMixin):
     nonnegative linear least squares function. This estimator has built-in
     support for mulitvariate regression.
 
+    Parameters
+    ----------
+    solver : string, optional (default = 'gram')
+        'gram' or 'scipy', see nonnegative_regression.
+
+    max_iter : int, optional (default = None)
+        Maximum number of iterations of each target, None for the default of
+        the solver (3 * n_features for both solvers).
+
+    tol : float, optional (default = None)
+        Tolerance of the 'gram' solver on the gradient, relative to the
+        largest absolute value of :math:`X^Ty` for each target, None for
+        1e-10. Not supported by 'scipy'.
+
     Attributes
     ----------
     coef_ : array, shape = (n_features,) or (n_features, n_targets)
@@ -130,7 +312,15 @@ class NonnegativeLinear(LinearModel, RegressorMixin):
     # needed for compatibility with LinearModel.predict() (decision_function)
     intercept_ = 0.0
 
-    def fit(self, X, y, sample_weight=None):
+    def __init__(self, solver='gram', max_iter=None, tol=None):
+        if solver not in ('gram', 'scipy'):
+            raise ValueError('solver must be one of gram, scipy, not %s'
+                             % solver)
+        self.solver = solver
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def fit(self, X, y, sample_weight=None, coef_init=None):
         """Fit nonnegative least squares linear model.
 
         Parameters
@@ -144,6 +334,9 @@ class NonnegativeLinear(LinearModel, RegressorMixin):
         sample_weight : float or array-like, shape (n_samples,), optional (default = None)
             Individual weights for each sample.
 
+        coef_init : array, shape = (n_features,) or (n_targets, n_features), optional
+            Warm start of the 'gram' solver.
+
         Returns
         -------
         self : returns an instance of self.
@@ -158,8 +351,13 @@ class NonnegativeLinear(LinearModel, RegressorMixin):
                 np.atleast_1d(sample_weight).ndim > 1):
             raise ValueError("Sample weights must be 1D array or scalar")
 
+        solver_kwargs = _check_solver_params(self.max_iter, self.tol)
+        if self.solver == 'scipy' and 'tol' in solver_kwargs:
+            raise ValueError("tol is not supported by the scipy solver")
+
         # fit weights
         self.coef_, self.res_ = nonnegative_regression(
-            X, y, sample_weight=sample_weight)
+            X, y, sample_weight=sample_weight, solver=self.solver,
+            coef_init=coef_init, **solver_kwargs)
 
         return self
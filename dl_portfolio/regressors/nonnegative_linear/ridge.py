@@ -18,10 +18,27 @@ from sklearn.utils import check_X_y
 from sklearn.utils import check_consistent_length
 
 from dl_portfolio.regressors.nonnegative_linear.base import NonnegativeLinear
+from dl_portfolio.regressors.nonnegative_linear.base import _check_solver_params
+from dl_portfolio.regressors.nonnegative_linear.base import _solve_nnls_gram
 
+SOLVERS = ('gram', 'L-BFGS-B', 'TNC', 'SLSQP')
 
-def _solve_ridge_nnls(A, b, alpha, solver, **solver_kwargs):
+
+def _solve_ridge_nnls(A, b, alpha, solver, coef_init=None, **solver_kwargs):
     """Solves nonnegative ridge regressiond through quadratic programming."""
+    n_features = A.shape[1]
+    n_targets = b.shape[1]
+
+    if solver == 'gram':
+        # x^T Q x - 2 (A^T b)^T x shares Q = A^T A + diag(alpha^2) between
+        # all targets, which are solved together by each active set iteration
+        Q = A.T.dot(A).astype(np.float64) + np.diag(alpha.astype(np.float64)**2)
+        Atb = A.T.dot(b).astype(np.float64)
+        coef, _ = _solve_nnls_gram(Q, Atb, coef_init=coef_init, **solver_kwargs)
+        res = (np.sum(coef.T * Q.dot(coef.T), axis=0) - 2*np.sum(coef.T * Atb, axis=0)
+               + np.sum(b.astype(np.float64)**2, axis=0))
+        return coef.astype(A.dtype), res.astype(A.dtype)
+
     # compute R^T R is more numerically stable than A^T A
     # 'r' mode returns tuple: (R,)
     R = linalg.qr(A, overwrite_a=False, mode='r', check_finite=False)[0]
@@ -31,15 +48,16 @@ def _solve_ridge_nnls(A, b, alpha, solver, **solver_kwargs):
     C = -2*A.T.dot(b)
 
     # define loss and gradient functions
-    loss = lambda x: x.T.dot(Q).dot(x) + c.dot(x)
-    grad = lambda x: (Q.T + Q).dot(x) + c
+    def loss(x, c):
+        return x.T.dot(Q).dot(x) + c.dot(x)
 
-    n_features = A.shape[1]
-    n_targets = b.shape[1]
+    def grad(x, c):
+        return (Q.T + Q).dot(x) + c
 
     # sopt.minimize params
-    x0 = np.ones(n_features)
     bounds = tuple(zip(n_features*[0.0], n_features*[None]))
+    if coef_init is not None:
+        coef_init = np.asarray(coef_init).reshape(n_targets, n_features)
 
     # return arrays
     coef = np.empty((n_targets, n_features), dtype=A.dtype)
@@ -47,8 +65,9 @@ def _solve_ridge_nnls(A, b, alpha, solver, **solver_kwargs):
 
     for i in range(n_targets):
         c = C[:, i]
-        sol = sopt.minimize(loss, x0, jac=grad, method=solver, bounds=bounds,
-                            **solver_kwargs)
+        x0 = np.ones(n_features) if coef_init is None else coef_init[i]
+        sol = sopt.minimize(loss, x0, args=(c,), jac=grad, method=solver,
+                            bounds=bounds, **solver_kwargs)
 
         if not sol.success:
             warnings.warn('Optimization was not a success for column %d, '
@@ -61,7 +80,8 @@ def _solve_ridge_nnls(A, b, alpha, solver, **solver_kwargs):
 
 
 def nonnegative_ridge_regression(X, y, alpha, sample_weight=None,
-                                 solver='SLSQP', **solver_kwargs):
+                                 solver='gram', coef_init=None,
+                                 **solver_kwargs):
     r"""Solve the nonnegative least squares estimate ridge regression problem.
 
     Solves
@@ -98,14 +118,19 @@ def nonnegative_ridge_regression(X, y, alpha, sample_weight=None,
     sample_weight : float or array-like, shape (n_samples,), optional (default = None)
         Individual weights for each sample.
 
-    solver : string, optional (default = 'SLSQP')
-        Solver with which to solve the QP. Must be one that supports bounds
-        (i.e. 'L-BFGS-B', 'TNC', 'SLSQP').
+    solver : string, optional (default = 'gram')
+        Solver with which to solve the QP. 'gram' solves all the targets on
+        the shared matrix Q with an active set method. Otherwise the QP is
+        solved target by target with scipy.optimize.minimize and must be a
+        method that supports bounds (i.e. 'L-BFGS-B', 'TNC', 'SLSQP').
+
+    coef_init : array, shape = (n_features,) or (n_targets, n_features), optional
+        Warm start, for example the solution for another alpha or fold.
 
     **solver_kwargs
-        See `scipy.optimize.minimize <https://docs.scipy.org/doc/scipy/
-        reference/generated/scipy.optimize.minimize.html>`_
-        for valid keyword arguments
+        max_iter and tol for 'gram', otherwise see `scipy.optimize.minimize
+        <https://docs.scipy.org/doc/scipy/reference/generated/
+        scipy.optimize.minimize.html>`_ for valid keyword arguments
 
     Returns
     -------
@@ -130,8 +155,8 @@ def nonnegative_ridge_regression(X, y, alpha, sample_weight=None,
     --------
     nonnegative_regression
     """
-    if solver not in ('L-BFGS-B', 'TNC', 'SLSQP'):
-        raise ValueError('solver must be one of L-BFGS-B, TNC, SLSQP, '
+    if solver not in SOLVERS:
+        raise ValueError('solver must be one of gram, L-BFGS-B, TNC, SLSQP, '
                          'not %s' % solver)
 
     # TODO accept_sparse=['csr', 'csc', 'coo']? check sopt.nnls
@@ -172,7 +197,8 @@ def nonnegative_ridge_regression(X, y, alpha, sample_weight=None,
     if alpha.size == 1 and n_features > 1:
         alpha = np.repeat(alpha, n_features)
 
-    coef, res = _solve_ridge_nnls(X, y, alpha, solver, **solver_kwargs)
+    coef, res = _solve_ridge_nnls(X, y, alpha, solver, coef_init=coef_init,
+                                  **solver_kwargs)
 
     if ravel:
         # When y was passed as 1d-array, we flatten the coefficients
@@ -196,14 +222,19 @@ class NonnegativeRidge(NonnegativeLinear):
         conditioning of the problem and reduces the variance of the estimates.
         Larger values specify stronger regularization.
 
-    solver : string, optional (default = 'SLSQP')
-        Solver with which to solve the QP. Must be one that supports bounds
+    solver : string, optional (default = 'gram')
+        Solver with which to solve the QP, 'gram' or one of the
+        scipy.optimize.minimize methods that supports bounds
         (i.e. 'L-BFGS-B', 'TNC', 'SLSQP').
 
-    **solver_kwargs
-        See `scipy.optimize.minimize <https://docs.scipy.org/doc/scipy/
-        reference/generated/scipy.optimize.minimize.html>`_
-        for valid keyword arguments
+    max_iter : int, optional (default = None)
+        Maximum number of iterations of each target, None for the default of
+        the solver. Passed as the maxiter option of `scipy.optimize.minimize
+        <https://docs.scipy.org/doc/scipy/reference/generated/
+        scipy.optimize.minimize.html>`_ for the scipy methods.
+
+    tol : float, optional (default = None)
+        Tolerance of the solver, None for the default of the solver.
 
 
     Attributes
@@ -243,15 +274,16 @@ class NonnegativeRidge(NonnegativeLinear):
     NonnegativeLinear
     """
 
-    def __init__(self, alpha=1.0, solver='SLSQP', **solver_kwargs):
-        if solver not in ('L-BFGS-B', 'TNC', 'SLSQP'):
-            raise ValueError('solver must be one of L-BFGS-B, TNC, SLSQP, '
-                             'not %s' % solver)
+    def __init__(self, alpha=1.0, solver='gram', max_iter=None, tol=None):
+        if solver not in SOLVERS:
+            raise ValueError('solver must be one of gram, L-BFGS-B, TNC, '
+                             'SLSQP, not %s' % solver)
         self.alpha = alpha
         self.solver = solver
-        self.solver_kwargs = solver_kwargs
+        self.max_iter = max_iter
+        self.tol = tol
 
-    def fit(self, X, y, sample_weight=None):
+    def fit(self, X, y, sample_weight=None, coef_init=None):
         """Fit nonnegative least squares linear model with L2 regularization.
 
         Parameters
@@ -265,6 +297,9 @@ class NonnegativeRidge(NonnegativeLinear):
         sample_weight : float or array-like, shape (n_samples,), optional (default = None)
             Individual weights for each sample.
 
+        coef_init : array, shape = (n_features,) or (n_targets, n_features), optional
+            Warm start of the solver.
+
         Returns
         -------
         self : returns an instance of self.
@@ -279,9 +314,70 @@ class NonnegativeRidge(NonnegativeLinear):
                 np.atleast_1d(sample_weight).ndim > 1):
             raise ValueError("Sample weights must be 1D array or scalar")
 
+        solver_kwargs = _check_solver_params(self.max_iter, self.tol)
+        if self.solver != 'gram' and 'max_iter' in solver_kwargs:
+            solver_kwargs['options'] = {'maxiter': solver_kwargs.pop('max_iter')}
+
         # fit weights
         self.coef_, self.res_ = nonnegative_ridge_regression(
             X, y, self.alpha, sample_weight=sample_weight,
-            solver=self.solver, **self.solver_kwargs)
+            solver=self.solver, coef_init=coef_init, **solver_kwargs)
 
         return self
+
+
+def nonnegative_ridge_path(X, y, alphas, **solver_kwargs):
+    r"""Compute the nonnegative ridge regression path.
+
+    :math:`X^TX` and :math:`X^Ty` are computed once, the alphas are solved in
+    descending order and each solution is warm started from the previous one.
+
+    Parameters
+    ----------
+    X : array, shape = (n_samples, n_features)
+        Training data.
+
+    y : array, shape = (n_samples,) or (n_samples, n_targets)
+        Target values.
+
+    alphas : array, shape = (n_alphas,)
+        Regularization strengths, see nonnegative_ridge_regression.
+
+    **solver_kwargs
+        max_iter and tol of the active set method.
+
+    Returns
+    -------
+    alphas : array, shape = (n_alphas,)
+        The alphas in descending order.
+
+    coefs : array, shape = (n_features, n_alphas) or (n_targets, n_features, n_alphas)
+        Coefficients along the path.
+    """
+    X = check_array(X)
+    y = check_array(y, ensure_2d=False)
+    check_consistent_length(X, y)
+
+    ravel = False
+    if y.ndim == 1:
+        y = y.reshape(-1, 1)
+        ravel = True
+
+    n_features = X.shape[1]
+    n_targets = y.shape[1]
+
+    alphas = np.sort(np.asarray(alphas, dtype=np.float64).ravel())[::-1]
+    XtX = X.T.dot(X).astype(np.float64)
+    Xty = X.T.dot(y).astype(np.float64)
+
+    coefs = np.empty((n_targets, n_features, len(alphas)), dtype=X.dtype)
+    coef = None
+    for i, alpha in enumerate(alphas):
+        Q = XtX + alpha**2 * np.eye(n_features)
+        coef, _ = _solve_nnls_gram(Q, Xty, coef_init=coef, **solver_kwargs)
+        coefs[:, :, i] = coef
+
+    if ravel:
+        coefs = coefs[0]
+
+    return alphas, coefs
@@ -0,0 +1,204 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from typing import List, Optional, Union
+
+from dl_portfolio.logger import LOGGER
+
+
+def _pad(covs: List[np.ndarray], budgets: List[np.ndarray]):
+    """
+    Stack problems of different sizes in a batch. Padded assets have a unit variance, no covariance with the other
+    assets and a null budget, so their weight is 0.
+
+    :param covs: list of covariance matrices
+    :param budgets: list of risk budgets
+    :return: cov (n_problems, n_max, n_max), budget (n_problems, n_max), sizes (n_problems)
+    """
+    sizes = np.array([len(b) for b in budgets])
+    n_max = np.max(sizes)
+    cov = np.tile(np.eye(n_max), (len(covs), 1, 1))
+    budget = np.zeros((len(covs), n_max))
+    for k, (c, b) in enumerate(zip(covs, budgets)):
+        n = sizes[k]
+        assert np.shape(c) == (n, n), f"Covariance and budget of problem {k} have incompatible shapes"
+        cov[k, :n, :n] = c
+        budget[k, :n] = b
+    return cov, budget, sizes
+
+
+def _objective(x: np.ndarray, cov: np.ndarray, budget: np.ndarray) -> np.ndarray:
+    log_x = np.log(np.where(budget > 0, x, 1.))
+    return 0.5 * np.einsum('bi,bij,bj->b', x, cov, x) - np.sum(budget * log_x, axis=1)
+
+
+def riskparity_batch(covs: Union[np.ndarray, List[np.ndarray]], budgets: Union[np.ndarray, List[np.ndarray]],
+                     x0: Optional[np.ndarray] = None, tol: float = 1e-10, max_iter: int = 100):
+    """
+    Solve a batch of budgeted risk parity problems with Newton's method on the convex formulation of Spinu (2013):
+
+        min_{x > 0} 0.5 x^T S x - sum_i b_i log(x_i)
+
+    The solution normalized to sum to one has risk contributions equal to b. The Newton steps of all problems are
+    computed at once with a batched linear solve, with a backtracking line search per problem to keep x > 0.
+
+    :param covs: covariance matrices, array (n_problems, n_assets, n_assets) or list of arrays of different sizes
+    :param budgets: risk budgets, they are normalized to sum to one
+    :param x0: initial weights with the same shape as budgets, for example the solution of the previous period
+    :param tol: stop when the largest relative Newton step of every problem is smaller than tol
+    :param max_iter: maximum number of Newton steps
+    :return: weights, array (n_problems, n_assets) or list of arrays if covs is a list
+    """
+    is_list = isinstance(covs, (list, tuple))
+    if is_list:
+        cov, budget, sizes = _pad([np.asarray(c, dtype=np.float64) for c in covs],
+                                  [np.asarray(b, dtype=np.float64) for b in budgets])
+        if x0 is not None:
+            x0_ = np.zeros_like(budget)
+            for k, x in enumerate(x0):
+                x0_[k, :len(x)] = x
+            x0 = x0_
+    else:
+        cov = np.asarray(covs, dtype=np.float64)
+        budget = np.asarray(budgets, dtype=np.float64)
+        if cov.ndim == 2:
+            cov, budget = cov[None, :, :], budget[None, :]
+        sizes = None
+    assert cov.shape[:2] == budget.shape and cov.shape[1] == cov.shape[2]
+    assert np.all(budget >= 0) and np.all(np.sum(budget, axis=1) > 0)
+    budget = budget / np.sum(budget, axis=1, keepdims=True)
+    active = budget > 0
+    # The weights do not depend on the scale of the covariance, rescale it to have unit average variance
+    cov = cov / np.mean(np.diagonal(cov, axis1=1, axis2=2), axis=1)[:, None, None]
+    # Assets with a null budget are out of the problem: neutralise them like the padded assets of _pad (unit variance,
+    # no covariance with the other assets), so that they do not move the weights of the active assets
+    pair_active = active[:, :, None] & active[:, None, :]
+    cov = np.where(pair_active, cov, 0.) + np.einsum('bi,ij->bij', (~active).astype(np.float64), np.eye(cov.shape[1]))
+
+    if x0 is None:
+        # Inverse volatility weights
+        x = budget / np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    else:
+        x = np.where(active, np.clip(np.asarray(x0, dtype=np.float64).reshape(budget.shape), 1e-12, None), 0.)
+    # The solution satisfies x^T S x = sum(b) = 1, start from the same scale
+    x = x / np.sqrt(np.einsum('bi,bij,bj->b', x, cov, x))[:, None]
+
+    converged = np.zeros(len(x), dtype=bool)
+    for n_iter in range(1, max_iter + 1):
+        safe_x = np.where(active, x, 1.)
+        grad = np.einsum('bij,bj->bi', cov, x) - budget / safe_x
+        hess = cov + np.einsum('bi,ij->bij', budget / safe_x ** 2, np.eye(x.shape[1]))
+        step = - np.linalg.solve(hess, grad[:, :, None])[:, :, 0]
+        step = np.where(active, step, 0.)
+        decrement = - np.sum(grad * step, axis=1)
+        converged = np.max(np.abs(step) / safe_x, axis=1) < tol
+        if np.all(converged):
+            x = x + step
+            break
+
+        # Backtracking line search, only on the problems which have not converged
+        f = _objective(x, cov, budget)
+        t = np.where(converged, 0., 1.)
+        for _ in range(50):
+            x_new = x + t[:, None] * step
+            feasible = np.all((x_new > 0) | ~active, axis=1)
+            # Close to the solution the decrease of the objective is below its rounding error: take the pure Newton
+            # step as long as it is feasible
+            check = feasible & (decrement > 1e-10)
+            ok = feasible.copy()
+            ok[check] = _objective(x_new[check], cov[check], budget[check]) <= f[check] - 0.25 * t[check] * decrement[
+                check]
+            ok |= converged
+            if np.all(ok):
+                break
+            t = np.where(ok, t, t / 2)
+        x = x + t[:, None] * step
+    if not np.all(converged):
+        LOGGER.warning(f"Risk parity did not converge after {max_iter} iterations for {np.sum(~converged)} problems")
+    x = np.where(active, x, 0.)
+    x = x / np.sum(x, axis=1, keepdims=True)
+
+    if is_list:
+        return [x[k, :n] for k, n in enumerate(sizes)]
+    return x
+
+
+def risk_contribution(weights: np.ndarray, cov: np.ndarray) -> np.ndarray:
+    """
+    Relative risk contributions w_i (S w)_i / w^T S w
+
+    :param weights: (n_assets) or (n_problems, n_assets)
+    :param cov: (n_assets, n_assets) or (n_problems, n_assets, n_assets)
+    :return:
+    """
+    rc = weights * np.einsum('...ij,...j->...i', cov, weights)
+    return rc / np.sum(rc, axis=-1, keepdims=True)
+
+
+def riskparity(cov: Union[pd.DataFrame, np.ndarray], budget: np.ndarray, **kwargs) -> np.ndarray:
+    """
+    Budgeted risk parity weights for a single covariance matrix, see riskparity_batch
+
+    :param cov:
+    :param budget:
+    :return:
+    """
+    return riskparity_batch(np.asarray(cov)[None, :, :], np.asarray(budget)[None, :], **kwargs)[0]
+
+
+def benchmark_riskparity(n_problems: int = 100, n_assets: List[int] = [2, 5, 10, 30], n_obs: int = 250,
+                         seed: Optional[int] = None) -> pd.DataFrame:
+    """
+    Compare riskparity_batch with riskparityportfolio (one RiskParityPortfolio per problem) on random covariance
+    matrices and budgets
+
+    :param n_problems: number of problems for each size
+    :param n_assets: problem sizes
+    :param n_obs: number of observations used to sample the covariance matrices
+    :param seed:
+    :return: pd.DataFrame with the time of both solvers, the max absolute difference between their weights, the max
+    error of the risk contributions with respect to the budget and the max difference between the weights of problems
+    with a null budget on the first asset and the weights of the same problems without this asset, for each size
+    """
+    import riskparityportfolio as rp
+
+    rng = np.random.default_rng(seed)
+    results = {}
+    for n in n_assets:
+        covs = []
+        budgets = []
+        for _ in range(n_problems):
+            returns = rng.standard_normal((n_obs, n)) @ rng.standard_normal((n, n)) * 0.01
+            covs.append(np.cov(returns, rowvar=False))
+            budget = rng.uniform(0.1, 1, n)
+            budgets.append(budget / np.sum(budget))
+        covs = np.array(covs)
+        budgets = np.array(budgets)
+
+        t0 = time.time()
+        weights = riskparity_batch(covs, budgets)
+        t1 = time.time()
+        rp_weights = np.array([rp.RiskParityPortfolio(covariance=c, budget=b).weights for c, b in zip(covs, budgets)])
+        t2 = time.time()
+
+        # A null budget must give the same weights as the problem without the asset
+        zero_budgets = budgets.copy()
+        zero_budgets[:, 0] = 0.
+        zero_weights = riskparity_batch(covs, zero_budgets)
+        sub_weights = riskparity_batch(covs[:, 1:, 1:], zero_budgets[:, 1:]) if n > 1 else zero_weights[:, 1:]
+
+        results[n] = {
+            'time': t1 - t0,
+            'rp_time': t2 - t1,
+            'max_weight_diff': np.max(np.abs(weights - rp_weights)),
+            'max_rc_error': np.max(np.abs(risk_contribution(weights, covs) - budgets)),
+            'rp_max_rc_error': np.max(np.abs(risk_contribution(rp_weights, covs) - budgets)),
+            'zero_budget_error': np.max(np.abs(zero_weights[:, 1:] - sub_weights))
+        }
+    results = pd.DataFrame(results).T
+    results.index.name = 'n_assets'
+    results['speedup'] = results['rp_time'] / results['time']
+
+    return results
@@ -0,0 +1,236 @@
+import numpy as np
+import pandas as pd
+
+from typing import Dict, Optional, Tuple, Union
+
+
+def _as_array(perf: Union[pd.DataFrame, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    float64 values of perf with NaN replaced by 0 and the mask of the NaN, (n_obs, n_strategies)
+    """
+    values = np.asarray(perf, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    missing = np.isnan(values)
+    return np.where(missing, 0., values), missing
+
+
+def _window_sum(x: np.ndarray, window: int) -> np.ndarray:
+    """
+    Sum of x over the rolling windows ending at window - 1, ..., n_obs - 1, from cumulative sums
+
+    :param x: (n_obs, n_strategies)
+    :param window:
+    :return: (n_obs - window + 1, n_strategies)
+    """
+    cumsum = np.concatenate([np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)])
+    return cumsum[window:] - cumsum[:-window]
+
+
+def _to_output(stat: np.ndarray, missing: np.ndarray, window: int, perf) -> Union[pd.DataFrame, np.ndarray]:
+    """
+    Pad the first window - 1 observations with NaN like pd.DataFrame.rolling and set the windows containing missing
+    returns to NaN
+    """
+    stat = np.where(_window_sum(missing.astype(np.float64), window) > 0, np.nan, stat)
+    stat = np.concatenate([np.full((window - 1, stat.shape[1]), np.nan), stat])
+    if isinstance(perf, pd.DataFrame):
+        return pd.DataFrame(stat, index=perf.index, columns=perf.columns)
+    return stat
+
+
+def rolling_moments(perf: Union[pd.DataFrame, np.ndarray], window: int) -> Tuple:
+    """
+    Rolling mean and variance (ddof=1) of all strategies from the cumulative sums of the returns and of their squares,
+    O(n_obs * n_strategies) whatever the window. The returns are centered on their full sample mean first to limit the
+    cancellation in the variance.
+
+    :param perf: returns, (n_obs, n_strategies)
+    :param window:
+    :return: mean, variance
+    """
+    assert 1 < window <= len(perf)
+    values, missing = _as_array(perf)
+    center = values.mean(0)
+    values = values - center
+    s1 = _window_sum(values, window)
+    s2 = _window_sum(values ** 2, window)
+    mean = s1 / window
+    var = np.maximum(s2 - s1 * mean, 0.) / (window - 1)
+    return _to_output(mean + center, missing, window, perf), _to_output(var, missing, window, perf)
+
+
+def rolling_volatility(perf: Union[pd.DataFrame, np.ndarray], window: int, period: int = 1):
+    _, var = rolling_moments(perf, window)
+    return np.sqrt(var * period)
+
+
+def rolling_sharpe_ratio(perf: Union[pd.DataFrame, np.ndarray], window: int, period: int = 1):
+    mean, var = rolling_moments(perf, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return mean / np.sqrt(var) * np.sqrt(period)
+
+
+def _block_scans(log_perf: np.ndarray, window: int) -> Tuple:
+    """
+    Prefix and suffix scans of (max, min, max drawdown) of the log performance inside blocks of window observations
+    (van Herk/Gil-Werman)
+
+    :param log_perf: (n_obs, n_strategies)
+    :param window:
+    :return: prefix (max, min, mdd), suffix (max, min, mdd), each (n_blocks * window, n_strategies)
+    """
+    n_obs, n_strategies = log_perf.shape
+    n_blocks = -(-n_obs // window)
+    padded = np.concatenate([log_perf, np.repeat(log_perf[-1:], n_blocks * window - n_obs, axis=0)])
+    blocks = padded.reshape(n_blocks, window, n_strategies)
+
+    pre_max = np.maximum.accumulate(blocks, axis=1)
+    pre_min = np.minimum.accumulate(blocks, axis=1)
+    pre_mdd = np.maximum.accumulate(pre_max - blocks, axis=1)
+
+    # Scans on the reversed blocks: the drawdown from a to b > a is the rise from b to a in reversed order
+    reverse = blocks[:, ::-1]
+    suf_max = np.maximum.accumulate(reverse, axis=1)[:, ::-1]
+    suf_min = np.minimum.accumulate(reverse, axis=1)[:, ::-1]
+    suf_mdd = np.maximum.accumulate(reverse - np.minimum.accumulate(reverse, axis=1), axis=1)[:, ::-1]
+
+    shape = (n_blocks * window, n_strategies)
+    return ((pre_max.reshape(shape), pre_min.reshape(shape), pre_mdd.reshape(shape)),
+            (suf_max.reshape(shape), suf_min.reshape(shape), suf_mdd.reshape(shape)))
+
+
+def rolling_mdd(perf: Union[pd.DataFrame, np.ndarray], window: int):
+    """
+    Maximum drawdown of the cumulative performance on each rolling window, same definition as
+    dl_portfolio.backtest.get_mdd(np.cumprod(perf + 1)) on the window.
+
+    (max, min, max drawdown) of a segment is an associative summary: the window [s, t] is the combination of the
+    suffix of the block of s and the prefix of the block of t, so the rolling max drawdown of all strategies costs
+    O(n_obs * n_strategies) vectorized operations whatever the window.
+
+    :param perf: returns, (n_obs, n_strategies)
+    :param window:
+    :return:
+    """
+    assert 1 < window <= len(perf)
+    values, missing = _as_array(perf)
+    log_perf = np.cumsum(np.log1p(values), axis=0)
+    (_, pre_min, pre_mdd), (suf_max, _, suf_mdd) = _block_scans(log_perf, window)
+
+    start = np.arange(len(values) - window + 1)
+    end = start + window - 1
+    mdd = np.maximum(np.maximum(suf_mdd[start], pre_mdd[end]), suf_max[start] - pre_min[end])
+    # Windows starting at the beginning of a block are the block itself
+    aligned = (start % window == 0)[:, None]
+    mdd = np.where(aligned, suf_mdd[start], mdd)
+
+    return _to_output(1. - np.exp(- mdd), missing, window, perf)
+
+
+def _window_view(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    Read-only view of the rolling windows of values, without copy
+
+    :param values: (n_obs, n_strategies)
+    :param window:
+    :return: (n_obs - window + 1, window, n_strategies)
+    """
+    n_obs, n_strategies = values.shape
+    values = np.ascontiguousarray(values)
+    return np.lib.stride_tricks.as_strided(values, shape=(n_obs - window + 1, window, n_strategies),
+                                           strides=(values.strides[0],) + values.strides, writeable=False)
+
+
+def rolling_var_es(perf: Union[pd.DataFrame, np.ndarray], window: int, level: float = 0.05,
+                   chunk_size: int = 2 ** 22) -> Tuple:
+    """
+    Rolling historical VaR and ES, same definitions as dl_portfolio.backtest.hist_VaR and hist_ES (np.quantile with
+    linear interpolation). The windows of all dates and strategies are partitioned at once around the two order
+    statistics of the quantile (np.partition, O(window) per window instead of a sort), by blocks of dates to bound the
+    memory.
+
+    :param perf: returns, (n_obs, n_strategies)
+    :param window:
+    :param level:
+    :param chunk_size: maximum number of returns copied in a block of windows
+    :return: VaR, ES
+    """
+    assert 1 < window <= len(perf)
+    values, missing = _as_array(perf)
+    n_obs, n_strategies = values.shape
+    windows = _window_view(values, window)
+
+    position = (window - 1) * level
+    lo = int(np.floor(position))
+    hi = min(lo + 1, window - 1)
+    frac = position - lo
+
+    var = np.empty((n_obs - window + 1, n_strategies))
+    es = np.empty((n_obs - window + 1, n_strategies))
+    n_dates = max(1, chunk_size // (window * n_strategies))
+    for start in range(0, len(windows), n_dates):
+        block = np.partition(windows[start:start + n_dates], sorted({lo, hi}), axis=1)
+        quantile = block[:, lo] + frac * (block[:, hi] - block[:, lo])
+        below = block <= quantile[:, None]
+        var[start:start + n_dates] = - quantile
+        es[start:start + n_dates] = - np.sum(np.where(below, block, 0.), axis=1) / np.sum(below, axis=1)
+
+    return _to_output(var, missing, window, perf), _to_output(es, missing, window, perf)
+
+
+def rolling_turnover(weights: Dict[str, pd.DataFrame], window: int) -> pd.DataFrame:
+    """
+    Rolling average total turnover per rebalancing, same definition as dl_portfolio.backtest.total_average_turnover
+    on each window of rebalancing dates
+
+    :param weights: {portfolio: weights pd.DataFrame with one row per rebalancing date}, the portfolios must share the
+    same rebalancing dates
+    :param window: number of turnovers in the window
+    :return: pd.DataFrame with portfolio columns
+    """
+    index = weights[list(weights.keys())[0]].index
+    assert all(weights[port].index.equals(index) for port in weights)
+    turnover = pd.DataFrame({port: weights[port].diff().abs().sum(axis=1, min_count=1) for port in weights}).iloc[1:]
+    assert 0 < window <= len(turnover)
+    values, missing = _as_array(turnover)
+    stat = _window_sum(values, window) / window
+    stat = np.where(_window_sum(missing.astype(np.float64), window) > 0, np.nan, stat)
+    stat = np.concatenate([np.full((window, stat.shape[1]), np.nan), stat])
+    return pd.DataFrame(stat, index=index, columns=turnover.columns)
+
+
+def rolling_stats(perf: pd.DataFrame, window: int = 250, period: int = 250, level: float = 0.05,
+                  weights: Optional[Dict[str, pd.DataFrame]] = None, turnover_window: Optional[int] = None) -> Dict:
+    """
+    Rolling statistics of all strategies at once
+
+    :param perf: returns of the strategies, (n_obs, n_strategies)
+    :param window: number of observations in each window
+    :param period: annualization period of the return, volatility and Sharpe ratio
+    :param level: VaR and ES level
+    :param weights: if given, weights of the portfolios at their rebalancing dates (see rolling_turnover), the rolling
+    turnover is then added as 'TTO'
+    :param turnover_window: number of turnovers in the window of TTO, by default the average number of rebalancings in
+    window observations
+    :return: {statistic: pd.DataFrame with the same index and columns as perf}, the first window - 1 rows are NaN. TTO
+    has the portfolios of weights as columns and is forward filled from the rebalancing dates.
+    """
+    mean, var = rolling_moments(perf, window)
+    var_, es = rolling_var_es(perf, window, level=level)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = {
+            'Return': mean * period,
+            'VOL': np.sqrt(var * period),
+            'SR': mean / np.sqrt(var) * np.sqrt(period),
+            'MDD': rolling_mdd(perf, window),
+            f'VaR-{int(level * 100)}%': var_,
+            f'ES-{int(level * 100)}%': es,
+        }
+    n_turnovers = len(weights[list(weights.keys())[0]]) - 1 if weights else 0
+    if n_turnovers > 0:
+        if turnover_window is None:
+            turnover_window = max(1, int(round(window * n_turnovers / len(perf))))
+        turnover = rolling_turnover(weights, min(turnover_window, n_turnovers))
+        stats['TTO'] = turnover.reindex(turnover.index.union(perf.index)).ffill().reindex(perf.index)
+    return stats
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, Optional
+
+from dl_portfolio.logger import LOGGER
+from dl_portfolio.context import PortfolioContext
+from dl_portfolio.weights import portfolio_weights, riskparity_weights
+
+
+class RollingMoments:
+    """
+    Mean and covariance of a rolling window updated with rank-one add/remove updates (Welford), each update costs
+    O(N^2) instead of O(WN^2) for a full recomputation.
+    """
+
+    def __init__(self, n_assets: int):
+        self.n = 0
+        self._mean = np.zeros(n_assets)
+        self._m2 = np.zeros((n_assets, n_assets))
+
+    def reset(self, x: np.ndarray):
+        """
+        Recompute the moments from scratch on the window x, (W, N)
+        """
+        self.n = len(x)
+        self._mean = x.mean(0)
+        centered = x - self._mean
+        self._m2 = centered.T @ centered
+
+    def add(self, x: np.ndarray):
+        self.n += 1
+        delta = x - self._mean
+        self._mean = self._mean + delta / self.n
+        self._m2 += np.outer(delta, x - self._mean)
+
+    def remove(self, x: np.ndarray):
+        assert self.n > 1
+        self.n -= 1
+        delta = x - self._mean
+        self._mean = self._mean - delta / self.n
+        self._m2 -= np.outer(delta, x - self._mean)
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self._mean.copy()
+
+    @property
+    def cov(self) -> np.ndarray:
+        cov = self._m2 / (self.n - 1)
+        # Remove the asymmetry due to rounding errors
+        return (cov + cov.T) / 2
+
+
+def rolling_portfolio_weights(returns: pd.DataFrame, dates: pd.DatetimeIndex, portfolios: List[str],
+                              window: int = 250, budget: Optional[pd.DataFrame] = None,
+                              refresh: Optional[int] = 250, **kwargs) -> Dict:
+    """
+    Compute the portfolio weights on every date of dates. The weights of date t only use the window of returns
+    ending at t-1. The window mean and covariance are updated incrementally and risk parity is warm-started from the
+    weights of the previous date. Markowitz is warm-started by its compiled engine (see dl_portfolio.markowitz). HRP,
+    HERC and HCAA have no iterative state to warm-start: the recursive bisection is a closed-form allocation, computed
+    on each date from the linkage of the window.
+
+    If the computation of a portfolio fails on a date (portfolio_weights returns None), the weights of the previous
+    date are carried forward, as if the portfolio was not rebalanced. The row is NaN if no previous weights exist.
+
+    :param returns: returns of the assets, must contain the window before dates[0]
+    :param dates: rebalancing dates, for example the test dates of a fold
+    :param portfolios: portfolios of dl_portfolio.weights.portfolio_weights
+    :param window: size of the rolling window
+    :param budget: market budget, required by 'rp', 'aeerc' and 'ae_rp_c'
+    :param refresh: recompute the moments from scratch every refresh dates to avoid the accumulation of rounding
+    errors, None to never refresh
+    :param kwargs: passed to portfolio_weights (embedding, loading, shrink_cov, ...)
+    :return: Dictionary with portfolio keys and dated weights pd.DataFrame, which can be passed to
+    get_portfolio_perf_wrapper as multi-row weights
+    """
+    assert not any(p in ['equal', 'equal_class'] for p in portfolios), "Equal weights do not need to be rebalanced"
+    positions = returns.index.get_indexer(dates)
+    assert np.all(positions >= 0), "All dates must be in returns index"
+    assert np.all(np.diff(positions) > 0), "dates must be sorted"
+    assert positions[0] >= window, f"returns must contain {window} observations before {dates[0]}"
+
+    values = returns.values.astype(np.float64)
+    moments = RollingMoments(values.shape[1])
+    lo, hi = None, None
+    n_updates = 0
+    other_portfolios = [p for p in portfolios if p != 'rp']
+    weights = {p: [] for p in portfolios}
+    prev_rp = None
+    missing = pd.Series(np.nan, index=returns.columns)
+
+    for p in positions:
+        new_lo = p - window
+        if lo is None or new_lo >= hi or (refresh is not None and n_updates >= refresh):
+            moments.reset(values[new_lo:p])
+            n_updates = 0
+        else:
+            for r in range(hi, p):
+                moments.add(values[r])
+            for r in range(lo, new_lo):
+                moments.remove(values[r])
+            n_updates += 1
+        lo, hi = new_lo, p
+
+        window_returns = returns.iloc[lo:hi]
+        mean = pd.Series(moments.mean, index=returns.columns)
+        cov = pd.DataFrame(moments.cov, index=returns.columns, columns=returns.columns)
+        context = PortfolioContext.from_moments(window_returns, mean, cov)
+
+        port_w = {}
+        if 'rp' in portfolios:
+            assert budget is not None
+            try:
+                port_w['rp'] = riskparity_weights(cov, budget=budget['rc'].values, x0=prev_rp)
+                prev_rp = port_w['rp'].values
+            except Exception as _exc:
+                LOGGER.warning(f'Error with rp weights: {_exc}... Setting to None')
+                port_w['rp'] = None
+        if other_portfolios:
+            port_w.update(portfolio_weights(window_returns, budget=budget, portfolio=other_portfolios,
+                                            context=context, **kwargs))
+        for port in portfolios:
+            if port_w[port] is None:
+                # Not rebalanced
+                port_w[port] = weights[port][-1] if weights[port] else missing
+            weights[port].append(port_w[port])
+
+    LOGGER.debug(f"Computed rolling weights on {len(dates)} dates")
+    for port in portfolios:
+        weights[port] = pd.DataFrame(weights[port], index=dates, columns=returns.columns)
+
+    return weights
@@ -17,6 +17,7 @@ from dl_portfolio.pca_ae import get_layer_by_name, heat_map, build_model
 from dl_portfolio.data import drop_remainder, get_features
 from dl_portfolio.train import fit, embedding_visualization, plot_history, create_dataset, build_model_input
 from dl_portfolio.constant import LOG_DIR
+from dl_portfolio.shared import as_frame
 from dl_portfolio.nmf.semi_nmf import SemiNMF
 from dl_portfolio.nmf.convex_nmf import ConvexNMF
 
@@ -29,6 +30,8 @@ def run_ae(config, data, assets, log_dir: Optional[str] = None, seed: Optional[i
     :param seed: if given use specific seed
     :return:
     """
+    # data can be a SharedFrame when runs are executed in parallel
+    data = as_frame(data)
     random_seed = np.random.randint(0, 100)
     if config.seed:
         seed = config.seed
@@ -411,6 +414,7 @@ def run_ae(config, data, assets, log_dir: Optional[str] = None, seed: Optional[i
 
 
 def run_kmeans(config, data, assets, seed=None):
+    data = as_frame(data)
     if config.seed:
         seed = config.seed
     if seed is None:
@@ -464,6 +468,7 @@ def run_kmeans(config, data, assets, seed=None):
 
 
 def run_nmf(config, data, assets, log_dir: Optional[str] = None, seed: Optional[int] = None, verbose=0):
+    data = as_frame(data)
     if config.model_type == "convex_nmf":
         LOG_DIR = 'log_convex_nmf'
     elif config.model_type == "semi_nmf":
@@ -25,3 +25,30 @@ def id_nb_bootstrap(n_obs, block_length):
     _id = _id[_id < n_obs]
 
     return _id
+
+
+def id_nb_bootstrap_batch(n_obs, block_length, n_replicas, random_state=None):
+    """
+    Bootstrapped indexes of n_replicas series at once with the non overlapping block bootstrap (Carlstein, 1986): the
+    series is cut in non overlapping blocks of block_length observations which are drawn with replacement. Unlike
+    id_nb_bootstrap, which permutes the blocks, every replica has exactly n_obs observations. The series is wrapped
+    around as in the circular block bootstrap (Politis and Romano, 1992): if n_obs is not a multiple of block_length,
+    the last block continues with the first observations so that every observation can be drawn.
+
+    :param n_obs:
+    :param block_length:
+    :param n_replicas:
+    :param random_state: seed or np.random.Generator
+    :return: (n_replicas, n_obs)
+    """
+    assert block_length < n_obs
+    assert block_length > 3
+
+    rng = np.random.default_rng(random_state)
+    starts = np.arange(0, n_obs, block_length)
+    n_blocks = int(np.ceil(n_obs / block_length))
+    blocks = rng.choice(starts, size=(n_replicas, n_blocks, 1))
+
+    _id = ((blocks + np.arange(block_length)) % n_obs).reshape(n_replicas, -1)[:, :n_obs]
+
+    return _id
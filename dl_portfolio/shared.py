@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Union
+
+from dl_portfolio.logger import LOGGER
+
+# Shared memory blocks attached by the current process, by name, so that each worker attaches a block only once
+_ATTACHED: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    if name not in _ATTACHED:
+        shm = shared_memory.SharedMemory(name=name)
+        # The block is owned by the parent process: the resource tracker of the worker must not unlink it when the
+        # worker exits
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        _ATTACHED[name] = shm
+    return _ATTACHED[name]
+
+
+class SharedFrame:
+    """
+    pd.DataFrame whose values are stored in shared memory. Only the name of the block, the index and the columns are
+    pickled, so sending a SharedFrame to joblib workers does not copy the data: the workers attach to the block and
+    build a read-only DataFrame on top of it without copy. The process which creates the SharedFrame owns the block
+    and must call unlink when the workers are done, for example with a with statement.
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        values = np.ascontiguousarray(frame.values)
+        assert values.dtype != object, "Only numeric frames can be shared"
+        self._shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        _ATTACHED[self._shm.name] = self._shm
+        self.name = self._shm.name
+        self.shape = values.shape
+        self.dtype = values.dtype.str
+        self.index = frame.index
+        self.columns = frame.columns
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)[:] = values
+        self._owner = True
+        LOGGER.debug(f"Created shared frame {self.name} of {values.nbytes} bytes")
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype, 'index': self.index,
+                'columns': self.columns}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+        self._owner = False
+
+    @property
+    def values(self) -> np.ndarray:
+        if self._shm is None:
+            self._shm = _attach(self.name)
+        values = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        values.flags.writeable = False
+        return values
+
+    @property
+    def frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.values, index=self.index, columns=self.columns, copy=False)
+
+    def unlink(self):
+        """
+        Release the block, only the owner can call it
+        """
+        assert self._owner
+        _ATTACHED.pop(self.name, None)
+        # Workers forked with the resource tracker of the parent unregistered the block from it when attaching,
+        # register it again so that unlink can unregister it
+        resource_tracker.register(self._shm._name, 'shared_memory')
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+
+
+def as_frame(data: Union[pd.DataFrame, SharedFrame]) -> pd.DataFrame:
+    """
+    DataFrame of data, attached without copy if data is a SharedFrame
+    """
+    if isinstance(data, SharedFrame):
+        return data.frame
+    return data
@@ -1,7 +1,7 @@
 import datetime as dt
 import os
 import pickle
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import numpy as np
 import pandas as pd
@@ -12,11 +12,13 @@ from dl_portfolio.logger import LOGGER
 from dl_portfolio.data import get_features
 from dl_portfolio.pca_ae import build_model
 from dl_portfolio.regularizers import WeightsOrthogonality
-from dl_portfolio.regressors.nonnegative_linear.ridge import NonnegativeRidge
+from dl_portfolio.regressors.nonnegative_linear.ridge import NonnegativeRidge, nonnegative_ridge_path
 from dl_portfolio.regressors.nonnegative_linear.base import NonnegativeLinear
 from dl_portfolio.constant import BASE_FACTOR_ORDER_DATASET2, BASE_FACTOR_ORDER_DATASET1
 
-from sklearn.linear_model import LinearRegression, Lasso
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.linear_model import LinearRegression, Lasso, lasso_path
+from sklearn.model_selection import TimeSeriesSplit
 
 LOG_BASE_DIR = './dl_portfolio/log'
 
@@ -48,22 +50,139 @@ def build_linear_model(ae_config, reg_type: str, **kwargs):
     return model
 
 
+def get_alpha_grid(x: np.ndarray, y: np.ndarray, reg_type: str, n_alphas: int = 20, eps: float = 1e-3) -> np.ndarray:
+    """
+    Descending grid of alphas for the regularization path
+
+    :param x: centered features
+    :param y: centered targets
+    :param reg_type: "nn_ridge" or "nn_lasso"
+    :param n_alphas:
+    :param eps: alpha_min / alpha_max
+    :return:
+    """
+    if reg_type == 'nn_lasso':
+        # Smallest alpha such that all (nonnegative) coefficients are 0
+        alpha_max = np.max(np.dot(x.T, y)) / x.shape[0]
+    elif reg_type == 'nn_ridge':
+        # Penalty alpha ** 2 of the order of the diagonal of x^T x
+        alpha_max = 10 * np.sqrt(np.mean(np.sum(x ** 2, 0)))
+    else:
+        raise NotImplementedError(reg_type)
+    return np.logspace(np.log10(alpha_max), np.log10(alpha_max * eps), num=n_alphas)
+
+
+def linear_model_path(x: np.ndarray, y: np.ndarray, reg_type: str, alphas: Optional[np.ndarray] = None,
+                      n_splits: int = 5, **kwargs) -> Dict:
+    """
+    Fit the non negative regularization path of y on x for a descending grid of alphas with warm starts and score
+    each alpha with time series cross-validation. Features and targets are centered on each train split as we do not
+    fit intercept.
+
+    :param x: features, shape (n_samples, n_features)
+    :param y: targets, shape (n_samples, n_targets)
+    :param reg_type: "nn_ridge" or "nn_lasso"
+    :param alphas: grid of alphas, computed with get_alpha_grid if not given
+    :param n_splits: number of TimeSeriesSplit splits
+    :param kwargs: passed to nonnegative_ridge_path or lasso_path
+    :return: Dictionary with keys:
+        - "alphas": descending alphas
+        - "coefs": coefficients fitted on the full data, shape (n_targets, n_features, n_alphas)
+        - "cv_mse": pd.DataFrame of out-of-sample mse with shape (n_splits, n_alphas)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if y.ndim == 1:
+        y = y.reshape(-1, 1)
+
+    def fit_path(x_train, y_train):
+        if reg_type == 'nn_ridge':
+            _, coefs = nonnegative_ridge_path(x_train, y_train, alphas, **kwargs)
+        elif reg_type == 'nn_lasso':
+            # lasso_path does not support positive=True with multiple targets
+            coefs = np.array([lasso_path(x_train, y_train[:, i], alphas=alphas, positive=True, **kwargs)[1]
+                              for i in range(y_train.shape[-1])])
+        else:
+            raise NotImplementedError(reg_type)
+        return coefs
+
+    if alphas is None:
+        alphas = get_alpha_grid(x - x.mean(0), y - y.mean(0), reg_type)
+    alphas = np.sort(np.asarray(alphas, dtype=np.float64))[::-1]
+
+    cv_mse = []
+    for train_index, test_index in TimeSeriesSplit(n_splits=n_splits).split(x):
+        x_mean = x[train_index].mean(0)
+        y_mean = y[train_index].mean(0)
+        coefs = fit_path(x[train_index] - x_mean, y[train_index] - y_mean)
+        pred = np.einsum('ij,tja->ita', x[test_index] - x_mean, coefs) + y_mean.reshape(1, -1, 1)
+        cv_mse.append(np.mean((y[test_index][:, :, None] - pred) ** 2, axis=(0, 1)))
+    cv_mse = pd.DataFrame(cv_mse, columns=alphas)
+
+    return {
+        'alphas': alphas,
+        'coefs': fit_path(x - x.mean(0), y - y.mean(0)),
+        'cv_mse': cv_mse
+    }
+
+
+def get_nnls_path_analysis(test_set: str, data: pd.DataFrame, assets: List[str], base_dir: str, ae_config,
+                           reg_type: str = 'nn_ridge', alphas: Optional[np.ndarray] = None, n_splits: int = 5,
+                           **kwargs) -> Dict:
+    """
+    Regularization path of the non negative regression of the relu activations on the input for each fold, replaces
+    one get_nnls_analysis run per alpha.
+
+    :param test_set:
+    :param data:
+    :param assets:
+    :param base_dir:
+    :param ae_config:
+    :param reg_type: "nn_ridge" or "nn_lasso"
+    :param alphas: grid of alphas common to all folds, if not given we use the grid of the first fold
+    :param n_splits: number of TimeSeriesSplit splits on each fold data
+    :return: Dictionary with keys:
+        - "alphas"
+        - "cv_mse": pd.DataFrame with average time series cv mse per fold (rows) and alpha (columns)
+        - "coefs": Dictionary with the coefficients path for each fold
+        - "best_alpha": alpha with the lowest mse averaged over folds
+    """
+    cv_mse = {}
+    coefs = {}
+    for cv in ae_config.data_specs:
+        LOGGER.info(f'CV: {cv}')
+        _, _, _, test_data, _, _, _, _, relu_activation = load_result(ae_config, test_set, data, assets, base_dir, cv)
+        path = linear_model_path(test_data, relu_activation.values, reg_type, alphas=alphas, n_splits=n_splits,
+                                 **kwargs)
+        alphas = path['alphas']
+        cv_mse[cv] = path['cv_mse'].mean()
+        coefs[cv] = path['coefs']
+
+    cv_mse = pd.DataFrame(cv_mse).T
+
+    return {
+        'alphas': alphas,
+        'cv_mse': cv_mse,
+        'coefs': coefs,
+        'best_alpha': cv_mse.mean().idxmin()
+    }
+
+
 def fit_nnls_one_cv(cv: int, test_set: str, data: pd.DataFrame, assets: List[str], base_dir: str,
-                    ae_config, reg_type: str = 'nn_ridge', **kwargs):
-    model, scaler, dates, test_data, test_features, prediction, embedding, decoding = load_result(ae_config,
-                                                                                                  test_set,
-                                                                                                  data,
-                                                                                                  assets,
-                                                                                                  base_dir,
-                                                                                                  cv)
+                    ae_config, reg_type: str = 'nn_ridge', coef_init: Optional[np.ndarray] = None, **kwargs):
+    # The regression is fitted on the factors in the order of the model, only embedding and decoding are reordered
+    model, scaler, dates, test_data, test_features, prediction, embedding, decoding, relu_activation = load_result(
+        ae_config,
+        test_set,
+        data,
+        assets,
+        base_dir,
+        cv,
+        reorder_features=False)
     prediction -= scaler['attributes']['mean_']
     prediction /= np.sqrt(scaler['attributes']['var_'])
     mse_or = np.mean((test_data - prediction) ** 2, 0)
 
-    relu_activation_layer = tf.keras.Model(inputs=model.input, outputs=model.get_layer('encoder').output)
-    relu_activation = relu_activation_layer.predict(test_data)
-    relu_activation = pd.DataFrame(relu_activation, index=prediction.index)
-
     # Fit linear encoder to the factors
     # input_dim = model.layers[0].input_shape[0][-1]
     # encoding_dim = model.layers[1].output_shape[-1]
@@ -79,7 +198,11 @@ def fit_nnls_one_cv(cv: int, test_set: str, data: pd.DataFrame, assets: List[str
     mean_ = np.mean(x, 0)
     # Center the data as we do not fit intercept
     x = x - mean_
-    reg_nnls.fit(x, relu_activation)
+    if isinstance(reg_nnls, NonnegativeLinear):
+        # Warm start from the coefficients of the previous fold
+        reg_nnls.fit(x, relu_activation, coef_init=coef_init)
+    else:
+        reg_nnls.fit(x, relu_activation)
     # Now compute intercept: it is just the mean of the dependent variable
     intercept_ = np.mean(relu_activation).values
     factors_nnls = reg_nnls.predict(x) + intercept_
@@ -106,12 +229,37 @@ def fit_nnls_one_cv(cv: int, test_set: str, data: pd.DataFrame, assets: List[str
     pred_nnls_model = pd.DataFrame(pred_nnls_model, columns=prediction.columns, index=prediction.index)
     test_data = pd.DataFrame(test_data, columns=prediction.columns, index=prediction.index)
     reg_coef = pd.DataFrame(weights.T, index=embedding.index)
+    embedding, decoding = reorder_factors(ae_config, embedding, decoding)
+    # Free the graph of the loaded model so that memory does not grow with the number of folds and seeds
+    del model
+    tf.keras.backend.clear_session()
+
+    return test_data, embedding, decoding, reg_coef, relu_activation, factors_nnls, prediction, pred_nnls_model, mse_or, mse_nnls_model, reg_nnls.coef_
+
 
-    return test_data, embedding, decoding, reg_coef, relu_activation, factors_nnls, prediction, pred_nnls_model, mse_or, mse_nnls_model
+def _fit_nnls_folds(cvs: List, test_set: str, data: pd.DataFrame, assets: List[str], base_dir: str, ae_config,
+                    reg_type: str = 'nn_ridge', warm_start: bool = True, **kwargs) -> List:
+    """
+    fit_nnls_one_cv on consecutive folds, each fold is warm started from the coefficients of the previous one if
+    warm_start
+
+    :return: list of fit_nnls_one_cv results
+    """
+    cv_results = []
+    coef = None
+    for cv in cvs:
+        LOGGER.info(f'CV: {cv}')
+        cv_results.append(
+            fit_nnls_one_cv(cv, test_set, data, assets, base_dir, ae_config, reg_type=reg_type, coef_init=coef,
+                            **kwargs)
+        )
+        if warm_start:
+            coef = cv_results[-1][-1]
+    return cv_results
 
 
 def get_nnls_analysis(test_set: str, data: pd.DataFrame, assets: List[str], base_dir: str, ae_config,
-                      reg_type: str = 'nn_ridge', **kwargs):
+                      reg_type: str = 'nn_ridge', warm_start: bool = True, n_jobs: Optional[int] = None, **kwargs):
     """
 
     :param test_set:
@@ -120,59 +268,46 @@ def get_nnls_analysis(test_set: str, data: pd.DataFrame, assets: List[str], base
     :param base_dir:
     :param ae_config:
     :param reg_type: regression type to fit "nn_ridge" for non negative Ridge or "nn_ls" for non negative LS
+    :param warm_start: start the solver of "nn_ridge" and "nn_ls_custom" from the coefficients of the previous fold.
+    With n_jobs, each worker fits a block of consecutive folds and only the first fold of each block starts cold.
+    The warm start only changes the starting point of the solver: the fits are the same up to the solver tolerance.
+    :param n_jobs: if given, run blocks of consecutive folds in parallel
     :return:
     """
+    cvs = list(ae_config.data_specs.keys())
+    if n_jobs:
+        n_blocks = min(effective_n_jobs(n_jobs), len(cvs))
+        bounds = np.linspace(0, len(cvs), n_blocks + 1).astype(int)
+        with Parallel(n_jobs=n_jobs) as _parallel_pool:
+            blocks = _parallel_pool(
+                delayed(_fit_nnls_folds)(cvs[start:end], test_set, data, assets, base_dir, ae_config,
+                                         reg_type=reg_type, warm_start=warm_start, **kwargs)
+                for start, end in zip(bounds[:-1], bounds[1:])
+            )
+        cv_results = [res for block in blocks for res in block]
+    else:
+        cv_results = _fit_nnls_folds(cvs, test_set, data, assets, base_dir, ae_config, reg_type=reg_type,
+                                     warm_start=warm_start, **kwargs)
 
-    test_data = pd.DataFrame()
-    prediction = pd.DataFrame()
-    # pred_nnls_factors = pd.DataFrame()
-    pred_nnls_model = pd.DataFrame()
-    factors_nnls = pd.DataFrame()
-    relu_activation = pd.DataFrame()
-    embedding = {}
-    decoding = {}
-    reg_coef = {}
-    mse = {
-        'original': [],
-        'nnls_factors': [],
-        'nnls_model': []
-    }
-
-    # cv = 0
-    for cv in ae_config.data_specs:
-        LOGGER.info(f'CV: {cv}')
-        test_data_i, embedding_i, decoding_i, reg_coef_i, relu_activation_i, factors_nnls_i, pred, pred_nnls_model_i, mse_or, mse_nnls_model = fit_nnls_one_cv(
-            cv,
-            test_set,
-            data,
-            assets,
-            base_dir,
-            ae_config,
-            reg_type=reg_type,
-            **kwargs)
-
-        embedding[cv] = embedding_i
-        decoding[cv] = decoding_i
-        reg_coef[cv] = reg_coef_i
-        relu_activation = pd.concat([relu_activation, relu_activation_i])
-        factors_nnls = pd.concat([factors_nnls, factors_nnls_i])
-        prediction = pd.concat([prediction, pred])
-        pred_nnls_model = pd.concat([pred_nnls_model, pred_nnls_model_i])
-        test_data = pd.concat([test_data, test_data_i])
-        mse['original'].append(mse_or)
-        mse['nnls_model'].append(mse_nnls_model)
+    test_data, embedding, decoding, reg_coef, relu_activation, factors_nnls, prediction, pred_nnls_model, mse_or, \
+    mse_nnls_model, _ = zip(*cv_results)
+    del cv_results
 
     results = {
-        'test_data': test_data,
-        'prediction': prediction,
+        'test_data': pd.concat(test_data),
+        'prediction': pd.concat(prediction),
         # 'pred_nnls_factors': pred_nnls_factors,
-        'pred_nnls_model': pred_nnls_model,
-        'factors_nnls': factors_nnls,
-        'relu_activation': relu_activation,
-        'mse': mse,
-        'embedding': embedding,
-        'decoding': decoding,
-        'reg_coef': reg_coef
+        'pred_nnls_model': pd.concat(pred_nnls_model),
+        'factors_nnls': pd.concat(factors_nnls),
+        'relu_activation': pd.concat(relu_activation),
+        'mse': {
+            'original': list(mse_or),
+            'nnls_factors': [],
+            'nnls_model': list(mse_nnls_model)
+        },
+        'embedding': dict(zip(cvs, embedding)),
+        'decoding': dict(zip(cvs, decoding)),
+        'reg_coef': dict(zip(cvs, reg_coef))
     }
 
     return results
@@ -319,6 +454,31 @@ def get_linear_encoder(config, test_set: str, data: pd.DataFrame, assets: List[s
     return model, test_features, lin_activation
 
 
+def reorder_factors(config, embedding: pd.DataFrame, *factors: pd.DataFrame) -> List[pd.DataFrame]:
+    """
+    Reorder the factor columns of embedding and factors as the base factor order of the dataset: the factor of a base
+    asset is the one with its largest embedding
+
+    :param config:
+    :param embedding: embedding in the order of the model
+    :param factors: other frames with the factors of the model as columns
+    :return: reordered embedding and factors, with the base assets as columns
+    """
+    if config.dataset == "dataset1":
+        base_order = BASE_FACTOR_ORDER_DATASET1
+    elif config.dataset == "dataset2":
+        base_order = BASE_FACTOR_ORDER_DATASET2
+    else:
+        raise NotImplementedError(config.dataset)
+    new_order = [embedding.loc[c].idxmax() for c in base_order]
+    reordered = []
+    for frame in (embedding,) + factors:
+        frame = reorder_columns(frame, new_order)
+        frame.columns = base_order
+        reordered.append(frame)
+    return reordered
+
+
 def load_result(config, test_set: str, data: pd.DataFrame, assets: List[str], base_dir: str, cv: str,
                 reorder_features=True):
     """
@@ -444,22 +604,11 @@ def load_result(config, test_set: str, data: pd.DataFrame, assets: List[str], ba
         relu_activation = None
 
     if reorder_features:
-        if config.dataset == "dataset1":
-            base_order = BASE_FACTOR_ORDER_DATASET1
-        elif config.dataset == "dataset2":
-            base_order = BASE_FACTOR_ORDER_DATASET2
-        else:
-            raise NotImplementedError(config.dataset)
-        new_order = [embedding.loc[c].idxmax() for c in base_order]
-        test_features = reorder_columns(test_features, new_order)
-        test_features.columns = base_order
-        embedding = reorder_columns(embedding, new_order)
-        embedding.columns = base_order
-        decoding = reorder_columns(decoding, new_order)
-        decoding.columns = base_order
         if relu_activation is not None:
-            relu_activation = reorder_columns(relu_activation, new_order)
-            relu_activation.columns = base_order
+            embedding, test_features, decoding, relu_activation = reorder_factors(config, embedding, test_features,
+                                                                                  decoding, relu_activation)
+        else:
+            embedding, test_features, decoding = reorder_factors(config, embedding, test_features, decoding)
 
     return model, scaler, dates, test_data, test_features, pred, embedding, decoding, relu_activation
 
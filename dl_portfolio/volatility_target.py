@@ -0,0 +1,147 @@
+import numpy as np
+
+from scipy.signal import lfilter
+from typing import List, Optional, Tuple
+
+# Windows of the portfolio returns used to estimate the volatility for the volatility target, Jaeger et al 2021
+VOL_LOOKBACKS = (20, 60)
+LEVERAGE_METHODS = ['fold', 'ewma', 'multi_horizon']
+
+
+def target_leverage(vol: np.ndarray, volatility_target: float = 0.05, max_leverage: Optional[float] = None,
+                    min_leverage: Optional[float] = None) -> np.ndarray:
+    """
+    Leverage volatility_target / vol, capped
+
+    :param vol: annualized volatility, any shape
+    :param volatility_target: annualized volatility target
+    :param max_leverage: if given, maximum leverage
+    :param min_leverage: if given, minimum leverage
+    :return: same shape as vol, inf for null volatility without max_leverage, NaN where vol is NaN
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        leverage = volatility_target / np.asarray(vol, dtype=np.float64)
+    if max_leverage is not None:
+        leverage = np.where(np.isnan(leverage), np.nan, np.minimum(leverage, max_leverage))
+    if min_leverage is not None:
+        leverage = np.where(np.isnan(leverage), np.nan, np.maximum(leverage, min_leverage))
+    return leverage
+
+
+def multi_horizon_volatility(port_returns: np.ndarray, lookbacks: Tuple[int, ...] = VOL_LOOKBACKS,
+                             period: int = 252) -> np.ndarray:
+    """
+    Annualized volatility at the last date: maximum of the standard deviations (ddof=0) of the last returns over each
+    lookback, NaN are ignored
+
+    :param port_returns: (..., n_obs) returns of the portfolios, the last axis is the time
+    :param lookbacks:
+    :param period: annualization period
+    :return: (...)
+    """
+    port_returns = np.asarray(port_returns, dtype=np.float64)
+    vol = np.max([np.nanstd(port_returns[..., -lookback:], axis=-1) for lookback in lookbacks], axis=0)
+    return vol * np.sqrt(period)
+
+
+def rolling_multi_horizon_volatility(port_returns: np.ndarray, lookbacks: Tuple[int, ...] = VOL_LOOKBACKS,
+                                     period: int = 252) -> np.ndarray:
+    """
+    multi_horizon_volatility on every date with the returns up to this date included, from cumulative sums. At the
+    beginning of the series the windows contain the available returns only.
+
+    :param port_returns: (..., n_obs) returns without NaN, the last axis is the time
+    :param lookbacks:
+    :param period: annualization period
+    :return: (..., n_obs), NaN on the first date
+    """
+    port_returns = np.asarray(port_returns, dtype=np.float64)
+    # Center the returns to limit the cancellation in the variance
+    x = port_returns - np.mean(port_returns, axis=-1, keepdims=True)
+    pad = np.zeros(x.shape[:-1] + (1,))
+    s1 = np.concatenate([pad, np.cumsum(x, axis=-1)], axis=-1)
+    s2 = np.concatenate([pad, np.cumsum(x ** 2, axis=-1)], axis=-1)
+    end = np.arange(1, x.shape[-1] + 1)
+
+    vol = np.full(x.shape, np.nan)
+    for lookback in lookbacks:
+        start = np.maximum(end - lookback, 0)
+        n = end - start
+        mean = (s1[..., end] - s1[..., start]) / n
+        var = np.maximum((s2[..., end] - s2[..., start]) / n - mean ** 2, 0.)
+        vol = np.fmax(vol, np.sqrt(var))
+    vol[..., 0] = np.nan
+    return vol * np.sqrt(period)
+
+
+def ewma_volatility(port_returns: np.ndarray, halflife: float = 20, period: int = 252) -> np.ndarray:
+    """
+    Annualized RiskMetrics volatility on every date with the returns up to this date included:
+    var_t = (1 - alpha) * var_t-1 + alpha * r_t^2, var_0 = r_0^2, alpha = 1 - 0.5 ** (1 / halflife). The recursion of
+    all the portfolios is computed at once by scipy.signal.lfilter.
+
+    :param port_returns: (..., n_obs) returns without NaN, the last axis is the time
+    :param halflife: in number of observations
+    :param period: annualization period
+    :return: (..., n_obs)
+    """
+    port_returns = np.asarray(port_returns, dtype=np.float64)
+    alpha = 1 - 0.5 ** (1 / halflife)
+    squared = port_returns ** 2
+    zi = (1 - alpha) * squared[..., :1]
+    var, _ = lfilter([alpha], [1, - (1 - alpha)], squared, axis=-1, zi=zi)
+    return np.sqrt(var * period)
+
+
+def daily_leverage(port_returns: np.ndarray, n_history: int, volatility_target: float = 0.05, method: str = 'ewma',
+                   max_leverage: Optional[float] = None, min_leverage: Optional[float] = None,
+                   halflife: float = 20, lookbacks: Tuple[int, ...] = VOL_LOOKBACKS,
+                   period: int = 252) -> np.ndarray:
+    """
+    Leverage of each date after a history of returns: the leverage of date t only uses the volatility estimated with
+    the returns up to t - 1
+
+    :param port_returns: (..., n_history + n_dates) unlevered returns of the portfolios, the history followed by the
+    returns of the dates on which the leverage is computed
+    :param n_history: number of returns of the history, at least 1
+    :param volatility_target:
+    :param method: 'ewma' or 'multi_horizon'
+    :param max_leverage:
+    :param min_leverage:
+    :param halflife: see ewma_volatility
+    :param lookbacks: see rolling_multi_horizon_volatility
+    :param period: annualization period
+    :return: (..., n_dates)
+    """
+    assert n_history >= 1
+    if method == 'ewma':
+        vol = ewma_volatility(port_returns, halflife=halflife, period=period)
+    elif method == 'multi_horizon':
+        vol = rolling_multi_horizon_volatility(port_returns, lookbacks=lookbacks, period=period)
+    else:
+        raise NotImplementedError(method)
+    return target_leverage(vol[..., n_history - 1:-1], volatility_target, max_leverage=max_leverage,
+                           min_leverage=min_leverage)
+
+
+def daily_fold_leverage(port_returns: np.ndarray, folds: np.ndarray, train_port_returns: List[np.ndarray],
+                        volatility_target: float = 0.05, method: str = 'ewma', **kwargs) -> np.ndarray:
+    """
+    daily_leverage on the test dates of all folds: the volatility of a fold is estimated on the train returns of the
+    portfolios followed by their returns on the previous test dates of the fold
+
+    :param port_returns: unlevered test returns of the portfolios, (P, T)
+    :param folds: position of the first date of each fold, (F)
+    :param train_port_returns: train returns of the portfolios with the weights of the fold, list of F (P, n_obs)
+    :param volatility_target:
+    :param method: 'ewma' or 'multi_horizon'
+    :param kwargs: passed to daily_leverage
+    :return: (P, T)
+    """
+    bounds = np.append(folds, port_returns.shape[-1])
+    leverage = np.empty_like(port_returns, dtype=np.float64)
+    for f in range(len(folds)):
+        history = np.concatenate([train_port_returns[f], port_returns[:, bounds[f]:bounds[f + 1]]], axis=-1)
+        leverage[:, bounds[f]:bounds[f + 1]] = daily_leverage(history, train_port_returns[f].shape[-1],
+                                                              volatility_target, method=method, **kwargs)
+    return leverage
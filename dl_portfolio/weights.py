@@ -1,88 +1,218 @@
+import time
+
 import pandas as pd
 import numpy as np
 
-import riskparityportfolio as rp
-import cvxpy as cp
-
-from typing import Union
-from sklearn.cluster import KMeans
-
-from pypfopt.efficient_frontier import EfficientFrontier
-from pypfopt import risk_models
-from portfoliolab.clustering.hrp import HierarchicalRiskParity
-from portfoliolab.clustering.herc import HierarchicalEqualRiskContribution
+from concurrent.futures import ThreadPoolExecutor
+from scipy.cluster.hierarchy import leaves_list
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from dl_portfolio.logger import LOGGER
-from dl_portfolio.cluster import get_cluster_labels
+from dl_portfolio.context import PortfolioContext, get_context
+from dl_portfolio.covariance import FactorCovariance
+from dl_portfolio.riskparity import riskparity, riskparity_batch
+from dl_portfolio.markowitz import get_markowitz_engine
+from dl_portfolio.hierarchical import get_linkage, get_optimal_number_of_clusters, herc, hrp, hrp_batch
 from dl_portfolio.constant import PORTFOLIOS
 
+# Portfolios which only depend on the returns and the market budget
+CONTEXT_PORTFOLIOS = ['markowitz', 'ivp', 'hrp', 'herc', 'hcaa', 'rp']
+# Portfolios whose weights can be solved for all the folds of a run in one batched call, see fold_batch_weights
+BATCH_PORTFOLIOS = ['hrp', 'rp']
+
+
+def _cache_key(portfolio: str, budget: Optional[pd.DataFrame] = None, optimal_num_clusters=None) -> Tuple:
+    """
+    Key of the weights of a CONTEXT_PORTFOLIOS portfolio in PortfolioContext.weights_cache: the portfolio and the other
+    inputs its weights depend on
+    """
+    if portfolio == 'rp':
+        return portfolio, tuple(budget['rc'].items())
+    if portfolio in ['herc', 'hcaa']:
+        return portfolio, optimal_num_clusters
+    return portfolio,
+
+
+def _run_strategy(portfolio: str, message: str, func: Callable, args: Tuple, kwargs: Dict):
+    """
+    Run one weight function, a failure only gives None weights for this portfolio
+
+    :return: portfolio, weights, computation time
+    """
+    start_time = time.time()
+    LOGGER.info(message)
+    try:
+        weights = func(*args, **kwargs)
+    except Exception as _exc:
+        LOGGER.warning(f'Error with {portfolio} weights: {_exc}... Setting to None')
+        weights = None
+    return portfolio, weights, time.time() - start_time
+
 
 def portfolio_weights(returns, shrink_cov=None, budget=None, embedding=None, loading=None,
                       portfolio=['markowitz', 'shrink_markowitz', 'ivp', 'aerp', 'hrp', 'rp', 'aeerc', 'herc'],
-                      **kwargs):
+                      context: Optional[PortfolioContext] = None, executor: Optional[ThreadPoolExecutor] = None,
+                      timings: Optional[Dict] = None, fold=None, solver_info: Optional[Dict] = None,
+                      cov_method: str = 'sample', **kwargs):
+    """
+
+    :param returns: train returns
+    :param shrink_cov:
+    :param budget:
+    :param embedding:
+    :param loading:
+    :param portfolio: list of portfolios
+    :param context: PortfolioContext of returns, the weights of the portfolios which do not depend on the embedding
+    are cached in the context
+    :param executor: ThreadPoolExecutor used to compute the portfolios concurrently, if None they are computed
+    sequentially. The portfolios share context and fill solver_info, a process pool would work on copies of them.
+    :param timings: if given, filled with the computation time of each portfolio
+    :param fold: fold of returns, used to label solver_info
+    :param solver_info: if given, filled with the solve time, status and solver of the Markowitz portfolios
+    :param cov_method: estimator of the covariance matrix used by all portfolios, see
+    dl_portfolio.covariance.get_covariance, it must be the one of context if given
+    :param kwargs:
+    :return: Dictionary with portfolio keys and weights, None if the computation of the portfolio failed
+    """
     assert all([p in PORTFOLIOS for p in portfolio]), [p for p in portfolio if p not in PORTFOLIOS]
+    assert executor is None or isinstance(executor, ThreadPoolExecutor), \
+        "Only a ThreadPoolExecutor is supported: with a process pool, solver_info and the context caches are lost"
     port_w = {}
 
-    mu = returns.mean()
-    S = returns.cov()
+    context = get_context(returns, context, cov_method=cov_method)
+    mu = context.mean
+    S = context.cov
+
+    if solver_info is None:
+        solver_info = {}
 
+    # {portfolio: (message, func, args, kwargs)}
+    tasks = {}
     if 'markowitz' in portfolio:
-        LOGGER.info('Computing Markowitz weights...')
-        port_w['markowitz'] = markowitz_weights(mu, S)
+        solver_info['markowitz'] = {}
+        tasks['markowitz'] = ('Computing Markowitz weights...', markowitz_weights, (mu, S),
+                              {'fold': fold, 'info': solver_info['markowitz']})
 
     if 'shrink_markowitz' in portfolio:
         assert shrink_cov is not None
-        LOGGER.info('Computing shrinked Markowitz weights...')
-        port_w['shrink_markowitz'] = markowitz_weights(mu, shrink_cov)
+        solver_info['shrink_markowitz'] = {}
+        tasks['shrink_markowitz'] = ('Computing shrinked Markowitz weights...', markowitz_weights, (mu, shrink_cov),
+                                     {'fold': fold, 'info': solver_info['shrink_markowitz']})
 
     if 'ivp' in portfolio:
-        LOGGER.info('Computing IVP weights...')
-        port_w['ivp'] = ivp_weights(S)
+        tasks['ivp'] = ('Computing IVP weights...', ivp_weights, (S,), {})
 
     if 'hrp' in portfolio:
-        LOGGER.info('Computing HRP weights...')
-        port_w['hrp'] = hrp_weights(S)
+        tasks['hrp'] = ('Computing HRP weights...', hrp_weights, (S,), {'context': context})
 
     if 'herc' in portfolio:
-        LOGGER.info('Computing HERC weights with variance as risk measure...')
-        port_w['herc'] = herc_weights(returns, optimal_num_clusters=kwargs.get('optimal_num_clusters'),
-                                      risk_measure='variance')
+        tasks['herc'] = ('Computing HERC weights with variance as risk measure...', herc_weights, (returns,),
+                         {'optimal_num_clusters': kwargs.get('optimal_num_clusters'), 'risk_measure': 'variance',
+                          'context': context})
 
     if 'hcaa' in portfolio:
-        LOGGER.info('Computing HCAA weights...')
-        port_w['hcaa'] = herc_weights(returns, optimal_num_clusters=kwargs.get('optimal_num_clusters'),
-                                      risk_measure='equal_weighting')
+        tasks['hcaa'] = ('Computing HCAA weights...', herc_weights, (returns,),
+                         {'optimal_num_clusters': kwargs.get('optimal_num_clusters'),
+                          'risk_measure': 'equal_weighting', 'context': context})
 
     if 'rp' in portfolio:
-        LOGGER.info('Computing Riskparity weights...')
         assert budget is not None
-        port_w['rp'] = riskparity_weights(S, budget=budget['rc'].values)
+        tasks['rp'] = ('Computing Riskparity weights...', riskparity_weights, (S,), {'budget': budget['rc'].values})
 
     if 'kmaa' in portfolio:
-        LOGGER.info('Computing KMeans Asset Allocation weights...')
         assert embedding is not None
-        port_w['kmaa'] = kmaa_weights(returns, n_clusters=embedding.shape[-1])
+        tasks['kmaa'] = ('Computing KMeans Asset Allocation weights...', kmaa_weights, (returns,),
+                         {'n_clusters': embedding.shape[-1], 'context': context})
 
     if 'aerp' in portfolio:
-        LOGGER.info('Computing AE Risk Parity weights...')
         assert embedding is not None
-        port_w['aerp'] = ae_ivp_weights(returns, embedding)
+        tasks['aerp'] = ('Computing AE Risk Parity weights...', ae_ivp_weights, (returns, embedding),
+                         {'context': context})
 
     if 'aeerc' in portfolio:
-        LOGGER.info('Computing AE Risk Contribution weights...')
         assert budget is not None
         assert embedding is not None
-        port_w['aeerc'] = ae_riskparity_weights(returns, embedding, loading, budget, risk_parity='budget')
+        tasks['aeerc'] = ('Computing AE Risk Contribution weights...', ae_riskparity_weights,
+                          (returns, embedding, loading, budget), {'risk_parity': 'budget', 'context': context})
 
     if 'ae_rp_c' in portfolio:
-        LOGGER.info('Computing AE Risk Contribution Cluster weights...')
         assert budget is not None
         assert embedding is not None
-        port_w['ae_rp_c'] = ae_riskparity_weights(returns, embedding, loading, budget, risk_parity='cluster')
+        tasks['ae_rp_c'] = ('Computing AE Risk Contribution Cluster weights...', ae_riskparity_weights,
+                            (returns, embedding, loading, budget), {'risk_parity': 'cluster', 'context': context})
 
     if 'aeaa' in portfolio:
-        LOGGER.info('Computing AE Asset Allocation weights...')
-        port_w['aeaa'] = aeaa_weights(returns, embedding)
+        tasks['aeaa'] = ('Computing AE Asset Allocation weights...', aeaa_weights, (returns, embedding),
+                         {'context': context})
+
+    # Weights of the portfolios which do not depend on the model are cached in the context, with the other inputs
+    # they depend on in the key
+    cache_keys = {p: _cache_key(p, budget=budget, optimal_num_clusters=kwargs.get('optimal_num_clusters'))
+                  for p in CONTEXT_PORTFOLIOS if p in tasks}
+    for p in CONTEXT_PORTFOLIOS:
+        if p in tasks and cache_keys[p] in context.weights_cache:
+            port_w[p] = context.weights_cache[cache_keys[p]]
+            tasks.pop(p)
+
+    if executor is None:
+        results = [_run_strategy(p, *tasks[p]) for p in tasks]
+    else:
+        futures = [executor.submit(_run_strategy, p, *tasks[p]) for p in tasks]
+        results = [future.result() for future in futures]
+
+    for p, weights, elapsed in results:
+        port_w[p] = weights
+        if timings is not None:
+            timings[p] = elapsed
+        if p in CONTEXT_PORTFOLIOS and weights is not None:
+            context.weights_cache[cache_keys[p]] = weights
+
+    port_w = {p: port_w[p] for p in portfolio if p in port_w}
+    # Portfolios read from the cache were not solved
+    for p in [p for p in solver_info if not solver_info[p]]:
+        solver_info.pop(p)
+
+    return port_w
+
+
+def fold_batch_weights(contexts: List[PortfolioContext], portfolio: List[str], budget: Optional[pd.DataFrame] = None,
+                       timings: Optional[Dict] = None) -> List[Dict]:
+    """
+    Weights of the BATCH_PORTFOLIOS of several folds with the same assets, for example all the folds of a run: the
+    HRP bisections of all folds are computed by one hrp_batch call and the risk parity problems by one
+    riskparity_batch call. The weights are read from and stored in the weights_cache of the contexts, like
+    portfolio_weights. If a batched solve fails, the weights of its portfolio are None.
+
+    :param contexts: PortfolioContext of the train returns of each fold
+    :param portfolio: list of portfolios, the ones which are not in BATCH_PORTFOLIOS are ignored
+    :param budget: market budget, required by 'rp'
+    :param timings: if given, filled with the computation time of each portfolio for all folds
+    :return: list of {portfolio: weights} for each context
+    """
+    port_w = [{} for _ in contexts]
+    for p in [p for p in BATCH_PORTFOLIOS if p in portfolio]:
+        start_time = time.time()
+        if p == 'rp':
+            assert budget is not None
+        key = _cache_key(p, budget=budget)
+        todo = [i for i, context in enumerate(contexts) if key not in context.weights_cache]
+        if todo:
+            LOGGER.info(f'Computing {p} weights of {len(todo)} folds...')
+            covs = np.stack([contexts[i].cov.values for i in todo])
+            try:
+                if p == 'hrp':
+                    orders = np.stack([leaves_list(contexts[i].linkage('single')) for i in todo])
+                    weights = hrp_batch(covs, orders)
+                else:
+                    weights = riskparity_batch(covs, np.tile(budget['rc'].values, (len(todo), 1)))
+                for i, w in zip(todo, weights):
+                    contexts[i].weights_cache[key] = pd.Series(w, index=contexts[i].cov.columns)
+            except Exception as _exc:
+                LOGGER.warning(f'Error with {p} weights: {_exc}... Setting to None')
+        for i, context in enumerate(contexts):
+            port_w[i][p] = context.weights_cache.get(key)
+        if timings is not None:
+            timings[p] = time.time() - start_time
 
     return port_w
 
@@ -106,116 +236,102 @@ def get_cluster_var(cov, cluster_items, weights=None):
 
 
 def get_inner_cluster_weights(cov, loading, clusters, market_budget=None):
-    weights = {}
-    n_clusters = len(clusters)
-    for c in clusters:
+    cluster_covs = []
+    cluster_budgets = []
+    non_empty = [c for c in clusters if clusters[c]]
+    for c in non_empty:
         cluster_items = clusters[c]
-
-        if cluster_items:
-            if market_budget is not None:
-                budget = market_budget.loc[cluster_items, 'rc']
-            else:
-                budget = loading.loc[cluster_items, c] ** 2 / np.sum(loading.loc[cluster_items, c] ** 2)
-            cov_slice = cov.loc[cluster_items, cluster_items]
-            weights[c] = pd.Series(
-                rp.RiskParityPortfolio(covariance=cov_slice, budget=budget.values).weights,
-                index=cluster_items
-            )
-    reorder_weights = {}
-    i = 0
-    for c in weights:
-        reorder_weights[i] = weights[c]
-        i+=1
-    weights = {i: weights[c] for i, c in enumerate(list(weights.keys()))}
+        if market_budget is not None:
+            budget = market_budget.loc[cluster_items, 'rc']
+        else:
+            # Clusters are numbered by factor position
+            cluster_loading = loading.loc[cluster_items].iloc[:, c]
+            budget = cluster_loading ** 2 / np.sum(cluster_loading ** 2)
+        cluster_covs.append(cov.loc[cluster_items, cluster_items].values)
+        cluster_budgets.append(budget.values)
+    # Solve the risk parity problems of all clusters at once
+    weights = riskparity_batch(cluster_covs, cluster_budgets) if non_empty else []
+    weights = {i: pd.Series(weights[i], index=clusters[c]) for i, c in enumerate(non_empty)}
     return weights
 
 
-def markowitz_weights(mu: Union[pd.Series, np.ndarray], S: pd.DataFrame, fix_cov: bool = False,
-                      risk_free_rate: float = 0.) -> pd.Series:
-    if fix_cov:
-        S = risk_models.fix_nonpositive_semidefinite(S, fix_method='spectral')
-    weights = None
-    try:
-        LOGGER.info(f"Trying Markowitz with default 'ECOS' solver")
-        ef = EfficientFrontier(mu, S, verbose=False)
-        # ef.add_objective(objective_functions.L2_reg, gamma=0)
-        weights = ef.max_sharpe(risk_free_rate=risk_free_rate)
-        weights = pd.Series(weights, index=weights.keys())
-        LOGGER.info("Success")
-    except Exception as _exc:
-        LOGGER.info(f'Error with max sharpe: {_exc}')
-        try:
-            LOGGER.info(f"Trying Markowitz with 'SCS' solver")
-            ef = EfficientFrontier(mu, S, verbose=True, solver='SCS')
-            # ef.add_objective(objective_functions.L2_reg, gamma=0)
-            weights = ef.max_sharpe(risk_free_rate=risk_free_rate)
-            weights = pd.Series(weights, index=weights.keys())
-            LOGGER.info("Success")
-        except Exception as _exc:
-            LOGGER.info(f'Error with max sharpe: {_exc}')
-            try:
-                LOGGER.info(f"Trying Markowitz with 'OSQP' solver")
-                ef = EfficientFrontier(mu, S, verbose=True, solver='OSQP')
-                # ef.add_objective(objective_functions.L2_reg, gamma=0)
-                weights = ef.max_sharpe(risk_free_rate=risk_free_rate)
-                weights = pd.Series(weights, index=weights.keys())
-                LOGGER.info("Success")
-            except Exception as _exc:
-                LOGGER.info(f'Error with max sharpe: {_exc}')
-                try:
-                    LOGGER.info(f"Trying Markowitz with 'CVXOPT' solver")
-
-                    # ef = EfficientFrontier(mu, S, verbose=True, solver=cp.CVXOPT, solver_options={'feastol': 1e-4})
-                    ef = EfficientFrontier(mu, S, verbose=True, solver=cp.SCS)
-                    weights = ef.max_sharpe(risk_free_rate=risk_free_rate)
-                    weights = pd.Series(weights, index=weights.keys())
-                    LOGGER.info("Success")
-                except Exception as _exc:
-                    LOGGER.info(f'Error with max sharpe: {_exc}')
+def markowitz_weights(mu: Union[pd.Series, np.ndarray], S: Union[pd.DataFrame, FactorCovariance],
+                      fix_cov: bool = False, risk_free_rate: float = 0., fold=None,
+                      info: Optional[Dict] = None) -> pd.Series:
+    """
+    Max Sharpe portfolio, solved with the MarkowitzEngine of the asset universe
+
+    :param mu:
+    :param S: covariance matrix, any estimator of dl_portfolio.covariance
+    :param fix_cov: apply the spectral fix to S even if it is positive definite
+    :param risk_free_rate:
+    :param fold: see MarkowitzEngine.max_sharpe
+    :param info: see MarkowitzEngine.max_sharpe
+    :return:
+    """
+    assets = list(S.index) if isinstance(S, (pd.DataFrame, FactorCovariance)) else list(range(len(S)))
+    engine = get_markowitz_engine(assets)
+    return engine.max_sharpe(mu, S, fix_cov=fix_cov, risk_free_rate=risk_free_rate, fold=fold, info=info)
 
-    if weights is None:
-        raise _exc
 
-    return weights
+def _cov_to_corr(S: np.ndarray) -> np.ndarray:
+    std = np.sqrt(np.diag(S))
+    return S / np.outer(std, std)
 
 
-def hrp_weights(S: pd.DataFrame, linkage: str = 'single') -> pd.Series:
-    # constructing our Single Linkage portfolio
-    hrp_single = HierarchicalRiskParity()
-    hrp_single.allocate(asset_names=S.columns,
-                        covariance_matrix=S,
-                        linkage=linkage)
+def hrp_weights(S: pd.DataFrame, linkage: str = 'single', context: Optional[PortfolioContext] = None) -> pd.Series:
+    """
+    Hierarchical Risk Parity weights
 
-    weights = hrp_single.weights.T
-    weights = weights[0]
-    weights = weights[S.columns]
+    :param S: covariance matrix
+    :param linkage: linkage method
+    :param context: if given, its covariance must be S and its linkage is reused
+    :return:
+    """
+    if context is not None:
+        link = context.linkage(linkage)
+    else:
+        link = get_linkage(_cov_to_corr(S.values), method=linkage)
+    weights = pd.Series(hrp(S.values, link), index=S.columns)
 
     return weights
 
 
 def herc_weights(returns: pd.DataFrame, linkage: str = 'single', risk_measure: str = 'equal_weighting',
-                 covariance_matrix=None, optimal_num_clusters=None) -> pd.Series:
-    hercEW_single = HierarchicalEqualRiskContribution()
-    hercEW_single.allocate(asset_names=returns.columns,
-                           asset_returns=returns,
-                           covariance_matrix=covariance_matrix,
-                           risk_measure=risk_measure,
-                           optimal_num_clusters=optimal_num_clusters,
-                           linkage=linkage)
-
-    weights = hercEW_single.weights.T
-    weights = weights[0]
-    weights = weights[returns.columns]
+                 covariance_matrix=None, optimal_num_clusters=None,
+                 context: Optional[PortfolioContext] = None) -> pd.Series:
+    """
+    HERC ('variance') or HCAA ('equal_weighting') weights
+
+    :param returns:
+    :param linkage: linkage method
+    :param risk_measure: 'variance' or 'equal_weighting'
+    :param covariance_matrix: default to the covariance of returns
+    :param optimal_num_clusters: if None, it is selected with the gap statistic
+    :param context: PortfolioContext of returns
+    :return:
+    """
+    context = get_context(returns, context)
+    if covariance_matrix is None:
+        covariance_matrix = context.cov
+    link = context.linkage(linkage)
+    if optimal_num_clusters is None:
+        optimal_num_clusters = get_optimal_number_of_clusters(returns.values, link, method=linkage)
+    weights = herc(covariance_matrix.values, link, optimal_num_clusters, risk_measure=risk_measure)
+    weights = pd.Series(weights, index=returns.columns)
 
     return weights
 
 
-def ivp_weights(S: Union[pd.DataFrame, np.ndarray]) -> pd.Series:
+def ivp_weights(S: Union[pd.DataFrame, np.ndarray, FactorCovariance]) -> pd.Series:
     # Compute the inverse-variance portfolio
-    ivp = 1. / np.diag(S.values)
+    if isinstance(S, FactorCovariance):
+        ivp = 1. / S.diag()
+    else:
+        ivp = 1. / np.diag(S.values)
     weights = ivp / ivp.sum()
 
-    if isinstance(S, pd.DataFrame):
+    if isinstance(S, (pd.DataFrame, FactorCovariance)):
         weights = pd.Series(weights, index=S.index)
     else:
         weights = pd.Series(weights)
@@ -223,14 +339,18 @@ def ivp_weights(S: Union[pd.DataFrame, np.ndarray]) -> pd.Series:
     return weights
 
 
-def riskparity_weights(S: pd.DataFrame(), budget: np.ndarray) -> pd.Series:
-    weights = rp.RiskParityPortfolio(covariance=S, budget=budget).weights
+def riskparity_weights(S: Union[pd.DataFrame, FactorCovariance], budget: np.ndarray,
+                       x0: Optional[np.ndarray] = None) -> pd.Series:
+    # The risk parity solver works on the dense matrix, FactorCovariance.values builds it
+    # x0 can be used to warm start from previous weights
+    weights = riskparity(S.values, budget, x0=x0)
     weights = pd.Series(weights, index=S.index)
 
     return weights
 
 
-def ae_riskparity_weights(returns, embedding, loading, market_budget, risk_parity='budget'):
+def ae_riskparity_weights(returns, embedding, loading, market_budget, risk_parity='budget',
+                          context: Optional[PortfolioContext] = None):
     """
 
     :param returns:
@@ -239,25 +359,24 @@ def ae_riskparity_weights(returns, embedding, loading, market_budget, risk_parit
     :param market_budget:
     :param risk_parity: if 'budget' then use budget for risk allocation, if 'cluster' use relative asset cluster
     importance from the embedding matrix
+    :param context: PortfolioContext of returns
     :return:
     """
     assert risk_parity in ['budget', 'cluster']
-    # Rename columns in case of previous renaming
-    loading.columns = list(range(len(loading.columns)))
-    embedding.columns = list(range(len(embedding.columns)))
+    context = get_context(returns, context)
     max_cluster = embedding.shape[-1] - 1
     # First get cluster allocation to forget about small contribution
-    clusters, _ = get_cluster_labels(embedding)
+    clusters, _ = context.cluster_labels(embedding)
     clusters = {c: clusters[c] for c in clusters if c <= max_cluster}
 
     # Now get weights of assets inside each cluster
     if risk_parity == 'budget':
-        inner_cluster_weights = get_inner_cluster_weights(returns.cov(),
+        inner_cluster_weights = get_inner_cluster_weights(context.cov,
                                                           loading,
                                                           clusters,
                                                           market_budget=market_budget)
     elif risk_parity == 'cluster':
-        inner_cluster_weights = get_inner_cluster_weights(returns.cov(),
+        inner_cluster_weights = get_inner_cluster_weights(context.cov,
                                                           loading,
                                                           clusters)
     else:
@@ -278,7 +397,7 @@ def ae_riskparity_weights(returns, embedding, loading, market_budget, risk_parit
     cov = cluster_returns.cov()
     budget = np.array(list(cluster_rc.values()))
     budget = budget / np.sum(budget)
-    cluster_weight = rp.RiskParityPortfolio(covariance=cov, budget=budget).weights
+    cluster_weight = riskparity(cov.values, budget)
     # Compute asset weight inside global portfolio
     weights = pd.Series(dtype='float32')
     for c in inner_cluster_weights:
@@ -289,93 +408,90 @@ def ae_riskparity_weights(returns, embedding, loading, market_budget, risk_parit
     return weights
 
 
-def kmaa_weights(returns: pd.DataFrame, n_clusters: int) -> pd.Series:
-    kmeans = KMeans(n_clusters=n_clusters, random_state=0)
-    kmeans.fit(returns.T)
-    labels = pd.DataFrame(kmeans.labels_.reshape(1, -1), columns=returns.columns).T
-    labels.columns = ['label']
-    clusters = {i: list(labels[labels['label'] == i].index) for i in range(n_clusters)}
+def cluster_equal_weights(labels: np.ndarray, n_clusters: int) -> np.ndarray:
+    """
+    Equal weights inside each cluster and 1 / n_clusters for each cluster, computed for a batch of label vectors (for
+    example folds x seeds) with a single bincount. Assets with label >= n_clusters are in no cluster and get a null
+    weight.
 
-    # Now get weights of assets inside each cluster
-    cluster_weights = {c: pd.Series([1 / len(clusters[c])] * len(clusters[c]), index=clusters[c]) for c in clusters}
-    # {asset: 1 / n_items for asset in clusters[c]}}
+    :param labels: integer cluster labels, (n_assets) or (n_batch, n_assets)
+    :param n_clusters:
+    :return: weights, same shape as labels
+    """
+    labels = np.asarray(labels)
+    batch = labels.ndim == 2
+    labels = np.minimum(np.atleast_2d(labels), n_clusters)
+    n_batch = labels.shape[0]
+    # Offset the labels of each vector to count all the clusters of the batch at once
+    labels = labels + (n_clusters + 1) * np.arange(n_batch)[:, None]
+    counts = np.bincount(labels.ravel(), minlength=n_batch * (n_clusters + 1))
+    weights = 1. / (n_clusters * counts[labels])
+    weights[labels % (n_clusters + 1) == n_clusters] = 0.
 
-    # Compute asset weight inside global portfolio
-    weights = pd.Series(dtype='float32')
-    for c in cluster_weights:
-        weights = pd.concat([weights, cluster_weights[c]])
-    weights = weights / n_clusters  # Rescale each weight
-    weights = weights.reindex(returns.columns)  # rerorder
-    weights.fillna(0., inplace=True)
+    return weights if batch else weights[0]
 
-    return weights
 
+def cluster_ivp_weights(covs: np.ndarray, labels: np.ndarray, n_clusters: int) -> np.ndarray:
+    """
+    Inverse variance weights inside each cluster, the clusters are weighted by the inverse variance of their inner
+    portfolio. Computed for a batch of label vectors, assets with label >= n_clusters get a null weight.
 
-def aeaa_weights(returns: Union[np.ndarray, pd.DataFrame], embedding: Union[np.ndarray, pd.DataFrame]) -> pd.Series:
-    max_cluster = embedding.shape[-1] - 1
-    # First get cluster allocation to forget about small contribution
-    # Rename columns in case of previous renaming
-    embedding.columns = list(range(len(embedding.columns)))
-    clusters, _ = get_cluster_labels(embedding)
-    clusters = {c: clusters[c] for c in clusters if c <= max_cluster}
-    n_clusters = embedding.shape[-1]
+    :param covs: covariance matrices, (n_assets, n_assets) or (n_batch, n_assets, n_assets)
+    :param labels: integer cluster labels, (n_assets) or (n_batch, n_assets)
+    :param n_clusters:
+    :return: weights, same shape as labels
+    """
+    labels = np.asarray(labels)
+    batch = labels.ndim == 2
+    labels = np.atleast_2d(labels)
+    n_batch, n_assets = labels.shape
+    covs = np.broadcast_to(np.asarray(covs, dtype=np.float64), (n_batch, n_assets, n_assets))
 
-    # Now get weights of assets inside each cluster
-    cluster_weights = {c: pd.Series([1 / len(clusters[c])] * len(clusters[c]), index=clusters[c]) for c in clusters}
-    # {asset: 1 / n_items for asset in clusters[c]}}
+    # Inner weights of each cluster, (n_batch, n_clusters, n_assets)
+    inv_var = 1. / np.diagonal(covs, axis1=1, axis2=2)
+    inner = (labels[:, None, :] == np.arange(n_clusters)[None, :, None]) * inv_var[:, None, :]
+    total = np.sum(inner, axis=-1)
+    non_empty = total > 0
+    inner = inner / np.where(non_empty, total, 1.)[:, :, None]
+    cluster_var = np.einsum('bki,bij,bkj->bk', inner, covs, inner)
+    cluster_weights = np.where(non_empty, 1. / np.where(non_empty, cluster_var, 1.), 0.)
+    cluster_weights = cluster_weights / np.sum(cluster_weights, axis=-1, keepdims=True)
+    weights = np.einsum('bk,bki->bi', cluster_weights, inner)
 
-    # Compute asset weight inside global portfolio
-    weights = pd.Series(dtype='float32')
-    for c in cluster_weights:
-        weights = pd.concat([weights, cluster_weights[c]])
-    weights = weights / n_clusters  # Rescale each weight
-    weights = weights.reindex(returns.columns)  # rerorder
-    weights.fillna(0., inplace=True)
+    return weights if batch else weights[0]
 
-    return weights
 
+def kmaa_weights(returns: pd.DataFrame, n_clusters: int, context: Optional[PortfolioContext] = None) -> pd.Series:
+    context = get_context(returns, context)
+    labels = context.kmeans_labels(n_clusters)
+    return pd.Series(cluster_equal_weights(labels, n_clusters), index=returns.columns)
 
-def equal_class_weights(market_budget: pd.DataFrame):
-    market_class = np.unique(market_budget['market'].values, return_counts=True)
-    inner_class_weight = {c: 1 / market_class[1][i] for i, c in enumerate(market_class[0])}
-    weights = pd.Series(index=market_budget.index)
-    for c in inner_class_weight:
-        assets = market_budget.index[market_budget['market'] == c]
-        weights.loc[assets] = inner_class_weight[c]
-    weights /= np.sum(weights)
 
-    return weights
+def _embedding_labels(returns: pd.DataFrame, embedding: pd.DataFrame, context: PortfolioContext) -> np.ndarray:
+    # Cluster labels in the order of the returns columns
+    _, labels = context.cluster_labels(embedding)
+    return labels['label'].loc[returns.columns].values
 
 
-def ae_ivp_weights(returns, embedding):
-    max_cluster = embedding.shape[-1] - 1
-    # First get cluster allocation to forget about small contribution
-    # Rename columns in case of previous renaming
-    embedding.columns = list(range(len(embedding.columns)))
-    clusters, _ = get_cluster_labels(embedding)
-    clusters = {c: clusters[c] for c in clusters if c <= max_cluster}
+def aeaa_weights(returns: Union[np.ndarray, pd.DataFrame], embedding: Union[np.ndarray, pd.DataFrame],
+                 context: Optional[PortfolioContext] = None) -> pd.Series:
+    context = get_context(returns, context)
+    # Assets which are in no cluster (label embedding.shape[-1]) are not allocated
+    labels = _embedding_labels(returns, embedding, context)
+    return pd.Series(cluster_equal_weights(labels, embedding.shape[-1]), index=returns.columns)
 
-    # Now get weights of assets inside each cluster
-    cluster_asset_weights = {}
-    cluster_weights = {}
-    cov = returns.cov()
-    for c in clusters:
-        cluster_items = clusters[c]
-        if cluster_items:
-            c_weights = ivp_weights(cov.loc[cluster_items, cluster_items])
-            cluster_var = get_cluster_var(cov, cluster_items, weights=cluster_weights)
-            cluster_asset_weights[c] = c_weights
-            cluster_weights[c] = cluster_var
 
-    cluster_weights = {c: 1 / cluster_weights[c] for c in cluster_weights}
-    cluster_weights = {c: cluster_weights[c] / np.sum(list(cluster_weights.values())) for c in cluster_weights}
-    cluster_weights = {c: cluster_weights[c] * cluster_asset_weights[c] for c in cluster_weights}
+def equal_class_weights(market_budget: pd.DataFrame):
+    _, labels, counts = np.unique(market_budget['market'].values, return_inverse=True, return_counts=True)
+    weights = 1. / counts[labels]
+    weights /= np.sum(weights)
 
-    # Compute asset weight inside global portfolio
-    weights = pd.Series(dtype='float32')
-    for c in cluster_weights:
-        weights = pd.concat([weights, cluster_weights[c]])
-    weights = weights.reindex(returns.columns)  # rerorder
-    weights.fillna(0., inplace=True)
+    return pd.Series(weights, index=market_budget.index)
 
-    return weights
+
+def ae_ivp_weights(returns, embedding, context: Optional[PortfolioContext] = None):
+    context = get_context(returns, context)
+    # Assets which are in no cluster (label embedding.shape[-1]) are not allocated
+    labels = _embedding_labels(returns, embedding, context)
+    cov = context.cov.loc[returns.columns, returns.columns].values
+    return pd.Series(cluster_ivp_weights(cov, labels, embedding.shape[-1]), index=returns.columns)
@@ -4,6 +4,7 @@ from joblib import Parallel, delayed
 import os, logging
 from dl_portfolio.constant import LOG_DIR
 from dl_portfolio.data import load_data
+from dl_portfolio.shared import SharedFrame
 
 if __name__ == "__main__":
     import argparse
@@ -73,9 +74,11 @@ if __name__ == "__main__":
             for i, seed in enumerate(args.seeds):
                 run(config, data, assets, seed=int(seed))
         else:
-            Parallel(n_jobs=args.n_jobs, backend=args.backend)(
-                delayed(run)(config, data, assets, seed=int(seed)) for seed in args.seeds
-            )
+            # Workers attach to the data in shared memory instead of receiving a copy with each task
+            with SharedFrame(data) as shared_data:
+                Parallel(n_jobs=args.n_jobs, backend=args.backend)(
+                    delayed(run)(config, shared_data, assets, seed=int(seed)) for seed in args.seeds
+                )
 
     else:
         if args.n_jobs == 1:
@@ -88,11 +91,12 @@ if __name__ == "__main__":
                 LOGGER.info(f'Experiment {i + 1} finished')
                 LOGGER.info(f'{args.n - i - 1} experiments to go')
         else:
-            if args.seed:
-                Parallel(n_jobs=args.n_jobs, backend=args.backend)(
-                    delayed(run)(config, data, assets, seed=args.seed) for i in range(args.n)
-                )
-            else:
-                Parallel(n_jobs=args.n_jobs, backend=args.backend)(
-                    delayed(run)(config, data, assets, seed=seed) for seed in range(args.n)
-                )
+            with SharedFrame(data) as shared_data:
+                if args.seed:
+                    Parallel(n_jobs=args.n_jobs, backend=args.backend)(
+                        delayed(run)(config, shared_data, assets, seed=args.seed) for i in range(args.n)
+                    )
+                else:
+                    Parallel(n_jobs=args.n_jobs, backend=args.backend)(
+                        delayed(run)(config, shared_data, assets, seed=seed) for seed in range(args.n)
+                    )
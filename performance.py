@@ -10,12 +10,18 @@ import pandas as pd
 import seaborn as sns
 from sklearn import metrics, preprocessing
 
-from dl_portfolio.backtest import bar_plot_weights, backtest_stats, plot_perf, get_ts_weights, get_cv_results, \
-    get_dl_average_weights, cv_portfolio_perf_df
+from dl_portfolio.backtest import bar_plot_weights, backtest_stats, plot_perf, get_ts_weights, get_runs_cv_results, \
+    get_dl_average_weights, get_dl_ensemble_weights
+from dl_portfolio.backtest_engine import cv_portfolio_perf_array, cv_portfolio_perf_drift
+from dl_portfolio.bootstrap import bootstrap_ci
+from dl_portfolio.rolling_metrics import rolling_stats
+from dl_portfolio.volatility_target import LEVERAGE_METHODS
+from dl_portfolio.covariance import COV_METHODS
 from dl_portfolio.cluster import get_cluster_labels, consensus_matrix, rand_score_permutation, \
     assign_cluster_from_consmat
 from dl_portfolio.evaluate import average_prediction, average_prediction_cv
 from dl_portfolio.logger import LOGGER
+from dl_portfolio.markowitz import get_markowitz_history
 from dl_portfolio.constant import BASE_FACTOR_ORDER_DATASET2, BASE_FACTOR_ORDER_DATASET1
 
 PORTFOLIOS = ['equal', 'equal_class', 'aerp', 'hrp', 'hcaa', 'aeerc', 'ae_rp_c', 'aeaa', 'kmaa']
@@ -39,10 +45,51 @@ if __name__ == "__main__":
                         default=2 * os.cpu_count(),
                         type=int,
                         help="Number of parallel jobs")
+    parser.add_argument("--n_threads",
+                        default=None,
+                        type=int,
+                        help="Number of threads computing the portfolios of a fold concurrently")
     parser.add_argument("--window",
                         default=250,
                         type=int,
                         help="Window size for portfolio optimisation")
+    parser.add_argument("--cov_method",
+                        default='sample',
+                        type=str,
+                        choices=COV_METHODS,
+                        help="Covariance estimator of the portfolio optimisation")
+    parser.add_argument("--ensemble",
+                        default=None,
+                        type=str,
+                        help="If 'mean' or 'consensus', compute the AE portfolios once per fold on the ensemble "
+                             "embedding of all runs instead of averaging the weights of each run")
+    parser.add_argument("--bootstrap",
+                        default=0,
+                        type=int,
+                        help="Number of block bootstrap replicas for the confidence intervals of the backtest "
+                             "statistics, 0 to skip")
+    parser.add_argument("--drift",
+                        action='store_true',
+                        help="Backtest with the share level simulator: weights drift with prices between "
+                             "rebalancing dates and costs are computed on the drifted weights")
+    parser.add_argument("--leverage",
+                        default='fold',
+                        type=str,
+                        choices=LEVERAGE_METHODS,
+                        help="Volatility target leverage: once per fold on the train returns, or daily with an EWMA "
+                             "or multi-horizon volatility, daily leverage is not available with --drift")
+    parser.add_argument("--max_leverage",
+                        default=None,
+                        type=float,
+                        help="Maximum leverage of the volatility target")
+    parser.add_argument("--rolling",
+                        default=0,
+                        type=int,
+                        help="Window of the rolling statistics of the strategies, 0 to skip")
+    parser.add_argument("--cache_dir",
+                        default=None,
+                        type=str,
+                        help="Cache the results of each fold in this directory, see clear_cache.py to invalidate it")
     parser.add_argument("--show",
                         action='store_true',
                         help="Show plots")
@@ -125,30 +172,47 @@ if __name__ == "__main__":
 
     LOGGER.info("Main loop to get results and portfolio weights...")
     # Main loop to get results
-    cv_results = {}
     train_cov = {}
     test_cov = {}
     port_perf = {}
+    run_portfolios = []
     for i, path in enumerate(paths):
-        LOGGER.info(len(paths) - i)
         if i == 0:
             portfolios = PORTFOLIOS
         else:
             portfolios = [p for p in PORTFOLIOS if 'ae' in p]  # ['aerp', 'aeerc', 'ae_rp_c']
-        cv_results[i] = get_cv_results(path,
-                                       args.test_set,
-                                       n_folds,
-                                       dataset=config.dataset,
-                                       portfolios=portfolios,
-                                       market_budget=market_budget,
-                                       window=args.window,
-                                       n_jobs=args.n_jobs,
-                                       ae_config=config)
+        if args.ensemble:
+            # AE portfolios are computed on the ensemble embedding
+            portfolios = [p for p in portfolios if 'ae' not in p]
+        run_portfolios.append(portfolios)
+    # The folds of all runs are dispatched at once to a single pool of workers
+    cv_results = get_runs_cv_results(paths,
+                                     args.test_set,
+                                     n_folds,
+                                     dataset=config.dataset,
+                                     portfolios=run_portfolios,
+                                     market_budget=market_budget,
+                                     window=args.window,
+                                     n_jobs=args.n_jobs,
+                                     cache_dir=args.cache_dir,
+                                     cov_method=args.cov_method,
+                                     n_threads=args.n_threads,
+                                     ae_config=config)
     LOGGER.info("Done.")
+    markowitz_history = pd.concat([get_markowitz_history(cv_results[i]).assign(run=i) for i in cv_results])
+    if len(markowitz_history):
+        LOGGER.info(f"Markowitz solves:\n{markowitz_history.groupby(['portfolio', 'status'])['time'].describe()}")
+        if args.save:
+            markowitz_history.to_csv(f"{save_dir}/markowitz_history.csv", index=False)
 
     LOGGER.info("Backtest weights...")
-    # Get average weights for AE portfolio across runs
-    port_weights = get_dl_average_weights(cv_results)
+    if args.ensemble:
+        # Get AE portfolio weights on the ensemble embedding of all runs
+        port_weights = get_dl_ensemble_weights(cv_results, [p for p in PORTFOLIOS if 'ae' in p], market_budget,
+                                               method=args.ensemble)
+    else:
+        # Get average weights for AE portfolio across runs
+        port_weights = get_dl_average_weights(cv_results)
     # Build dictionary for cv_portfolio_perf
     cv_returns = {}
     for cv in cv_results[0]:
@@ -156,7 +220,11 @@ if __name__ == "__main__":
         date = cv_results[0][cv]['returns'].index[0]
         for port in PORTFOLIOS:
             if port not in ['equal', 'equal_class'] and 'ae' not in port:
-                weights = pd.DataFrame(cv_results[0][cv]['port'][port]).T
+                if cv_results[0][cv]['port'][port] is not None:
+                    weights = pd.DataFrame(cv_results[0][cv]['port'][port]).T
+                else:
+                    # Computation failed, the performance will be NaN
+                    weights = pd.DataFrame(np.nan, columns=cv_returns[cv].columns, index=[0])
                 weights.index = [date]
                 port_weights[cv][port] = weights
 
@@ -181,8 +249,14 @@ if __name__ == "__main__":
         } for cv in cv_returns
     }
 
-    port_perf, leverage = cv_portfolio_perf_df(cv_portfolio_df, portfolios=PORTFOLIOS, volatility_target=0.05,
-                                               market_budget=market_budget)
+    if args.drift:
+        assert args.leverage == 'fold', "The share level simulator only supports the fold leverage"
+        port_perf, leverage = cv_portfolio_perf_drift(cv_portfolio_df, portfolios=PORTFOLIOS, volatility_target=0.05,
+                                                      market_budget=market_budget, max_leverage=args.max_leverage)
+    else:
+        port_perf, leverage = cv_portfolio_perf_array(cv_portfolio_df, portfolios=PORTFOLIOS,
+                                                      volatility_target=0.05, market_budget=market_budget,
+                                                      leverage_method=args.leverage, max_leverage=args.max_leverage)
     LOGGER.info("Done.")
 
     K = cv_results[i][0]['loading'].shape[-1]
@@ -323,6 +397,21 @@ if __name__ == "__main__":
     if args.save:
         stats.to_csv(f"{save_dir}/backtest_stats.csv")
     LOGGER.info(stats.to_string())
+    if args.bootstrap:
+        LOGGER.info("Bootstrap confidence intervals...")
+        stats_ci = bootstrap_ci(ann_perf, n_replicas=args.bootstrap, period=250, n_jobs=args.n_jobs)
+        if args.save:
+            stats_ci.to_csv(f"{save_dir}/backtest_stats_ci.csv")
+        LOGGER.info(stats_ci.to_string())
+    if args.rolling:
+        LOGGER.info("Rolling statistics...")
+        # Turnover of the optimized portfolios, backtest_stats adds the weights of the benchmarks
+        rolling = rolling_stats(ann_perf, window=args.rolling, period=250,
+                                weights={p: port_weights[p] for p in port_weights
+                                         if p not in ['equal', 'equal_class']})
+        if args.save:
+            for stat in rolling:
+                rolling[stat].to_csv(f"{save_dir}/rolling_{stat}.csv")
     LOGGER.info("Done with backtest.")
 
     ##########################
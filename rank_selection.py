@@ -0,0 +1,60 @@
+import datetime as dt
+import json
+import logging
+import os
+
+from dl_portfolio.data import load_data
+from dl_portfolio.logger import LOGGER
+from dl_portfolio.nmf.rank_selection import rank_selection
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ranks",
+                        nargs="+",
+                        default=[2, 3, 4, 5, 6, 7, 8],
+                        type=int,
+                        help="List of encoding_dim to evaluate")
+    parser.add_argument("--seeds",
+                        nargs="+",
+                        default=[0, 1, 2],
+                        type=int,
+                        help="Seeds used to measure the cluster stability for each encoding_dim")
+    parser.add_argument("--test_set",
+                        default='val',
+                        type=str,
+                        help="val or test")
+    parser.add_argument("--n_jobs",
+                        default=os.cpu_count(),
+                        type=int,
+                        help="Number of parallel jobs")
+    parser.add_argument("--save",
+                        action='store_true',
+                        help="Save results")
+    parser.add_argument("-v",
+                        "--verbose",
+                        help="Be verbose",
+                        action="store_const",
+                        dest="loglevel",
+                        const=logging.INFO,
+                        default=logging.WARNING)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+    LOGGER.setLevel(args.loglevel)
+
+    from dl_portfolio.config import nmf_config as config
+
+    data, assets = load_data(dataset=config.dataset)
+    summary, cv_results = rank_selection(config, data, assets, args.ranks, seeds=args.seeds, test_set=args.test_set,
+                                         n_jobs=args.n_jobs)
+    print(summary.to_string())
+
+    if args.save:
+        save_dir = f"rank_selection/{config.dataset}_{config.model_type}_" + dt.datetime.now().strftime(
+            "%Y%m%d_%H%M%S")
+        os.makedirs(save_dir)
+        LOGGER.info(f"Saving result to {save_dir}")
+        json.dump(vars(args), open(f"{save_dir}/meta.json", "w"))
+        summary.to_csv(f"{save_dir}/summary.csv")
+        cv_results.to_csv(f"{save_dir}/cv_results.csv")
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from scipy import stats as scipy_stats
+
+from dl_portfolio.backtest import compute_balance, cv_portfolio_perf_df, get_mdd
+from dl_portfolio.backtest_engine import BacktestState, backtest_arrays, cv_portfolio_arrays, cv_portfolio_perf_array, \
+    fold_leverage, simulate_drift
+
+ASSETS = [f'a{i}' for i in range(6)]
+PORTFOLIOS = ['equal', 'equal_class', 'ae_rp_c', 'aeaa', 'hrp']
+
+
+@pytest.fixture
+def market_budget():
+    return pd.DataFrame({'market': list('xxyyzz'), 'rc': 1.}, index=ASSETS)
+
+
+@pytest.fixture
+def cv_portfolio():
+    rng = np.random.RandomState(0)
+    returns = pd.DataFrame(rng.normal(0., 0.01, (1500, len(ASSETS))), index=pd.bdate_range('2015-01-01', periods=1500),
+                           columns=ASSETS)
+    cv_portfolio = {}
+    for cv in range(5):
+        start = 500 + cv * 200
+        test = returns.iloc[start:start + 200]
+        port = {}
+        for p in PORTFOLIOS[2:]:
+            w = rng.random_sample(len(ASSETS))
+            port[p] = pd.DataFrame(np.repeat(w[None] / w.sum(), len(test), axis=0), index=test.index, columns=ASSETS)
+        # Missing weights on a fold, then weights in another column order
+        port['hrp'] = port['hrp'] * np.nan if cv == 2 else port['hrp']
+        port['aeaa'] = port['aeaa'].iloc[:, ::-1]
+        cv_portfolio[cv] = {'returns': test, 'train_returns': returns.iloc[start - 250:start], 'port': port}
+    return cv_portfolio
+
+
+@pytest.mark.parametrize('volatility_target', [0.05, None])
+def test_array_engine_matches_cv_portfolio_perf_df(cv_portfolio, market_budget, volatility_target):
+    expected, expected_leverage = cv_portfolio_perf_df(cv_portfolio, portfolios=PORTFOLIOS,
+                                                       volatility_target=volatility_target,
+                                                       market_budget=market_budget)
+    port_perf, leverage = cv_portfolio_perf_array(cv_portfolio, portfolios=PORTFOLIOS,
+                                                  volatility_target=volatility_target, market_budget=market_budget)
+    for p in PORTFOLIOS:
+        pd.testing.assert_frame_equal(port_perf[p]['total'], expected[p]['total'], check_names=False, check_freq=False,
+                                      check_column_type=False, rtol=1e-12, atol=1e-15)
+    assert port_perf['hrp']['total'].iloc[400:600].isna().all().all()
+    np.testing.assert_allclose(leverage.values, expected_leverage[PORTFOLIOS].values, rtol=1e-12)
+
+
+def test_array_engine_fee_and_reset(cv_portfolio, market_budget):
+    returns, weights, folds, train_returns, fees = cv_portfolio_arrays(cv_portfolio, ['hrp'])
+    port_returns, leverage = backtest_arrays(returns.values, weights, folds, train_returns, fee=fees)
+    no_fee, _ = backtest_arrays(returns.values, weights, folds, train_returns, fee=0.)
+    cost = (no_fee - port_returns) / np.repeat(leverage, np.diff(np.append(folds, len(returns))), axis=1)
+    # Costs at the start of the folds only: from 1 for the first fold and the fold after the missing one
+    dates = np.flatnonzero(np.nan_to_num(cost[0]) > 1e-15)
+    assert list(dates) == [0, 200, 600, 800]
+    np.testing.assert_allclose(cost[0, [0, 600]], 2e-4 * np.abs(weights[0, [0, 600]] - 1.).sum(-1), rtol=1e-10)
+
+
+@pytest.fixture
+def folds_arrays():
+    rng = np.random.RandomState(1)
+    n_dates, n_assets, n_ports = 1000, 5, 4
+    returns = rng.normal(0., 0.01, (n_dates + 300, n_assets))
+    folds = np.array([0, 250, 500, 750])
+    weights = np.empty((n_ports, n_dates, n_assets))
+    for start in folds:
+        w = rng.random_sample((n_ports, n_assets))
+        weights[:, start:start + 250] = (w / w.sum(1, keepdims=True))[:, None]
+    weights[2, 250:500] = np.nan
+    train_returns = [returns[start:start + 300] for start in folds]
+    return returns[300:], weights, folds, train_returns
+
+
+def test_backtest_state_matches_backtest_arrays(folds_arrays, tmp_path):
+    returns, weights, folds, train_returns = folds_arrays
+    fee = np.array([0., 2e-4, 2e-4, 2e-4])
+    expected, _ = backtest_arrays(returns, weights, folds, train_returns, fee=fee)
+
+    state = BacktestState(list('abcd'), list(range(returns.shape[1])), fee=fee)
+    port_returns = []
+    for t in range(len(returns)):
+        if t in folds:
+            state.new_fold(train_returns[list(folds).index(t)], weights[:, t])
+        port_returns.append(state.update(t, returns[t], weights[:, t]))
+        if t == 600:
+            # Restart from a checkpoint
+            state.save(str(tmp_path / 'state.p'))
+            state = BacktestState.load(str(tmp_path / 'state.p'))
+    np.testing.assert_allclose(np.array(port_returns).T, expected, rtol=1e-12, equal_nan=True)
+
+
+def test_backtest_state_moments_match_pandas(folds_arrays):
+    returns, weights, folds, train_returns = folds_arrays
+    port_returns, _ = backtest_arrays(returns, weights, folds, train_returns)
+    state = BacktestState(list('abcd'), list(range(returns.shape[1])))
+    for t in range(len(returns)):
+        if t in folds:
+            state.new_fold(train_returns[list(folds).index(t)], weights[:, t])
+        state.update(t, returns[t], weights[:, t])
+    stats = state.stats()
+
+    perf = pd.DataFrame(port_returns.T, columns=list('abcd'))
+    for p in perf.columns:
+        x = perf[p].dropna()
+        cum_perf = np.cumprod(x + 1)
+        mdd = get_mdd(cum_perf)
+        expected = {
+            'Return': x.mean() * 250,
+            'Volatility': x.std() * np.sqrt(250),
+            'Skewness': x.skew() * (len(x) - 2) / np.sqrt(len(x) * (len(x) - 1)),
+            'Excess kurtosis': scipy_stats.kurtosis(x) - 3,
+            'SR': x.mean() / x.std() * np.sqrt(250),
+            'MDD': mdd,
+            'CR': (cum_perf.iloc[-1] / cum_perf.iloc[0] - 1) / mdd,
+            'CEQ': x.mean() * 250 - x.var() / 2 * 250,
+        }
+        for s in expected:
+            assert np.isclose(stats.loc[p, s], expected[s], rtol=1e-9), (p, s)
+    assert state.n[2] == len(returns) - 250
+
+
+def _share_loop(returns, weights, folds, leverage, fee):
+    """
+    Reference of simulate_drift: number of shares, cash and prices updated date by date
+    """
+    n_ports, n_dates, n_assets = weights.shape
+    port_returns = np.full((n_ports, n_dates), np.nan)
+    for p in range(n_ports):
+        capital, shares, cash, price, prev_weights = 1., np.zeros(n_assets), 1., np.ones(n_assets), None
+        for t in range(n_dates):
+            fold = np.searchsorted(folds, t, side='right') - 1
+            missing = np.all(np.isnan(weights[p, t]))
+            rebalance = t in folds or not np.array_equal(np.nan_to_num(weights[p, t]), np.nan_to_num(prev_weights))
+            start_capital = capital
+            if rebalance:
+                target = np.zeros(n_assets) if missing else leverage[p, fold] * weights[p, t]
+                cost = np.sum(fee * np.abs(target - shares * price / capital))
+                start_capital, capital = capital, capital * (1 - cost)
+                shares, cash = target * capital / price, capital - np.sum(target * capital)
+            prev_weights = weights[p, t]
+            price = price * (1 + returns[t])
+            capital = cash + np.sum(shares * price)
+            port_returns[p, t] = np.nan if missing else capital / start_capital - 1
+    return port_returns
+
+
+def test_simulate_drift_matches_share_loop(folds_arrays):
+    returns, weights, folds, train_returns = folds_arrays
+    # Change of target weights inside a fold
+    weights[1, 100:250] = weights[1, 100:250, ::-1]
+    fee = np.random.RandomState(2).random_sample(returns.shape[1]) * 1e-3
+    port_returns, leverage, turnover = simulate_drift(returns, weights, folds, train_returns, fee=fee)
+    expected = _share_loop(returns, weights, folds, leverage, fee)
+    np.testing.assert_allclose(port_returns, expected, rtol=1e-10, atol=1e-15, equal_nan=True)
+    expected_leverage = fold_leverage(np.nan_to_num(weights), folds, train_returns)
+    expected_leverage[2, 1] = np.nan
+    np.testing.assert_allclose(leverage, expected_leverage, rtol=1e-12)
+    assert np.all(turnover[1, [0, 100, 250, 500, 750]] > 0)
+    assert np.count_nonzero(turnover[1]) == 5
+
+
+def test_simulate_drift_matches_compute_balance(folds_arrays):
+    returns, weights, folds, train_returns = folds_arrays
+    returns, weights = returns[:250], weights[:1, :250]
+    prices = pd.DataFrame(np.cumprod(np.vstack([np.ones(returns.shape[1]), 1 + returns]), axis=0))
+    port_returns, leverage, _, drifted_weights = simulate_drift(returns, weights, folds[:1], train_returns[:1],
+                                                                return_weights=True)
+    # compute_balance starts from cash (null previous weights) and buys leverage * K0 * weights / price shares
+    _, shares, cost = compute_balance(prices, weights[0, 0], 0., 1., leverage=leverage[0, 0])
+    capital = np.cumprod(1 + port_returns[0])
+    np.testing.assert_allclose(drifted_weights[0] * capital[:, None] / prices.values[1:], np.tile(shares, (250, 1)),
+                               rtol=1e-10)
+    assert np.isclose(capital[0], (1 - cost) * (1 + leverage[0, 0] * returns[0] @ weights[0, 0]), rtol=1e-12)
+
+    # Without leverage and with a single asset the shares do not drift: same capital as compute_balance
+    single = returns[:, :1]
+    port_returns, _, _ = simulate_drift(single, np.ones((1, 250, 1)), folds[:1], train_returns[:1],
+                                        volatility_target=None)
+    capital, _, _ = compute_balance(prices.iloc[:, :1], np.ones(1), 0., 1.)
+    np.testing.assert_allclose(np.cumprod(1 + port_returns[0]), capital.values, rtol=1e-10)
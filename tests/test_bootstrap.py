@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dl_portfolio.backtest import get_mdd, hist_ES, hist_VaR, perf_stats
+from dl_portfolio.bootstrap import BOOTSTRAP_STATS, _bootstrap_chunk, bootstrap_ci, bootstrap_stats
+from dl_portfolio.sample import id_nb_bootstrap_batch
+
+
+@pytest.fixture
+def perf():
+    rng = np.random.RandomState(0)
+    return pd.DataFrame(0.01 * rng.standard_t(5, size=(500, 3)) + 0.0005, columns=['a', 'b', 'c'])
+
+
+def test_id_nb_bootstrap_batch():
+    n_obs, block_length = 103, 10
+    _id = id_nb_bootstrap_batch(n_obs, block_length, 200, random_state=0)
+    assert _id.shape == (200, n_obs)
+    blocks = _id[:, ::block_length]
+    # Every block starts at a block start of the series and continues with the next observations, wrapped around
+    assert np.all(blocks % block_length == 0)
+    expected = (np.repeat(blocks, block_length, axis=1)[:, :n_obs] + np.tile(np.arange(block_length), 11)[:n_obs]) \
+        % n_obs
+    np.testing.assert_array_equal(_id, expected)
+    assert len(np.unique(_id)) == n_obs
+    np.testing.assert_array_equal(id_nb_bootstrap_batch(n_obs, block_length, 200, random_state=0), _id)
+
+
+def test_replica_stats_match_backtest_stats(perf):
+    seed = np.random.SeedSequence(1)
+    stats = _bootstrap_chunk(perf.values, 20, 44, 250, seed)
+    _id = id_nb_bootstrap_batch(len(perf), 44, 20, random_state=seed)
+    for r in range(20):
+        replica = perf.iloc[_id[r]].reset_index(drop=True)
+        expected = perf_stats(replica, period=250)[BOOTSTRAP_STATS]
+        np.testing.assert_allclose(stats[:, r, :], expected.values.T, rtol=1e-10)
+        for j, strat in enumerate(perf.columns):
+            x = replica[strat]
+            assert np.isclose(stats[3, r, j], hist_VaR(x.values), rtol=1e-12)
+            assert np.isclose(stats[4, r, j], hist_ES(x.values), rtol=1e-12)
+            assert np.isclose(stats[2, r, j], get_mdd(np.cumprod(x + 1)), rtol=1e-12)
+
+
+def test_bootstrap_does_not_depend_on_chunks_and_jobs(perf):
+    # max_memory of 5 replicas per chunk
+    max_memory = 5 * 8 * perf.size
+    expected = bootstrap_stats(perf, n_replicas=23, max_memory=max_memory)
+    for n_jobs in [None, 2]:
+        stats = bootstrap_stats(perf, n_replicas=23, max_memory=max_memory, n_jobs=n_jobs)
+        for s in BOOTSTRAP_STATS:
+            pd.testing.assert_frame_equal(stats[s], expected[s])
+    assert all(expected[s].shape == (23, 3) for s in BOOTSTRAP_STATS)
+
+
+def test_bootstrap_ci(perf):
+    ci = bootstrap_ci(perf, n_replicas=200)
+    expected = perf_stats(perf, period=250)
+    for s in BOOTSTRAP_STATS:
+        np.testing.assert_allclose(ci[s].values, expected[s].values, rtol=1e-10)
+        assert np.all(ci[f'{s}-lower'] <= ci[f'{s}-upper'])
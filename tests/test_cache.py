@@ -0,0 +1,137 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+from dl_portfolio import backtest
+from dl_portfolio.cache import list_cache, load_cached, one_cv_key, save_cached
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _key(**kwargs):
+    params = dict(artifact='abc', cv=0, test_set='val', window=250, portfolios=['ivp', 'hrp'], market_budget=None,
+                  data_hash='data')
+    params.update(kwargs)
+    return one_cv_key(params.pop('artifact'), params.pop('cv'), params.pop('test_set'), params.pop('window'),
+                      params.pop('portfolios'), params.pop('market_budget'), **params)
+
+
+def _load_module(path, source):
+    with open(path, 'w') as _file:
+        _file.write(source)
+    spec = importlib.util.spec_from_file_location('run_config', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_key_stability(tmp_path):
+    budget = pd.DataFrame({'rc': [1., 2.]}, index=['a', 'b'])
+    assert _key(cov_method='oas', market_budget=budget) == _key(market_budget=budget.copy(), cov_method='oas')
+    assert _key(optimal_num_clusters=np.int64(3)) == _key(optimal_num_clusters=3)
+    keys = {
+        _key(),
+        _key(cv=1),
+        _key(cov_method='oas'),
+        _key(market_budget=budget),
+        _key(market_budget=budget * 2),
+        _key(budget=budget['rc']),
+        _key(rc=np.array([1., 2.])),
+        _key(rc=np.array([1., 3.])),
+        _key(options={'a': [1, 2]}),
+        _key(options={'a': [1, 3]}),
+    }
+    assert len(keys) == 10
+
+    config = _load_module(str(tmp_path / 'run_config.py'), "encoding_dim = 4\n")
+    key = _key(ae_config=config)
+    assert key == _key(ae_config=config)
+    config = _load_module(str(tmp_path / 'run_config.py'), "encoding_dim = 5\n")
+    assert _key(ae_config=config) != key
+
+
+def test_key_rejects_unknown_types():
+    with pytest.raises(ValueError, match='context'):
+        _key(context=object())
+    with pytest.raises(ValueError, match=r'options\[a\]\[0\]'):
+        _key(options={'a': [object()]})
+
+
+def test_atomic_write(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path)
+    save_cached(cache_dir, 'key', {'a': 1}, base_dir='run')
+    assert load_cached(cache_dir, 'key') == {'a': 1}
+
+    def _fail(value, filename, *args, **kwargs):
+        with open(filename, 'wb') as _file:
+            _file.write(b'partial')
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(joblib, 'dump', _fail)
+    with pytest.raises(OSError):
+        save_cached(cache_dir, 'key', {'a': 2}, base_dir='run')
+    # The previous result is untouched and the partial file is removed
+    assert load_cached(cache_dir, 'key') == {'a': 1}
+    assert sorted(os.listdir(cache_dir)) == ['key.joblib', 'key.json']
+
+
+def _run_clear_cache(*args):
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'clear_cache.py'), *args], check=True, cwd=REPO_DIR,
+                   capture_output=True)
+
+
+def test_clear_cache_invalidation(tmp_path):
+    cache_dir = str(tmp_path)
+    save_cached(cache_dir, 'k0', {}, base_dir='runs/m_0', test_set='val')
+    save_cached(cache_dir, 'k1', {}, base_dir='runs/m_0', test_set='test')
+    save_cached(cache_dir, 'k2', {}, base_dir='runs/m_1', test_set='val')
+    with open(tmp_path / 'k2.json') as _file:
+        meta = json.load(_file)
+    meta['created'] = '2020-01-01T00:00:00'
+    with open(tmp_path / 'k2.json', 'w') as _file:
+        json.dump(meta, _file)
+
+    _run_clear_cache('--cache_dir', cache_dir, '--older_than', '1')
+    assert sorted(list_cache(cache_dir).index) == ['k0', 'k1']
+    _run_clear_cache('--cache_dir', cache_dir, '--base_dir', 'runs/m_0/', '--test_set', 'test')
+    assert sorted(list_cache(cache_dir).index) == ['k0']
+    _run_clear_cache('--cache_dir', cache_dir)
+    assert os.listdir(cache_dir) == []
+
+
+def test_cached_one_cv(tmp_path, monkeypatch):
+    base_dir = tmp_path / 'run'
+    (base_dir / '0').mkdir(parents=True)
+    (base_dir / '0' / 'model.h5').write_bytes(b'weights')
+    cache_dir = str(tmp_path / 'cache')
+    data = pd.DataFrame({'a': [1., 2., 3.], 'b': [2., 1., 3.]})
+    budget = pd.DataFrame({'rc': [1., 2.]}, index=['a', 'b'])
+    calls = []
+
+    def _one_cv(data, assets, base_dir, cv, test_set, portfolios, **kwargs):
+        calls.append(kwargs)
+        return cv, {'calls': len(calls)}
+
+    monkeypatch.setattr(backtest, 'one_cv', _one_cv)
+
+    def _cached(**kwargs):
+        return backtest.cached_one_cv(cache_dir, data, ['a', 'b'], str(base_dir), 0, 'val', ['ivp'],
+                                      market_budget=budget, **kwargs)[1]['calls']
+
+    assert _cached(cov_method='sample') == 1
+    # The returns and the number of threads do not change the result
+    assert _cached(cov_method='sample', data_returns=data.pct_change(1).dropna(), n_threads=4) == 1
+    assert calls[0]['n_threads'] is None
+    assert _cached(cov_method='oas') == 2
+    # A new artifact of the fold invalidates the result
+    (base_dir / '0' / 'model.h5').write_bytes(b'new weights')
+    assert _cached(cov_method='sample') == 3
+    with pytest.raises(ValueError):
+        _cached(cov_method='sample', strategy=lambda x: x)
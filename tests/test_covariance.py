@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sklearn.covariance import LedoitWolf, OAS
+
+from dl_portfolio.context import PortfolioContext, get_context
+from dl_portfolio.covariance import COV_METHODS, FactorCovariance, ewma_cov, factor_covariance, get_covariance
+from dl_portfolio.weights import portfolio_weights
+
+ASSETS = ['a', 'b', 'c', 'd']
+
+
+@pytest.fixture
+def returns():
+    rng = np.random.RandomState(0)
+    factor = rng.randn(300, 1)
+    x = 0.01 * (factor * np.array([1., 0.8, 0.5, 0.2]) + rng.randn(300, len(ASSETS)) * np.array([0.5, 1., 1.5, 2.]))
+    return pd.DataFrame(x, index=pd.date_range('2020-01-01', periods=300), columns=ASSETS)
+
+
+def test_get_covariance(returns):
+    pd.testing.assert_frame_equal(get_covariance(returns, 'sample'), returns.cov())
+    np.testing.assert_allclose(get_covariance(returns, 'ledoit_wolf').values,
+                               LedoitWolf().fit(returns.values).covariance_)
+    np.testing.assert_allclose(get_covariance(returns, 'oas').values, OAS().fit(returns.values).covariance_)
+    for method in COV_METHODS:
+        cov = get_covariance(returns, method)
+        assert cov.index.equals(returns.columns) and cov.columns.equals(returns.columns)
+    with pytest.raises(NotImplementedError):
+        get_covariance(returns, 'unknown')
+
+
+def test_ewma_cov_matches_pandas(returns):
+    expected = returns.ewm(halflife=60).cov().loc[returns.index[-1]]
+    np.testing.assert_allclose(ewma_cov(returns, halflife=60).values, expected.values, rtol=1e-10)
+
+
+def test_factor_covariance_operations():
+    rng = np.random.RandomState(1)
+    loadings = pd.DataFrame(rng.randn(len(ASSETS), 2), index=ASSETS)
+    S = FactorCovariance(loadings, np.array([[2., 0.5], [0.5, 1.]]), rng.uniform(0.1, 0.2, len(ASSETS)))
+    dense = S.values
+    x = rng.randn(len(ASSETS))
+    np.testing.assert_allclose(S.diag(), np.diag(dense))
+    np.testing.assert_allclose(S.dot(x), dense.dot(x))
+    np.testing.assert_allclose(S.quad(x), x.dot(dense).dot(x))
+    F = S.factor()
+    np.testing.assert_allclose(F.dot(F.T) + np.diag(S.specific_var), dense)
+
+
+def test_factor_covariance_estimation(returns):
+    loadings = pd.DataFrame(np.array([[1., 0.8, 0.5, 0.2]]).T, index=ASSETS)
+    S = factor_covariance(returns, loadings)
+    # the sample covariance is the factor covariance plus the covariance of the residuals
+    x = returns.values - returns.values.mean(0)
+    factors = x.dot(loadings.values) / np.sum(loadings.values ** 2)
+    np.testing.assert_allclose(S.factor_cov, np.var(factors, ddof=1).reshape(1, 1))
+    np.testing.assert_allclose(S.specific_var, np.var(x - factors.dot(loadings.values.T), axis=0, ddof=1))
+    # given specific variance
+    specific_var = pd.Series([1., 2., 3., 4.], index=ASSETS[::-1])
+    S = factor_covariance(returns, loadings, specific_var=specific_var)
+    np.testing.assert_allclose(S.specific_var, [4., 3., 2., 1.])
+
+
+@pytest.mark.parametrize('cov_method', COV_METHODS)
+def test_portfolio_weights_cov_method(returns, cov_method):
+    budget = pd.DataFrame({'rc': [1., 1., 1., 1.]}, index=ASSETS)
+    weights = portfolio_weights(returns, budget=budget, portfolio=['ivp', 'rp'], cov_method=cov_method)
+    cov = get_covariance(returns, cov_method)
+    ivp = 1. / np.diag(cov.values)
+    np.testing.assert_allclose(weights['ivp'].values, ivp / ivp.sum())
+    # equal risk contributions on the covariance of cov_method
+    w = weights['rp'].values
+    rc = w * cov.values.dot(w)
+    np.testing.assert_allclose(rc / rc.sum(), 0.25, atol=1e-6)
+
+
+def test_context_cov_method(returns):
+    context = PortfolioContext(returns, cov_method='ledoit_wolf')
+    pd.testing.assert_frame_equal(context.cov, get_covariance(returns, 'ledoit_wolf'))
+    assert get_context(returns, context) is context
+    assert get_context(returns, context, cov_method='ledoit_wolf') is context
+    with pytest.raises(AssertionError):
+        get_context(returns, context, cov_method='sample')
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from scipy.cluster.hierarchy import fcluster, leaves_list, to_tree
+
+from dl_portfolio.hierarchical import get_linkage, herc, hrp, hrp_batch
+
+
+def _ivp_var(cov, items):
+    sub = cov[np.ix_(items, items)]
+    w = 1. / np.diag(sub)
+    w = w / w.sum()
+    return w.dot(sub).dot(w)
+
+
+def _reference_hrp(cov, link):
+    # Recursive bisection of Lopez de Prado (2016), Advances in Financial Machine Learning, snippet 16.3
+    sort_ix = list(leaves_list(link))
+    w = pd.Series(1., index=sort_ix)
+    c_items = [sort_ix]
+    while len(c_items) > 0:
+        c_items = [i[j:k] for i in c_items for j, k in ((0, len(i) // 2), (len(i) // 2, len(i))) if len(i) > 1]
+        for i in range(0, len(c_items), 2):
+            c_items0, c_items1 = c_items[i], c_items[i + 1]
+            c_var0, c_var1 = _ivp_var(cov, c_items0), _ivp_var(cov, c_items1)
+            alpha = 1 - c_var0 / (c_var0 + c_var1)
+            w[c_items0] *= alpha
+            w[c_items1] *= 1 - alpha
+    return w.sort_index().values
+
+
+def _block_returns(block_sizes, n_obs=1000, seed=0):
+    # Assets of a block share a common factor, blocks are independent
+    rng = np.random.RandomState(seed)
+    returns = []
+    for size in block_sizes:
+        factor = rng.randn(n_obs, 1)
+        returns.append(factor + 0.3 * rng.randn(n_obs, size) * rng.uniform(0.5, 2., size))
+    return np.concatenate(returns, axis=1) * 0.01
+
+
+@pytest.fixture
+def returns():
+    return _block_returns([3, 4, 5])
+
+
+def test_hrp_matches_reference(returns):
+    cov = np.cov(returns, rowvar=False)
+    link = get_linkage(np.corrcoef(returns, rowvar=False))
+    weights = hrp(cov, link)
+    np.testing.assert_allclose(weights, _reference_hrp(cov, link), rtol=1e-12)
+    assert np.isclose(weights.sum(), 1.)
+
+
+def test_hrp_batch_matches_single_problems():
+    covs, orders, expected = [], [], []
+    for seed in range(4):
+        returns = _block_returns([3, 4, 5], seed=seed)
+        cov = np.cov(returns, rowvar=False)
+        link = get_linkage(np.corrcoef(returns, rowvar=False))
+        covs.append(cov)
+        orders.append(leaves_list(link))
+        expected.append(hrp(cov, link))
+    np.testing.assert_allclose(hrp_batch(np.stack(covs), np.stack(orders)), np.stack(expected), rtol=1e-12)
+
+
+def test_herc_cluster_risk_split(returns):
+    cov = np.cov(returns, rowvar=False)
+    link = get_linkage(np.corrcoef(returns, rowvar=False))
+    labels = fcluster(link, 3, criterion='maxclust')
+    clusters = [np.where(labels == c)[0] for c in np.unique(labels)]
+    # the three blocks are recovered
+    assert sorted(len(c) for c in clusters) == [3, 4, 5]
+
+    weights = herc(cov, link, 3, risk_measure='variance')
+    risk = {c: _ivp_var(cov, items) for c, items in zip(np.unique(labels), clusters)}
+    # first split of the tree: one cluster against the two others, whose risk is the sum of their risks
+    left_clusters = np.unique(labels[to_tree(link).get_left().pre_order()])
+    right_clusters = np.setdiff1d(np.unique(labels), left_clusters)
+    risk_left = sum(risk[c] for c in left_clusters)
+    risk_right = sum(risk[c] for c in right_clusters)
+    alpha = 1 - risk_left / (risk_left + risk_right)
+    np.testing.assert_allclose(weights[np.isin(labels, left_clusters)].sum(), alpha, rtol=1e-12)
+    # inverse variance weights inside a cluster
+    for items in clusters:
+        ivp = 1. / np.diag(cov)[items]
+        np.testing.assert_allclose(weights[items] / weights[items].sum(), ivp / ivp.sum(), rtol=1e-12)
+    assert np.isclose(weights.sum(), 1.)
+
+
+def test_hcaa_equal_weighting(returns):
+    cov = np.cov(returns, rowvar=False)
+    link = get_linkage(np.corrcoef(returns, rowvar=False))
+    labels = fcluster(link, 2, criterion='maxclust')
+    weights = herc(cov, link, 2, risk_measure='equal_weighting')
+    for c in np.unique(labels):
+        np.testing.assert_allclose(weights[labels == c], 0.5 / np.sum(labels == c))
+
+
+def test_herc_matches_portfoliolab(returns):
+    herc_module = pytest.importorskip('portfoliolab.clustering.herc')
+    frame = pd.DataFrame(returns, columns=[f'a{i}' for i in range(returns.shape[1])])
+    cov = frame.cov()
+    link = get_linkage(frame.corr().values)
+    reference = herc_module.HierarchicalEqualRiskContribution()
+    reference.allocate(asset_names=frame.columns, asset_returns=frame, covariance_matrix=cov,
+                       risk_measure='variance', optimal_num_clusters=3, linkage='single')
+    np.testing.assert_allclose(herc(cov.values, link, 3, risk_measure='variance'),
+                               reference.weights.T.loc[frame.columns].values.ravel(), rtol=1e-6)
+
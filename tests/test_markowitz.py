@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dl_portfolio.covariance import FactorCovariance
+from dl_portfolio.markowitz import MarkowitzEngine, get_markowitz_engine, get_markowitz_history
+
+ASSETS = ['a', 'b', 'c', 'd', 'e']
+
+
+@pytest.fixture
+def cov():
+    rng = np.random.RandomState(0)
+    x = rng.randn(500, len(ASSETS)) * np.linspace(0.01, 0.02, len(ASSETS))
+    return pd.DataFrame(np.cov(x, rowvar=False), index=ASSETS, columns=ASSETS)
+
+
+def _interior_mu(cov, seed=1):
+    # The max Sharpe portfolio of mu = S w is w / sum(w) when w > 0
+    w = np.random.RandomState(seed).uniform(0.5, 1.5, len(ASSETS))
+    return pd.Series(cov.values.dot(w), index=ASSETS), pd.Series(w / w.sum(), index=ASSETS)
+
+
+def test_max_sharpe_interior_solution(cov):
+    mu, expected = _interior_mu(cov)
+    weights = MarkowitzEngine(ASSETS).max_sharpe(mu, cov)
+    np.testing.assert_allclose(weights.values, expected.values, atol=1e-4)
+
+
+def test_max_sharpe_long_only(cov):
+    mu = pd.Series([0.001, -0.002, 0.0005, -0.001, 0.002], index=ASSETS)
+    weights = MarkowitzEngine(ASSETS).max_sharpe(mu, cov)
+    assert np.all(weights >= 0)
+    assert np.isclose(weights.sum(), 1)
+    # assets with a negative expected return are not held as they are positively correlated with the others
+    excess = mu.values
+    sharpe = excess.dot(weights) / np.sqrt(weights.dot(cov.values).dot(weights))
+    rng = np.random.RandomState(0)
+    for w in rng.dirichlet(np.ones(len(ASSETS)), 200):
+        assert excess.dot(w) / np.sqrt(w.dot(cov.values).dot(w)) <= sharpe + 1e-6
+
+
+def test_max_sharpe_all_negative_expected_returns(cov):
+    mu = pd.Series(-0.001, index=ASSETS)
+    with pytest.raises(ValueError):
+        MarkowitzEngine(ASSETS).max_sharpe(mu, cov)
+
+
+def test_factor_covariance_matches_dense(cov):
+    rng = np.random.RandomState(2)
+    loadings = pd.DataFrame(rng.uniform(0, 0.01, (len(ASSETS), 2)), index=ASSETS)
+    S = FactorCovariance(loadings, np.array([[1., 0.3], [0.3, 2.]]), rng.uniform(1e-5, 2e-5, len(ASSETS)))
+    mu, _ = _interior_mu(S.to_frame())
+    engine = MarkowitzEngine(ASSETS)
+    weights = engine.max_sharpe(mu, S)
+    np.testing.assert_allclose(weights.values, engine.max_sharpe(mu, S.to_frame()).values, atol=1e-4)
+
+
+def test_problems_do_not_share_variables(cov):
+    engine = MarkowitzEngine(ASSETS)
+    factor_problem = engine._factor_problem(2)
+    assert factor_problem['y'] is not engine._dense_problem['y']
+    assert factor_problem['excess_mu'] is not engine._dense_problem['excess_mu']
+
+
+def test_threads_share_an_engine(cov):
+    engine = MarkowitzEngine(ASSETS)
+    mus = [_interior_mu(cov, seed=seed) for seed in range(20)]
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda m: engine.max_sharpe(m[0], cov), mus))
+    for weights, (_, expected) in zip(results, mus):
+        np.testing.assert_allclose(weights.values, expected.values, atol=1e-4)
+
+
+def test_engine_is_shared_per_universe():
+    assert get_markowitz_engine(ASSETS) is get_markowitz_engine(list(ASSETS))
+    assert get_markowitz_engine(ASSETS) is not get_markowitz_engine(ASSETS[:-1])
+
+
+def test_markowitz_history(cov):
+    mu, _ = _interior_mu(cov)
+    engine = MarkowitzEngine(ASSETS)
+    cv_results = {}
+    for cv in range(2):
+        info = {}
+        engine.max_sharpe(mu, cov, fold=cv, info=info)
+        cv_results[cv] = {'markowitz': {'markowitz': info}}
+    history = get_markowitz_history(cv_results)
+    assert list(history.columns) == ['fold', 'portfolio', 'time', 'status', 'solver']
+    assert history['fold'].tolist() == [0, 1]
+    assert (history['status'] == 'optimal').all()
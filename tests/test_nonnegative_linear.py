@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import scipy.optimize as sopt
+
+from sklearn.base import clone
+
+from dl_portfolio.regressors.nonnegative_linear.base import NonnegativeLinear, _solve_nnls_gram, nonnegative_regression
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    X = rng.randn(100, 8)
+    y = X.dot(rng.randn(8, 20)) + rng.randn(100, 20)
+    return X, y
+
+
+def _scipy_nnls(X, y):
+    return np.stack([sopt.nnls(X, y[:, i])[0] for i in range(y.shape[1])])
+
+
+def test_gram_solver_matches_scipy(data):
+    X, y = data
+    coef, res = nonnegative_regression(X, y, solver='gram')
+    coef_scipy, res_scipy = nonnegative_regression(X, y, solver='scipy')
+    np.testing.assert_allclose(coef, _scipy_nnls(X, y), atol=1e-8)
+    np.testing.assert_allclose(res, res_scipy, rtol=1e-8)
+
+
+def test_gram_solver_warm_start(data):
+    X, y = data
+    XtX, Xty = X.T.dot(X), X.T.dot(y)
+    coef, n_iter = _solve_nnls_gram(XtX, Xty)
+    coef_warm, n_iter_warm = _solve_nnls_gram(XtX, Xty, coef_init=coef)
+    np.testing.assert_allclose(coef_warm, coef, atol=1e-10)
+    # the support of the solution is already optimal
+    assert np.all(n_iter_warm == 0)
+    assert np.all(n_iter > 0)
+
+
+def test_gram_solver_single_target(data):
+    X, y = data
+    coef, _ = nonnegative_regression(X, y[:, 0])
+    assert coef.shape == (X.shape[1],)
+    np.testing.assert_allclose(coef, sopt.nnls(X, y[:, 0])[0], atol=1e-8)
+
+
+def test_estimator_params_survive_clone(data):
+    X, y = data
+    reg = NonnegativeLinear(max_iter=2, tol=1e-6)
+    assert reg.get_params() == {'solver': 'gram', 'max_iter': 2, 'tol': 1e-6}
+    cloned = clone(reg)
+    assert cloned.get_params() == reg.get_params()
+    # max_iter is used by the fit of the clone
+    coef = cloned.fit(X, y).coef_
+    coef_full = NonnegativeLinear().fit(X, y).coef_
+    assert not np.allclose(coef, coef_full)
+
+
+@pytest.mark.parametrize('params', [{'max_iter': 0}, {'max_iter': 1.5}, {'tol': -1.}, {'solver': 'scipy', 'tol': 1e-6}])
+def test_estimator_invalid_params(data, params):
+    X, y = data
+    with pytest.raises(ValueError):
+        NonnegativeLinear(**params).fit(X, y)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from sklearn.base import clone
+
+from dl_portfolio.regressors.nonnegative_linear.ridge import NonnegativeRidge, nonnegative_ridge_path, \
+    nonnegative_ridge_regression
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    X = rng.randn(100, 8)
+    y = X.dot(rng.randn(8, 5)) + rng.randn(100, 5)
+    return X, y
+
+
+@pytest.mark.parametrize('alpha', [0.5, np.linspace(0.1, 2., 8)])
+def test_gram_solver_matches_slsqp(data, alpha):
+    X, y = data
+    coef, res = nonnegative_ridge_regression(X, y, alpha, solver='gram')
+    coef_slsqp, res_slsqp = nonnegative_ridge_regression(X, y, alpha, solver='SLSQP', tol=1e-12,
+                                                         options={'maxiter': 1000})
+    np.testing.assert_allclose(coef, coef_slsqp, atol=1e-4)
+    np.testing.assert_allclose(res, res_slsqp, rtol=1e-6)
+    # KKT conditions of min ||Xc - y||^2 + ||alpha c||^2 s.t. c >= 0
+    alpha = np.broadcast_to(alpha, X.shape[1])
+    grad = (X.T.dot(X) + np.diag(alpha ** 2)).dot(coef.T) - X.T.dot(y)
+    assert np.all(coef >= 0)
+    np.testing.assert_allclose(grad[coef.T > 0], 0., atol=1e-8)
+    assert np.all(grad[coef.T == 0] >= -1e-8)
+
+
+def test_path_matches_independent_fits(data):
+    X, y = data
+    alphas, coefs = nonnegative_ridge_path(X, y, [0.1, 1., 10.])
+    for i, alpha in enumerate(alphas):
+        coef, _ = nonnegative_ridge_regression(X, y, alpha)
+        np.testing.assert_allclose(coefs[:, :, i], coef, atol=1e-10)
+
+
+@pytest.mark.filterwarnings('ignore:Optimization was not a success')
+@pytest.mark.parametrize('solver', ['gram', 'SLSQP'])
+def test_estimator_params_survive_clone(data, solver):
+    X, y = data
+    reg = NonnegativeRidge(alpha=0.5, solver=solver, max_iter=1, tol=1e-6)
+    cloned = clone(reg)
+    assert cloned.get_params() == {'alpha': 0.5, 'solver': solver, 'max_iter': 1, 'tol': 1e-6}
+    coef = cloned.fit(X, y).coef_
+    coef_full = NonnegativeRidge(alpha=0.5, solver=solver).fit(X, y).coef_
+    assert not np.allclose(coef, coef_full)
+
+
+@pytest.mark.parametrize('params', [{'max_iter': -1}, {'tol': 'a'}])
+def test_estimator_invalid_params(data, params):
+    X, y = data
+    with pytest.raises(ValueError):
+        NonnegativeRidge(**params).fit(X, y)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from dl_portfolio.riskparity import risk_contribution, riskparity, riskparity_batch
+
+
+def _problems(n_problems, n_assets, seed=0):
+    rng = np.random.RandomState(seed)
+    covs, budgets = [], []
+    for _ in range(n_problems):
+        returns = rng.standard_normal((250, n_assets)) @ rng.standard_normal((n_assets, n_assets)) * 0.01
+        covs.append(np.cov(returns, rowvar=False))
+        budget = rng.uniform(0.1, 1, n_assets)
+        budgets.append(budget / budget.sum())
+    return np.array(covs), np.array(budgets)
+
+
+@pytest.mark.parametrize('n_assets', [2, 5, 30])
+def test_risk_contributions_match_budget(n_assets):
+    covs, budgets = _problems(50, n_assets)
+    weights = riskparity_batch(covs, budgets)
+    assert np.all(weights > 0)
+    np.testing.assert_allclose(weights.sum(1), 1.)
+    np.testing.assert_allclose(risk_contribution(weights, covs), budgets, atol=1e-9)
+
+
+def test_uncorrelated_closed_form():
+    vol = np.array([0.1, 0.2, 0.4])
+    budget = np.array([0.5, 0.3, 0.2])
+    expected = np.sqrt(budget) / vol
+    np.testing.assert_allclose(riskparity(np.diag(vol ** 2), budget), expected / expected.sum(), rtol=1e-10)
+
+
+def test_batch_of_different_sizes_and_warm_start():
+    covs_5, budgets_5 = _problems(3, 5, seed=1)
+    covs_8, budgets_8 = _problems(3, 8, seed=2)
+    covs = list(covs_5) + list(covs_8)
+    budgets = list(budgets_5) + list(budgets_8)
+    weights = riskparity_batch(covs, budgets)
+    for w, c, b in zip(weights, covs, budgets):
+        np.testing.assert_allclose(w, riskparity(c, b), atol=1e-10)
+    # Warm start from a perturbed solution and scale invariance
+    x0 = [w * np.linspace(0.8, 1.2, len(w)) for w in weights]
+    for w, w0 in zip(weights, riskparity_batch([c * 1e4 for c in covs], budgets, x0=x0)):
+        np.testing.assert_allclose(w0, w, atol=1e-10)
+
+
+def test_null_budget_is_the_problem_without_the_asset():
+    covs, budgets = _problems(20, 6, seed=3)
+    budgets[:, 0] = 0.
+    weights = riskparity_batch(covs, budgets)
+    np.testing.assert_array_equal(weights[:, 0], 0.)
+    np.testing.assert_allclose(weights[:, 1:], riskparity_batch(covs[:, 1:, 1:], budgets[:, 1:]), atol=1e-10)
+
+
+def test_match_riskparityportfolio():
+    rp = pytest.importorskip('riskparityportfolio')
+    covs, budgets = _problems(20, 10, seed=4)
+    weights = riskparity_batch(covs, budgets)
+    expected = np.array([rp.RiskParityPortfolio(covariance=c, budget=b).weights for c, b in zip(covs, budgets)])
+    np.testing.assert_allclose(weights, expected, atol=1e-6)
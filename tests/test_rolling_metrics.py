@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dl_portfolio.backtest import get_mdd, hist_ES, hist_VaR, total_average_turnover
+from dl_portfolio.rolling_metrics import rolling_mdd, rolling_moments, rolling_stats, rolling_turnover, \
+    rolling_var_es
+
+
+@pytest.fixture
+def perf():
+    rng = np.random.RandomState(0)
+    perf = pd.DataFrame(0.01 * rng.standard_t(4, size=(400, 4)), index=pd.date_range('2020-01-01', periods=400),
+                        columns=['a', 'b', 'c', 'd'])
+    # Ties in the tail of the window
+    perf.iloc[100:140, 2] = np.round(perf.iloc[100:140, 2], 3)
+    perf.iloc[200, 1] = np.nan
+    return perf
+
+
+def _naive(perf, window, func):
+    return perf.rolling(window).apply(func, raw=True)
+
+
+@pytest.mark.parametrize('window', [20, 63])
+@pytest.mark.parametrize('level', [0.05, 0.01])
+@pytest.mark.parametrize('chunk_size', [2 ** 22, 100])
+def test_rolling_var_es(perf, window, level, chunk_size):
+    var, es = rolling_var_es(perf, window, level=level, chunk_size=chunk_size)
+    pd.testing.assert_frame_equal(var, _naive(perf, window, lambda x: hist_VaR(x, level=level)), rtol=1e-12)
+    pd.testing.assert_frame_equal(es, _naive(perf, window, lambda x: hist_ES(x, level=level)), rtol=1e-12)
+
+
+def test_rolling_moments_and_mdd(perf):
+    window = 50
+    mean, var = rolling_moments(perf, window)
+    pd.testing.assert_frame_equal(mean, perf.rolling(window).mean(), rtol=1e-8)
+    pd.testing.assert_frame_equal(var, perf.rolling(window).var(), rtol=1e-6)
+    mdd = rolling_mdd(perf, window)
+    expected = _naive(perf, window, lambda x: get_mdd(pd.Series(np.cumprod(x + 1))))
+    pd.testing.assert_frame_equal(mdd, expected, rtol=1e-10)
+
+
+def test_rolling_turnover():
+    rng = np.random.RandomState(1)
+    index = pd.date_range('2020-01-01', periods=12, freq='MS')
+    weights = {p: pd.DataFrame(rng.dirichlet(np.ones(3), size=12), index=index) for p in ['ivp', 'hrp']}
+    turnover = rolling_turnover(weights, 4)
+    for p in weights:
+        for t in range(4, 12):
+            assert np.isclose(turnover[p].iloc[t], total_average_turnover(weights[p].iloc[t - 4:t + 1]))
+        assert turnover[p].iloc[:4].isna().all()
+
+
+def test_rolling_stats_turnover(perf):
+    index = perf.index[::20]
+    rng = np.random.RandomState(2)
+    weights = {p: pd.DataFrame(rng.dirichlet(np.ones(3), size=len(index)), index=index) for p in ['a', 'b']}
+    stats = rolling_stats(perf, window=100, weights=weights)
+    # 100 observations contain 5 rebalancings
+    expected = rolling_turnover(weights, 5)
+    assert list(stats['TTO'].columns) == ['a', 'b']
+    assert stats['TTO'].index.equals(perf.index)
+    pd.testing.assert_frame_equal(stats['TTO'].loc[index], expected)
+    pd.testing.assert_frame_equal(stats['TTO'].iloc[121:139], expected.iloc[[6] * 18].set_axis(perf.index[121:139]))
+    assert 'TTO' not in rolling_stats(perf, window=100)
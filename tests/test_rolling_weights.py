@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dl_portfolio import weights as weights_module
+from dl_portfolio.rolling_weights import RollingMoments, rolling_portfolio_weights
+from dl_portfolio.weights import portfolio_weights
+
+ASSETS = ['a', 'b', 'c', 'd', 'e']
+
+
+@pytest.fixture
+def returns():
+    rng = np.random.RandomState(0)
+    x = 0.01 * rng.randn(200, len(ASSETS)) * np.linspace(0.5, 2., len(ASSETS)) + 0.0005
+    return pd.DataFrame(x, index=pd.date_range('2020-01-01', periods=200), columns=ASSETS)
+
+
+@pytest.fixture
+def budget():
+    return pd.DataFrame({'rc': [1., 1., 1., 2., 2.]}, index=ASSETS)
+
+
+def test_rolling_moments_match_pandas(returns):
+    window = 50
+    values = returns.values
+    moments = RollingMoments(len(ASSETS))
+    moments.reset(values[:window])
+    expected_cov = returns.rolling(window).cov()
+    expected_mean = returns.rolling(window).mean()
+    for t in range(window, len(values)):
+        moments.add(values[t])
+        moments.remove(values[t - window])
+        date = returns.index[t]
+        np.testing.assert_allclose(moments.mean, expected_mean.loc[date].values, rtol=1e-10, atol=1e-14)
+        np.testing.assert_allclose(moments.cov, expected_cov.loc[date].values, rtol=1e-8, atol=1e-14)
+
+
+@pytest.mark.parametrize('refresh', [None, 10])
+def test_rolling_weights_match_daily_recomputation(returns, budget, refresh):
+    window = 60
+    dates = returns.index[100:130]
+    portfolios = ['ivp', 'hrp', 'markowitz', 'rp']
+    weights = rolling_portfolio_weights(returns, dates, portfolios, window=window, budget=budget, refresh=refresh)
+    for i, date in enumerate(dates):
+        p = returns.index.get_loc(date)
+        expected = portfolio_weights(returns.iloc[p - window:p], budget=budget, portfolio=portfolios)
+        for port in ['ivp', 'hrp']:
+            np.testing.assert_allclose(weights[port].loc[date].values, expected[port].values, rtol=1e-8)
+        for port in ['markowitz', 'rp']:
+            np.testing.assert_allclose(weights[port].loc[date].values, expected[port].values, atol=1e-4)
+
+
+def test_rolling_weights_failed_portfolio(returns, budget):
+    window = 60
+    # All expected returns are negative on the first windows: markowitz fails on these dates
+    returns = returns.copy()
+    returns.iloc[:100] -= 0.01
+    dates = returns.index[100:200]
+    weights = rolling_portfolio_weights(returns, dates, ['ivp', 'markowitz'], window=window)
+    markowitz = weights['markowitz']
+    assert markowitz.shape == (len(dates), len(ASSETS))
+    failed = markowitz.isna().all(axis=1)
+    # NaN until the first window with a positive expected return
+    assert failed.iloc[0] and not failed.iloc[-1]
+    assert not failed.iloc[failed.values.argmin():].any()
+    assert not weights['ivp'].isna().any().any()
+
+
+def test_rolling_weights_carry_forward(returns, monkeypatch):
+    markowitz_weights = weights_module.markowitz_weights
+    calls = []
+
+    def failing_markowitz_weights(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 3:
+            raise ValueError('solver failure')
+        return markowitz_weights(*args, **kwargs)
+
+    monkeypatch.setattr(weights_module, 'markowitz_weights', failing_markowitz_weights)
+    dates = returns.index[100:105]
+    weights = rolling_portfolio_weights(returns, dates, ['ivp', 'markowitz'], window=60)
+    pd.testing.assert_series_equal(weights['markowitz'].iloc[2], weights['markowitz'].iloc[1], check_names=False)
+    assert not weights['markowitz'].iloc[3].equals(weights['markowitz'].iloc[2])
@@ -0,0 +1,73 @@
+import multiprocessing
+import pickle
+
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from joblib import Parallel, delayed
+
+from dl_portfolio.shared import SharedFrame, as_frame
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.RandomState(0)
+    return pd.DataFrame(rng.randn(1000, 20), index=pd.date_range('2000-01-01', periods=1000),
+                        columns=[f'a{i}' for i in range(20)])
+
+
+def _worker_sum(data, column):
+    frame = as_frame(data)
+    return frame[column].sum(), frame.index[-1], frame.values.flags.writeable
+
+
+def _attach_and_exit(shared, queue):
+    queue.put(float(as_frame(shared).values.sum()))
+
+
+def _exists(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    shm.close()
+    return True
+
+
+def test_shared_frame_in_process(frame):
+    with SharedFrame(frame) as shared:
+        pd.testing.assert_frame_equal(as_frame(shared), frame)
+        assert not shared.values.flags.writeable
+        # Only the name, the index and the columns are pickled
+        assert len(pickle.dumps(shared)) < frame.values.nbytes / 4
+        loaded = pickle.loads(pickle.dumps(shared))
+        pd.testing.assert_frame_equal(loaded.frame, frame)
+        with pytest.raises(AssertionError):
+            loaded.unlink()
+    assert not _exists(shared.name)
+    assert as_frame(frame) is frame
+
+
+def test_shared_frame_joblib_workers(frame):
+    with SharedFrame(frame) as shared:
+        results = Parallel(n_jobs=2)(delayed(_worker_sum)(shared, c) for c in frame.columns)
+        for c, (total, last_date, writeable) in zip(frame.columns, results):
+            assert np.isclose(total, frame[c].sum(), rtol=1e-12)
+            assert last_date == frame.index[-1]
+            assert not writeable
+
+        # A worker which exits does not release the block of the parent
+        ctx = multiprocessing.get_context('spawn')
+        queue = ctx.Queue()
+        process = ctx.Process(target=_attach_and_exit, args=(shared, queue))
+        process.start()
+        total = queue.get(timeout=60)
+        process.join(60)
+        assert process.exitcode == 0
+        assert np.isclose(total, frame.values.sum(), rtol=1e-12)
+        assert _exists(shared.name)
+        pd.testing.assert_frame_equal(as_frame(shared), frame)
+    assert not _exists(shared.name)
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dl_portfolio.volatility_target import daily_fold_leverage, daily_leverage, ewma_volatility, \
+    multi_horizon_volatility, rolling_multi_horizon_volatility, target_leverage
+
+
+@pytest.fixture
+def port_returns():
+    rng = np.random.RandomState(0)
+    return rng.normal(0., 0.01, (3, 300)) * np.array([[0.5], [1.], [2.]])
+
+
+def test_multi_horizon_volatility(port_returns):
+    expected = [np.max((np.std(x[-20:]), np.std(x[-60:]))) * np.sqrt(252) for x in port_returns]
+    np.testing.assert_allclose(multi_horizon_volatility(port_returns), expected, rtol=1e-12)
+    x = port_returns.copy()
+    x[0, -5:] = np.nan
+    expected = np.max((np.nanstd(x[0, -20:]), np.nanstd(x[0, -60:]))) * np.sqrt(252)
+    assert np.isclose(multi_horizon_volatility(x)[0], expected, rtol=1e-12)
+
+
+def test_rolling_multi_horizon_volatility(port_returns):
+    vol = rolling_multi_horizon_volatility(port_returns)
+    assert np.all(np.isnan(vol[:, 0]))
+    for t in range(1, port_returns.shape[1]):
+        np.testing.assert_allclose(vol[:, t], multi_horizon_volatility(port_returns[:, :t + 1]), rtol=1e-8)
+
+
+def test_ewma_volatility(port_returns):
+    halflife = 20
+    alpha = 1 - 0.5 ** (1 / halflife)
+    expected = pd.DataFrame(port_returns.T ** 2).ewm(alpha=alpha, adjust=False).mean().values.T
+    np.testing.assert_allclose(ewma_volatility(port_returns, halflife=halflife), np.sqrt(expected * 252), rtol=1e-12)
+
+
+def test_target_leverage():
+    vol = np.array([0.1, 0.01, 0., np.nan])
+    np.testing.assert_allclose(target_leverage(vol), [0.5, 5., np.inf, np.nan])
+    np.testing.assert_allclose(target_leverage(vol, max_leverage=2., min_leverage=1.), [1., 2., 2., np.nan])
+
+
+@pytest.mark.parametrize('method', ['ewma', 'multi_horizon'])
+def test_daily_leverage_uses_previous_returns(port_returns, method):
+    n_history = 100
+    leverage = daily_leverage(port_returns, n_history, method=method, max_leverage=3.)
+    assert leverage.shape == (3, 200)
+    for t in [0, 1, 57, 199]:
+        history = port_returns[:, :n_history + t]
+        if method == 'ewma':
+            vol = ewma_volatility(history)[:, -1]
+        else:
+            vol = multi_horizon_volatility(history)
+        np.testing.assert_allclose(leverage[:, t], target_leverage(vol, max_leverage=3.), rtol=1e-8)
+    # The return of a date does not change its leverage, up to the rounding of the centering of the returns
+    shocked = port_returns.copy()
+    shocked[:, n_history + 57] = 0.5
+    np.testing.assert_allclose(daily_leverage(shocked, n_history, method=method)[:, :58],
+                               daily_leverage(port_returns, n_history, method=method)[:, :58], rtol=1e-12)
+
+
+def test_daily_fold_leverage(port_returns):
+    folds = np.array([0, 100, 180])
+    rng = np.random.RandomState(1)
+    train = [rng.normal(0., 0.01, (3, 60)) for _ in folds]
+    leverage = daily_fold_leverage(port_returns, folds, train, method='multi_horizon')
+    for start, end, history in zip(folds, [100, 180, 300], train):
+        expected = daily_leverage(np.concatenate([history, port_returns[:, start:end]], axis=1), 60,
+                                  method='multi_horizon')
+        np.testing.assert_allclose(leverage[:, start:end], expected, rtol=1e-12)
@@ -0,0 +1,89 @@
+import pickle
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dl_portfolio import weights as weights_module
+from dl_portfolio.context import PortfolioContext
+from dl_portfolio.weights import portfolio_weights
+
+ASSETS = ['a', 'b', 'c', 'd', 'e']
+PORTFOLIOS = ['markowitz', 'shrink_markowitz', 'ivp', 'hrp', 'hcaa', 'rp']
+
+
+@pytest.fixture
+def returns():
+    rng = np.random.RandomState(0)
+    x = 0.01 * rng.randn(250, len(ASSETS)) * np.linspace(0.5, 2., len(ASSETS)) + 0.0005
+    return pd.DataFrame(x, index=pd.date_range('2020-01-01', periods=250), columns=ASSETS)
+
+
+@pytest.fixture
+def budget():
+    return pd.DataFrame({'rc': [1., 1., 1., 2., 2.]}, index=ASSETS)
+
+
+def _weights(returns, budget, executor=None, **kwargs):
+    solver_info = {}
+    port_w = portfolio_weights(returns, shrink_cov=returns.cov() * 1.1, budget=budget, portfolio=PORTFOLIOS,
+                               executor=executor, solver_info=solver_info, fold=0, optimal_num_clusters=2,
+                               **kwargs)
+    return port_w, solver_info
+
+
+def test_threads_match_sequential(returns, budget):
+    expected, expected_info = _weights(returns, budget)
+    with ThreadPoolExecutor(4) as executor:
+        port_w, solver_info = _weights(returns, budget, executor=executor)
+    assert list(port_w) == PORTFOLIOS
+    for p in PORTFOLIOS:
+        # Solver tolerance: the second Markowitz solve is warm-started by the engine
+        atol = 1e-4 if p in ['markowitz', 'shrink_markowitz', 'rp'] else 1e-10
+        np.testing.assert_allclose(port_w[p].values, expected[p].values, atol=atol)
+    assert set(solver_info) == set(expected_info) == {'markowitz', 'shrink_markowitz'}
+    assert all(solver_info[p]['fold'] == 0 for p in solver_info)
+
+
+@pytest.mark.parametrize('n_threads', [None, 4])
+def test_failed_strategy_gives_none(returns, budget, monkeypatch, n_threads):
+    def _fail(*args, **kwargs):
+        raise ValueError('singular covariance')
+
+    monkeypatch.setattr(weights_module, 'ivp_weights', _fail)
+    if n_threads:
+        with ThreadPoolExecutor(n_threads) as executor:
+            port_w, _ = _weights(returns, budget, executor=executor)
+    else:
+        port_w, _ = _weights(returns, budget)
+    assert port_w['ivp'] is None
+    for p in PORTFOLIOS:
+        if p != 'ivp':
+            assert port_w[p] is not None
+            np.testing.assert_allclose(port_w[p].sum(), 1., atol=1e-6)
+
+
+def test_failed_strategy_is_not_cached(returns, budget, monkeypatch):
+    context = PortfolioContext(returns)
+    monkeypatch.setattr(weights_module, 'ivp_weights', lambda *args, **kwargs: 1 / 0)
+    assert portfolio_weights(returns, portfolio=['ivp'], context=context)['ivp'] is None
+    monkeypatch.undo()
+    assert portfolio_weights(returns, portfolio=['ivp'], context=context)['ivp'] is not None
+
+
+def test_process_pool_rejected(returns, budget):
+    with ProcessPoolExecutor(1) as executor:
+        with pytest.raises(AssertionError):
+            _weights(returns, budget, executor=executor)
+
+
+def test_context_pickle(returns):
+    context = PortfolioContext(returns)
+    link = context.linkage('single')
+    loaded = pickle.loads(pickle.dumps(context))
+    np.testing.assert_array_equal(loaded.linkage('single'), link)
+    with ThreadPoolExecutor(2) as executor:
+        labels = list(executor.map(loaded.kmeans_labels, [2, 2]))
+    np.testing.assert_array_equal(labels[0], labels[1])